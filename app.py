@@ -1,8 +1,13 @@
-import copy
+import asyncio
+import base64
+import hashlib
 import json
+import math
 import os
 import logging
+import time
 import uuid
+from datetime import datetime
 from dotenv import load_dotenv
 import httpx
 from quart import (
@@ -20,11 +25,14 @@ from azure.identity.aio import (
     DefaultAzureCredential,
     get_bearer_token_provider
 )
+from azure.cosmos.aio import CosmosClient
 from openai import AsyncOpenAI
 from openai import AsyncAzureOpenAI
+from openai import DEFAULT_TIMEOUT
 from backend.auth.auth_utils import (
     get_userid,
     get_authenticated_user_details, 
+    warm_up_firebase,
     fetch_users,
     verify_email,
     set_custom_claims,
@@ -37,13 +45,52 @@ from backend.auth.auth_utils import (
     get_custom_claims
 )
 from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.summary import SummaryCache, apply_summary, select_turns, summary_request
+from backend.history.tail import ConversationTailCache, StaleHistoryError
 from backend.prompt.cosmosdbservice import CosmosPromptClient
+from backend.cache.response_cache import ResponseCache
+from backend.cache.semantic_cache import SemanticCache
+from backend.attachments.image import ImagePreprocessor
+from backend.attachments.index import AttachmentIndex
+from backend.attachments.extract import AttachmentExtractor, UnsupportedAttachmentError
+from backend.attachments.store import AttachmentStore, LocalBlobContainer
+from backend.attachments.upload import UploadRejected, UploadSpooler
+from backend.llm.context import (
+    MODEL_REGISTRY,
+    TokenCounter,
+    get_encoder,
+    get_model_spec,
+    pack_messages,
+)
+from backend.llm.admission import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_STANDARD,
+    AdmissionController,
+    priority_from_claims,
+)
+from backend.llm.router import Deployment, DeploymentRouter
+from backend.llm.replay import ReplayExpired, ReplayStore
+from backend.llm.singleflight import SingleFlight
+from backend.llm.resilience import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    get_retry_after,
+    is_retryable,
+)
 from backend.utils import (
+    ClosingStream,
+    ORJSONProvider,
+    buffer_stream_response,
+    closes_source,
+    coalesce_stream_response,
+    drop_finish_frames,
     format_as_ndjson,
     format_stream_response,
     generateFilterString,
     parse_multi_columns,
     format_non_streaming_response,
+    try_lock_file,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static",
@@ -72,6 +119,33 @@ def create_app():
     app = Quart(__name__)
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
+    if USE_ORJSON:
+        app.json = ORJSONProvider(app)
+
+    maintenance_tasks = []
+
+    @app.before_serving
+    async def init_clients():
+        init_openai_clients()
+        init_cosmosdb_clients()
+        if WARMUP_ENABLED:
+            await warm_up()
+        warmup_state["ready"] = True
+        if ATTACHMENT_GC_INTERVAL > 0 and CHAT_HISTORY_ENABLED:
+            maintenance_tasks.append(asyncio.create_task(collect_attachment_garbage()))
+
+    @app.after_serving
+    async def close_clients():
+        warmup_state["ready"] = False
+        for task in maintenance_tasks:
+            task.cancel()
+        attachment_extractor.shutdown()
+        # let pending history writes finish before their clients go away
+        if background_tasks:
+            await asyncio.wait(background_tasks, timeout=10)
+        await close_openai_clients()
+        await close_cosmosdb_clients()
+
     return app
 
 
@@ -90,6 +164,13 @@ async def assets(path):
     return await send_from_directory("static/assets", path)
 
 
+@bp.route("/ready")
+async def ready():
+    # readiness probe for the load balancer, only healthy once warmed up
+    status = 200 if warmup_state["ready"] else 503
+    return jsonify(warmup_state), status
+
+
 # Debug settings
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -137,6 +218,197 @@ AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
 SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
 
+# LLM HTTP Connection Pool Settings
+OPENAI_HTTP_MAX_CONNECTIONS = int(
+    os.environ.get("OPENAI_HTTP_MAX_CONNECTIONS", 100))
+OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+OPENAI_HTTP_KEEPALIVE_EXPIRY = float(
+    os.environ.get("OPENAI_HTTP_KEEPALIVE_EXPIRY", 60))
+OPENAI_HTTP2 = os.environ.get("OPENAI_HTTP2", "true").lower() == "true"
+
+# Serialize JSON responses with orjson
+USE_ORJSON = os.environ.get("USE_ORJSON", "false").lower() == "true"
+
+# Stream frame coalescing (disabled when the interval is 0)
+STREAM_COALESCE_INTERVAL_MS = int(
+    os.environ.get("STREAM_COALESCE_INTERVAL_MS", 0))
+STREAM_COALESCE_MAX_BYTES = int(
+    os.environ.get("STREAM_COALESCE_MAX_BYTES", 1024))
+
+# Maximum number of frames read ahead of the client per streamed response
+STREAM_BUFFER_SIZE = int(os.environ.get("STREAM_BUFFER_SIZE", 32))
+
+# How long a finished stream waits for the title of a new conversation
+# before closing without it; the title is saved to history either way
+TITLE_GENERATION_WAIT = float(os.environ.get("TITLE_GENERATION_WAIT", 3))
+
+# Last messages of recently used conversations, so /history/generate can take
+# just the new message (with the version it was sent against) instead of the
+# whole history; a miss is filled from CosmosDB. Each delta request reads the
+# conversation's history generation, bumped on clear, to drop stale tails
+CONVERSATION_TAIL_CACHE_SIZE = int(os.environ.get("CONVERSATION_TAIL_CACHE_SIZE", 1000))
+CONVERSATION_TAIL_MESSAGES = int(os.environ.get("CONVERSATION_TAIL_MESSAGES", 50))
+
+# Rolling summaries of long conversations. Once the turns not yet summarized
+# take more than SUMMARY_TRIGGER_TOKENS, all but the last SUMMARY_KEEP_TURNS
+# of them are folded into the summary by SUMMARY_MODEL in the background,
+# and later requests send the summary instead of those turns
+SUMMARY_ENABLED = os.environ.get("SUMMARY_ENABLED", "false").lower() == "true"
+SUMMARY_TRIGGER_TOKENS = int(os.environ.get("SUMMARY_TRIGGER_TOKENS", 6000))
+SUMMARY_KEEP_TURNS = int(os.environ.get("SUMMARY_KEEP_TURNS", 4))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "az-gpt-3.5")
+SUMMARY_MAX_TOKENS = int(os.environ.get("SUMMARY_MAX_TOKENS", 600))
+
+# Open upstream connections, read CosmosDB container properties, fetch
+# credentials and Firebase keys and load tokenizers before the worker
+# serves, giving up on whatever is not done after WARMUP_TIMEOUT seconds
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_TIMEOUT = float(os.environ.get("WARMUP_TIMEOUT", 20))
+
+# Identical /history/generate requests (same user, conversation, model and
+# last message, or the same Idempotency-Key header) share one completion
+# while it runs and for SINGLE_FLIGHT_LINGER seconds after it ends
+SINGLE_FLIGHT_ENABLED = (
+    os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+)
+SINGLE_FLIGHT_LINGER = float(os.environ.get("SINGLE_FLIGHT_LINGER", 5))
+
+# Resumable /history/generate streams: the last RESUME_BUFFER_FRAMES frames
+# of each answer are kept by message id until RESUME_TTL seconds after it
+# ends, and a client that lost the connection continues from its offset with
+# /conversation/resume. An answer nobody reads is cancelled after
+# RESUME_GRACE_PERIOD seconds. The buffers live in the worker that runs the
+# answer, so with more than one worker (gunicorn.conf.py) the load balancer
+# must keep a client on one instance and worker (sticky sessions, e.g. App
+# Service ARR affinity with a single worker per instance); a resume that reaches
+# another worker gets 404 and the client shows the error as before
+RESUMABLE_STREAMS_ENABLED = (
+    os.environ.get("RESUMABLE_STREAMS_ENABLED", "false").lower() == "true"
+)
+RESUME_BUFFER_FRAMES = int(os.environ.get("RESUME_BUFFER_FRAMES", 2048))
+RESUME_TTL = float(os.environ.get("RESUME_TTL", 60))
+RESUME_GRACE_PERIOD = float(os.environ.get("RESUME_GRACE_PERIOD", 15))
+RESUME_MAX_STREAMS = int(os.environ.get("RESUME_MAX_STREAMS", 1000))
+
+# Exact-match response cache for deterministic (temperature 0) requests
+RESPONSE_CACHE_ENABLED = (
+    os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+)
+RESPONSE_CACHE_MAX_SIZE = int(
+    os.environ.get("RESPONSE_CACHE_MAX_SIZE", 10000000))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+
+# Semantic answer cache for single-turn questions
+SEMANTIC_CACHE_ENABLED = (
+    os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+)
+SEMANTIC_CACHE_THRESHOLD = float(
+    os.environ.get("SEMANTIC_CACHE_THRESHOLD", 0.95))
+SEMANTIC_CACHE_MAX_ENTRIES = int(
+    os.environ.get("SEMANTIC_CACHE_MAX_ENTRIES", 5000))
+SEMANTIC_CACHE_TTL = float(os.environ.get("SEMANTIC_CACHE_TTL", 3600))
+# Give up on the cache when the question embedding takes longer than this
+SEMANTIC_CACHE_EMBEDDING_TIMEOUT = float(
+    os.environ.get("SEMANTIC_CACHE_EMBEDDING_TIMEOUT", 0.5))
+
+# Latency-aware routing across equivalent deployments. LLM_DEPLOYMENTS is a
+# JSON object that maps gptModel values to lists of deployments, e.g.
+# {"gpt-4o": [{"name": "openai", "backend": "openai", "model": "gpt-4o"},
+#             {"name": "aoai-japaneast", "backend": "azure", "model": "gpt-4o",
+#              "endpoint": "https://<resource>.openai.azure.com/", "api_key": "<key>"}]}
+LLM_DEPLOYMENTS = os.environ.get("LLM_DEPLOYMENTS")
+LLM_ROUTER_WINDOW_SECONDS = float(
+    os.environ.get("LLM_ROUTER_WINDOW_SECONDS", 60))
+LLM_ROUTER_MAX_ERROR_RATE = float(
+    os.environ.get("LLM_ROUTER_MAX_ERROR_RATE", 0.5))
+
+# Retries before the first streamed chunk, and per-deployment circuit breaker
+LLM_RETRY_MAX_ATTEMPTS = int(os.environ.get("LLM_RETRY_MAX_ATTEMPTS", 3))
+LLM_RETRY_DEADLINE = float(os.environ.get("LLM_RETRY_DEADLINE", 20))
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", 0.5))
+LLM_RETRY_MAX_DELAY = float(os.environ.get("LLM_RETRY_MAX_DELAY", 8))
+LLM_CIRCUIT_FAILURE_THRESHOLD = int(
+    os.environ.get("LLM_CIRCUIT_FAILURE_THRESHOLD", 5))
+LLM_CIRCUIT_RESET_TIMEOUT = float(
+    os.environ.get("LLM_CIRCUIT_RESET_TIMEOUT", 30))
+
+# Admission control for chat completions. Guests share one user id, so the
+# per-user cap applies to all of them together
+ADMISSION_CONTROL_ENABLED = (
+    os.environ.get("ADMISSION_CONTROL_ENABLED", "false").lower() == "true"
+)
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", 64))
+ADMISSION_MAX_PER_USER = int(os.environ.get("ADMISSION_MAX_PER_USER", 4))
+ADMISSION_MAX_QUEUE = int(os.environ.get("ADMISSION_MAX_QUEUE", 128))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 10))
+# Slots only premium requests may use, and the priority given to custom claims
+# of the verified token, e.g. {"admin": 3, "level=premium": 2}. Others get 1,
+# title generation 0
+ADMISSION_RESERVED_SLOTS = int(os.environ.get("ADMISSION_RESERVED_SLOTS", 0))
+ADMISSION_PRIORITY_CLAIMS = json.loads(
+    os.environ.get("ADMISSION_PRIORITY_CLAIMS", '{"admin": 3, "level=premium": 2}'))
+
+# Chat attachments are spooled to UPLOAD_SPOOL_DIR (the system temp dir by
+# default) while they are received and checked against these limits
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 20 * 1024 * 1024))
+UPLOAD_ALLOWED_TYPES = [
+    content_type.strip()
+    for content_type in os.environ.get(
+        "UPLOAD_ALLOWED_TYPES",
+        "application/pdf,text/*,image/png,image/jpeg,image/gif,image/webp,"
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ).split(",")
+    if content_type.strip()
+]
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR")
+# Content-addressed attachment store. Blobs no message refers to are removed
+# every ATTACHMENT_GC_INTERVAL seconds (0 turns this off) once they are older
+# than ATTACHMENT_GC_GRACE_PERIOD, by one worker per ATTACHMENT_STORE_DIR
+ATTACHMENT_STORE_DIR = os.environ.get("ATTACHMENT_STORE_DIR", "usr/attachments")
+ATTACHMENT_GC_INTERVAL = float(os.environ.get("ATTACHMENT_GC_INTERVAL", 86400))
+ATTACHMENT_GC_GRACE_PERIOD = float(os.environ.get("ATTACHMENT_GC_GRACE_PERIOD", 3600))
+
+# Text extraction from attachments, in worker processes with results cached by
+# content hash. Up to ATTACHMENT_CONTEXT_TOKENS of it is added to the question
+ATTACHMENT_EXTRACT_WORKERS = int(os.environ.get("ATTACHMENT_EXTRACT_WORKERS", 2))
+# megabytes (characters) of extracted chunks cached per worker
+ATTACHMENT_EXTRACT_CACHE_MB = int(os.environ.get("ATTACHMENT_EXTRACT_CACHE_MB", 64))
+ATTACHMENT_CHUNK_TOKENS = int(os.environ.get("ATTACHMENT_CHUNK_TOKENS", 256))
+ATTACHMENT_CONTEXT_TOKENS = int(os.environ.get("ATTACHMENT_CONTEXT_TOKENS", 3000))
+
+# Per-conversation vector index of attachment chunks, so later questions get
+# the ATTACHMENT_INDEX_TOP_K closest chunks instead of the start of the file.
+# Needs AZURE_OPENAI_EMBEDDING_ENDPOINT. Workers check their copy against the
+# file in ATTACHMENT_INDEX_DIR, so a cleared conversation is cleared for all of
+# them; ATTACHMENT_INDEX_DIR="" keeps indexes in memory, per worker
+ATTACHMENT_INDEX_ENABLED = (
+    os.environ.get("ATTACHMENT_INDEX_ENABLED", "false").lower() == "true"
+)
+ATTACHMENT_INDEX_TOP_K = int(os.environ.get("ATTACHMENT_INDEX_TOP_K", 5))
+ATTACHMENT_INDEX_MAX_CONVERSATIONS = int(
+    os.environ.get("ATTACHMENT_INDEX_MAX_CONVERSATIONS", 1000))
+ATTACHMENT_INDEX_MAX_MB = int(os.environ.get("ATTACHMENT_INDEX_MAX_MB", 256))
+ATTACHMENT_INDEX_DIR = os.environ.get("ATTACHMENT_INDEX_DIR", "usr/indexes")
+# seconds a turn waits for its question embedding before going without retrieval
+ATTACHMENT_INDEX_EMBEDDING_TIMEOUT = float(
+    os.environ.get("ATTACHMENT_INDEX_EMBEDDING_TIMEOUT", 2))
+# New attachments are indexed in the background, at most ATTACHMENT_INDEX_MAX_CHUNKS
+# chunks each with ATTACHMENT_INDEX_EMBEDDING_CONCURRENCY embedding calls at a
+# time per worker; the turn that uploads one is answered from its first chunks
+ATTACHMENT_INDEX_MAX_CHUNKS = int(os.environ.get("ATTACHMENT_INDEX_MAX_CHUNKS", 400))
+ATTACHMENT_INDEX_EMBEDDING_CONCURRENCY = int(
+    os.environ.get("ATTACHMENT_INDEX_EMBEDDING_CONCURRENCY", 4))
+
+# Image attachments for vision models are downscaled to what the model uses
+# (IMAGE_MAX_TILES 512px tiles at most, 0 for the model's own limit) and
+# re-encoded before they are sent, cached by content hash
+IMAGE_DETAIL = os.environ.get("IMAGE_DETAIL", "high")
+IMAGE_MAX_TILES = int(os.environ.get("IMAGE_MAX_TILES", 0))
+IMAGE_OUTPUT_FORMAT = os.environ.get("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 85))
+IMAGE_CACHE_SIZE = int(os.environ.get("IMAGE_CACHE_SIZE", 64))
+
 # Chat History CosmosDB Integration Settings
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
 AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
@@ -173,28 +445,45 @@ frontend_settings = {
 }
 
 
-# Initialize Azure OpenAI Client
-def init_openai_client():
+def init_openai_http_client():
+    return httpx.AsyncClient(
+        timeout=DEFAULT_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=OPENAI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=OPENAI_HTTP2,
+        follow_redirects=True,
+    )
+
+
+# Initialize OpenAI Client
+def init_openai_client(api_key=None, base_url=None):
     openai_client = None
     try:
         # Authentication
-        aoai_api_key = OPENAI_API_KEY
+        aoai_api_key = api_key or OPENAI_API_KEY
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
         openai_client = AsyncOpenAI(
             api_key=aoai_api_key,
-            default_headers=default_headers
+            base_url=base_url,
+            default_headers=default_headers,
+            http_client=init_openai_http_client(),
+            # retries are handled by send_chat_request
+            max_retries=0,
         )
 
         return openai_client
     except Exception as e:
-        logging.exception("Exception in Azure OpenAI initialization", e)
-        azure_openai_client = None
+        logging.exception("Exception in OpenAI initialization", e)
+        openai_client = None
         raise e
 
 # Initialize Azure OpenAI Client
-def init_azopenai_client():
+def init_azopenai_client(endpoint=None, api_key=None):
     azure_openai_client = None
     try:
         # API version check
@@ -207,19 +496,19 @@ def init_azopenai_client():
             )
 
         # Endpoint
-        if not AZURE_OPENAI_ENDPOINT and not AZURE_OPENAI_RESOURCE:
+        if not endpoint and not AZURE_OPENAI_ENDPOINT and not AZURE_OPENAI_RESOURCE:
             raise Exception(
                 "AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required"
             )
 
         endpoint = (
-            AZURE_OPENAI_ENDPOINT
-            if AZURE_OPENAI_ENDPOINT
-            else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
+            endpoint
+            or AZURE_OPENAI_ENDPOINT
+            or f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
         )
 
         # Authentication
-        aoai_api_key = AZURE_OPENAI_KEY
+        aoai_api_key = api_key or AZURE_OPENAI_KEY
         ad_token_provider = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure AD auth")
@@ -240,6 +529,9 @@ def init_azopenai_client():
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
             azure_endpoint=endpoint,
+            http_client=init_openai_http_client(),
+            # retries are handled by send_chat_request
+            max_retries=0,
         )
 
         return azure_openai_client
@@ -249,25 +541,372 @@ def init_azopenai_client():
         raise e
 
 
-def init_conversation_cosmosdb_client():
-    cosmos_conversation_client = None
+# Initialize Azure OpenAI Embedding Client
+def init_embedding_client():
+    embedding_client = None
     try:
+        if not AZURE_OPENAI_EMBEDDING_ENDPOINT:
+            raise Exception("AZURE_OPENAI_EMBEDDING_ENDPOINT is required")
+
+        # The endpoint is either the full embeddings URL or the resource URL
+        api_version = AZURE_OPENAI_PREVIEW_API_VERSION
+        if "/openai/deployments/" in AZURE_OPENAI_EMBEDDING_ENDPOINT:
+            endpoint, deployment_path = AZURE_OPENAI_EMBEDDING_ENDPOINT.split(
+                "/openai/deployments/")
+            if "api-version=" in deployment_path:
+                api_version = deployment_path.split(
+                    "api-version=")[1].split("&")[0]
+        else:
+            endpoint = AZURE_OPENAI_EMBEDDING_ENDPOINT
+
+        # Authentication
+        ad_token_provider = None
+        if not AZURE_OPENAI_EMBEDDING_KEY:
+            logging.debug(
+                "No AZURE_OPENAI_EMBEDDING_KEY found, using Azure AD auth")
+            ad_token_provider = get_bearer_token_provider(
+                DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default"
+            )
+
+        embedding_client = AsyncAzureOpenAI(
+            api_version=api_version,
+            api_key=AZURE_OPENAI_EMBEDDING_KEY,
+            azure_ad_token_provider=ad_token_provider,
+            default_headers={"x-ms-useragent": USER_AGENT},
+            azure_endpoint=endpoint,
+            http_client=init_openai_http_client(),
+        )
+
+        return embedding_client
+    except Exception as e:
+        logging.exception("Exception in Azure OpenAI embedding initialization", e)
+        embedding_client = None
+        raise e
+
+
+def get_embedding_deployment():
+    if "/openai/deployments/" in (AZURE_OPENAI_EMBEDDING_ENDPOINT or ""):
+        return AZURE_OPENAI_EMBEDDING_ENDPOINT.split(
+            "/openai/deployments/")[1].split("/")[0]
+    return AZURE_OPENAI_EMBEDDING_NAME
+
+
+# Worker-wide LLM clients, keyed by deployment name ("openai" / "azure" /
+# "embedding" for the clients configured by the AZURE_OPENAI_* settings)
+openai_clients = {}
+
+
+def get_deployment_client(deployment):
+    client = openai_clients.get(deployment.name)
+    if client is None:
+        if deployment.backend == "azure":
+            client = init_azopenai_client(deployment.endpoint, deployment.api_key)
+        else:
+            client = init_openai_client(deployment.api_key, deployment.endpoint)
+        openai_clients[deployment.name] = client
+    return client
+
+
+def get_openai_client(backend="openai"):
+    client = openai_clients.get(backend)
+    if client is None:
+        if backend == "azure":
+            client = init_azopenai_client()
+        elif backend == "embedding":
+            client = init_embedding_client()
+        else:
+            client = init_openai_client()
+        openai_clients[backend] = client
+    return client
+
+
+def init_openai_clients():
+    for deployment in llm_router.all_deployments():
+        try:
+            get_deployment_client(deployment)
+        except Exception:
+            logging.warning("LLM client for %s is not configured", deployment.name)
+    if semantic_cache:
+        try:
+            get_openai_client("embedding")
+        except Exception:
+            logging.warning("LLM client for embedding is not configured")
+
+
+warmup_state = {"ready": False, "duration_ms": None, "steps": {}}
+
+
+async def warm_up_openai():
+    # one cheap request per client opens its pooled connection (DNS and TLS)
+    clients = {id(client): client for client in openai_clients.values()}
+    await asyncio.gather(*[client.models.list() for client in clients.values()])
+
+
+async def warm_up_cosmosdb():
+    credential = cosmosdb_clients.get("credential")
+    if credential:
+        await credential.get_token("https://cosmos.azure.com/.default")
+    for name in ("conversation", "prompt"):
+        client = cosmosdb_clients.get(name)
+        if client:
+            success, err = await client.ensure()
+            if not success:
+                raise Exception(err)
+
+
+def warm_up_tokenizers():
+    for spec in MODEL_REGISTRY.values():
+        get_encoder(spec.encoding)
+
+
+async def warm_up():
+    steps = {
+        "openai": warm_up_openai(),
+        "tokenizers": asyncio.to_thread(warm_up_tokenizers),
+    }
+    if cosmosdb_clients:
+        steps["cosmosdb"] = warm_up_cosmosdb()
+    if os.environ.get("FIREBASE_PRIVATE_KEY"):
+        steps["firebase"] = asyncio.to_thread(warm_up_firebase)
+
+    async def run(name, step):
+        step_start = time.monotonic()
+        try:
+            await asyncio.wait_for(step, WARMUP_TIMEOUT)
+            warmup_state["steps"][name] = "ok"
+        except Exception as e:
+            ## a step that fails is retried lazily by the first request that needs it
+            logging.warning("Warm-up of %s failed: %r", name, e)
+            warmup_state["steps"][name] = "failed"
+        logging.info("Warm-up of %s took %d ms", name, (time.monotonic() - step_start) * 1000)
+
+    start = time.monotonic()
+    await asyncio.gather(*[run(name, step) for name, step in steps.items()])
+    warmup_state["duration_ms"] = round((time.monotonic() - start) * 1000)
+
+
+def init_llm_router():
+    deployments = {
+        "gpt-3.5-turbo-0125": [
+            {"name": "openai", "backend": "openai", "model": "gpt-3.5-turbo-0125"}
+        ],
+        "gpt-4": [{"name": "openai", "backend": "openai", "model": "gpt-4"}],
+        "gpt-4o": [{"name": "openai", "backend": "openai", "model": "gpt-4o"}],
+        "az-gpt-3.5": [
+            {"name": "azure", "backend": "azure", "model": AZURE_OPENAI_GPT35_TURBO_16K_MODEL}
+        ],
+        "az-gpt-4": [
+            {"name": "azure", "backend": "azure", "model": AZURE_OPENAI_GPT4_MODEL}
+        ],
+    }
+    if LLM_DEPLOYMENTS:
+        deployments.update(json.loads(LLM_DEPLOYMENTS))
+
+    return DeploymentRouter(
+        {
+            gptModel: [
+                Deployment(
+                    window_seconds=LLM_ROUTER_WINDOW_SECONDS,
+                    breaker=CircuitBreaker(
+                        failure_threshold=LLM_CIRCUIT_FAILURE_THRESHOLD,
+                        reset_timeout=LLM_CIRCUIT_RESET_TIMEOUT,
+                    ),
+                    **deployment,
+                )
+                for deployment in model_deployments
+            ]
+            for gptModel, model_deployments in deployments.items()
+        },
+        default_model="gpt-3.5-turbo-0125",
+        max_error_rate=LLM_ROUTER_MAX_ERROR_RATE,
+    )
+
+
+async def close_openai_clients():
+    while openai_clients:
+        _, client = openai_clients.popitem()
+        try:
+            await client.close()
+        except Exception:
+            logging.exception("Exception while closing LLM client")
+
+
+async def collect_attachment_garbage():
+    # Only the worker holding the lock file in the store collects; another one
+    # takes over at its next interval once the holder exits
+    gc_lock = None
+    while True:
+        await asyncio.sleep(ATTACHMENT_GC_INTERVAL)
+        gc_lock = gc_lock or try_lock_file(os.path.join(ATTACHMENT_STORE_DIR, ".gc.lock"))
+        if not gc_lock:
+            continue
+        try:
+            cosmos_conversation_client = init_conversation_cosmosdb_client()
+            referenced = await cosmos_conversation_client.get_attachment_hashes()
+            deleted = await attachment_store.collect_garbage(referenced)
+            logging.info("Removed %d unreferenced attachments", deleted)
+        except Exception:
+            logging.exception("Exception while collecting attachments")
+
+
+background_tasks = set()
+
+
+def run_in_background(coro):
+    # keep a reference so the task is not garbage collected before it is done
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_task_done)
+    return task
+
+
+def background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logging.error("Exception in background task", exc_info=task.exception())
+
+
+token_counter = TokenCounter()
+
+upload_spooler = UploadSpooler(
+    max_file_size=UPLOAD_MAX_BYTES,
+    allowed_types=UPLOAD_ALLOWED_TYPES,
+    spool_dir=UPLOAD_SPOOL_DIR,
+)
+
+attachment_store = AttachmentStore(
+    LocalBlobContainer(ATTACHMENT_STORE_DIR),
+    grace_period=ATTACHMENT_GC_GRACE_PERIOD,
+)
+
+attachment_index = (
+    AttachmentIndex(
+        max_conversations=ATTACHMENT_INDEX_MAX_CONVERSATIONS,
+        max_bytes=ATTACHMENT_INDEX_MAX_MB * 1024 * 1024,
+        persist_dir=ATTACHMENT_INDEX_DIR or None,
+    )
+    if ATTACHMENT_INDEX_ENABLED
+    else None
+)
+attachment_embedding_slots = asyncio.Semaphore(ATTACHMENT_INDEX_EMBEDDING_CONCURRENCY)
+## (index key, sha256) of the attachments being indexed in the background
+indexing_attachments = set()
+
+image_preprocessor = ImagePreprocessor(
+    max_entries=IMAGE_CACHE_SIZE,
+    detail=IMAGE_DETAIL,
+    max_tiles=IMAGE_MAX_TILES or None,
+    output_format=IMAGE_OUTPUT_FORMAT,
+    quality=IMAGE_QUALITY,
+)
+
+attachment_extractor = AttachmentExtractor(
+    max_workers=ATTACHMENT_EXTRACT_WORKERS,
+    max_size=ATTACHMENT_EXTRACT_CACHE_MB * 1024 * 1024,
+    num_tokens=ATTACHMENT_CHUNK_TOKENS,
+)
+
+llm_retry_policy = RetryPolicy(
+    max_attempts=LLM_RETRY_MAX_ATTEMPTS,
+    deadline=LLM_RETRY_DEADLINE,
+    base_delay=LLM_RETRY_BASE_DELAY,
+    max_delay=LLM_RETRY_MAX_DELAY,
+)
+
+llm_router = init_llm_router()
+
+conversation_tails = ConversationTailCache(
+    max_conversations=CONVERSATION_TAIL_CACHE_SIZE,
+    max_messages=CONVERSATION_TAIL_MESSAGES,
+)
+
+conversation_summaries = SummaryCache() if SUMMARY_ENABLED else None
+
+replay_store = (
+    ReplayStore(
+        max_frames=RESUME_BUFFER_FRAMES,
+        ttl=RESUME_TTL,
+        grace=RESUME_GRACE_PERIOD,
+        max_streams=RESUME_MAX_STREAMS,
+    )
+    if RESUMABLE_STREAMS_ENABLED
+    else None
+)
+
+single_flight = SingleFlight(linger=SINGLE_FLIGHT_LINGER) if SINGLE_FLIGHT_ENABLED else None
+
+admission_controller = (
+    AdmissionController(
+        max_concurrency=ADMISSION_MAX_CONCURRENCY,
+        max_per_user=ADMISSION_MAX_PER_USER,
+        max_queue=ADMISSION_MAX_QUEUE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT,
+        reserved=ADMISSION_RESERVED_SLOTS,
+    )
+    if ADMISSION_CONTROL_ENABLED
+    else None
+)
+
+response_cache = (
+    ResponseCache(max_size=RESPONSE_CACHE_MAX_SIZE, ttl=RESPONSE_CACHE_TTL)
+    if RESPONSE_CACHE_ENABLED
+    else None
+)
+semantic_cache = (
+    SemanticCache(
+        threshold=SEMANTIC_CACHE_THRESHOLD,
+        max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl=SEMANTIC_CACHE_TTL,
+    )
+    if SEMANTIC_CACHE_ENABLED
+    else None
+)
+
+
+# Worker-wide CosmosDB clients: one account client shared by the
+# conversation and prompt services
+cosmosdb_clients = {}
+
+
+def get_cosmosdb_credential():
+    if AZURE_COSMOSDB_ACCOUNT_KEY:
+        return AZURE_COSMOSDB_ACCOUNT_KEY
+    credential = cosmosdb_clients.get("credential")
+    if credential is None:
+        credential = DefaultAzureCredential()
+        cosmosdb_clients["credential"] = credential
+    return credential
+
+
+def get_cosmosdb_client():
+    client = cosmosdb_clients.get("account")
+    if client is None:
         cosmos_endpoint = (
             f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/"
         )
+        client = CosmosClient(cosmos_endpoint, credential=get_cosmosdb_credential())
+        cosmosdb_clients["account"] = client
+    return client
 
-        if not AZURE_COSMOSDB_ACCOUNT_KEY:
-            credential = DefaultAzureCredential()
-        else:
-            credential = AZURE_COSMOSDB_ACCOUNT_KEY
+
+def init_conversation_cosmosdb_client():
+    cosmos_conversation_client = cosmosdb_clients.get("conversation")
+    if cosmos_conversation_client:
+        return cosmos_conversation_client
+    try:
+        cosmos_endpoint = (
+            f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/"
+        )
 
         cosmos_conversation_client = CosmosConversationClient(
             cosmosdb_endpoint=cosmos_endpoint,
-            credential=credential,
+            credential=get_cosmosdb_credential(),
             database_name=AZURE_COSMOSDB_DATABASE,
             container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
             enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
+            cosmosdb_client=get_cosmosdb_client(),
         )
+        cosmosdb_clients["conversation"] = cosmos_conversation_client
     except Exception as e:
         logging.exception("Exception in CosmosDB initialization", e)
         cosmos_conversation_client = None
@@ -277,23 +916,22 @@ def init_conversation_cosmosdb_client():
 
 
 def init_prompt_cosmosdb_client():
-    cosmos_prompt_client = None
+    cosmos_prompt_client = cosmosdb_clients.get("prompt")
+    if cosmos_prompt_client:
+        return cosmos_prompt_client
     try:
         cosmos_endpoint = (
             f"https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/"
         )
 
-        if not AZURE_COSMOSDB_ACCOUNT_KEY:
-            credential = DefaultAzureCredential()
-        else:
-            credential = AZURE_COSMOSDB_ACCOUNT_KEY
-
         cosmos_prompt_client = CosmosPromptClient(
             cosmosdb_endpoint=cosmos_endpoint,
-            credential=credential,
+            credential=get_cosmosdb_credential(),
             database_name=AZURE_COSMOSDB_DATABASE,
             container_name=AZURE_COSMOSDB_PROMPTS_CONTAINER,
+            cosmosdb_client=get_cosmosdb_client(),
         )
+        cosmosdb_clients["prompt"] = cosmos_prompt_client
     except Exception as e:
         logging.exception("Exception in CosmosDB initialization", e)
         cosmos_prompt_client = None
@@ -302,9 +940,33 @@ def init_prompt_cosmosdb_client():
     return cosmos_prompt_client
 
 
+def init_cosmosdb_clients():
+    if not AZURE_COSMOSDB_ACCOUNT:
+        return
+    try:
+        init_conversation_cosmosdb_client()
+        init_prompt_cosmosdb_client()
+    except Exception:
+        logging.warning("CosmosDB clients could not be initialized")
+
+
+async def close_cosmosdb_clients():
+    client = cosmosdb_clients.get("account")
+    credential = cosmosdb_clients.get("credential")
+    cosmosdb_clients.clear()
+    try:
+        if client:
+            await client.close()
+        if credential:
+            await credential.close()
+    except Exception:
+        logging.exception("Exception while closing CosmosDB client")
+
+
 def prepare_model_args(request_body):
     request_messages = request_body.get("messages", [])
     gptModel= request_body.get("gptModel", "gpt-3.5-turbo-0125")
+    model_spec = get_model_spec(gptModel)
     if gptModel == "gpt-3.5-turbo-0125":
         gptModel = "gpt-3.5-turbo-0125"
     elif gptModel == "gpt-4":
@@ -321,16 +983,58 @@ def prepare_model_args(request_body):
     messages = []
     
     system_message = AZURE_OPENAI_SYSTEM_MESSAGE
+    if request_body.get("summary"):
+        ## in the system message, so packing never drops it
+        system_message += "\n\nSummary of the earlier conversation:\n" + request_body["summary"]
     messages.append({"role": "system", "content": system_message})
     for message in request_messages:
         if message:
             messages.append(
                 {"role": message["role"], "content": message["content"]})
 
+    attachment_context = request_body.get("attachment_context")
+    if attachment_context:
+        budget = ATTACHMENT_CONTEXT_TOKENS
+        texts = []
+        for chunk in attachment_context:
+            budget -= token_counter.count_text(chunk["text"], model_spec.encoding)
+            if budget < 0:
+                break
+            texts.append(f"[{chunk['filename']}]\n{chunk['text']}")
+        if texts:
+            messages[-1] = append_text(
+                messages[-1], "Relevant parts of the attached files:\n\n" + "\n\n".join(texts))
+
+    attachment_images = request_body.get("attachment_images")
+    if attachment_images:
+        content = messages[-1]["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}]
+        messages[-1] = dict(messages[-1], content=content + [
+            {
+                "type": "image_url",
+                "image_url": {"url": image["url"], "detail": IMAGE_DETAIL},
+                "tokens": image["tokens"],
+            }
+            for image in attachment_images
+        ])
+
+    # drop the oldest turns that do not fit the model's context window
+    messages, max_tokens, prompt_tokens = pack_messages(
+        messages, model_spec, int(AZURE_OPENAI_MAX_TOKENS), token_counter
+    )
+    if attachment_images:
+        ## the token estimate is only for packing, the API does not accept it
+        messages[-1] = dict(messages[-1], content=[
+            {key: value for key, value in part.items() if key != "tokens"}
+            for part in messages[-1]["content"]
+        ])
+    logging.debug("Prompt tokens: %s, max_tokens: %s", prompt_tokens, max_tokens)
+
     model_args = {
         "messages": messages,
         "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
+        "max_tokens": max_tokens,
         "top_p": float(AZURE_OPENAI_TOP_P),
         "stop": (
             parse_multi_columns(AZURE_OPENAI_STOP_SEQUENCE)
@@ -340,97 +1044,391 @@ def prepare_model_args(request_body):
         "stream": True,
         "model": gptModel,
     }
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = [
-            "key",
-            "connection_string",
-            "embedding_key",
-            "encoded_api_key",
-            "api_key",
-        ]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(
-                secret_param
-            ):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    secret_param
-                ] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                    "authentication"
-                ][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0][
-            "parameters"
-        ].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"][
-                        "embedding_dependency"
-                    ]["authentication"][field] = "*****"
 
     return model_args
 
 
-async def send_chat_request(request):
-    model_args = prepare_model_args(request)
+async def send_chat_request(request, model_args=None):
+    # Returns (response, deployment, first_chunk). Failed attempts are retried
+    # or failed over only until the first chunk of a stream has arrived, so
+    # nothing has reached the client yet. For streams the caller releases
+    # the deployment's in-flight slot once the stream ends.
+    if model_args is None:
+        model_args = prepare_model_args(request)
+    gptModel = request.get("gptModel")
+    stream = model_args.get("stream", False)
+    deadline = time.monotonic() + llm_retry_policy.deadline
+    failed = set()
+    attempt = 0
+    while True:
+        deployment = llm_router.choose(gptModel, exclude=failed)
+        started_at = time.monotonic()
+        deployment.in_flight += 1
+        response = None
+        try:
+            if not deployment.breaker.allow():
+                raise CircuitOpenError(
+                    deployment.name, deployment.breaker.retry_after())
+            client = get_deployment_client(deployment)
+            response = await client.chat.completions.create(
+                **dict(model_args, model=deployment.model))
+            first_chunk = await anext(response, None) if stream else None
+            deployment.record_first_token(time.monotonic() - started_at)
+            deployment.breaker.record_success()
+            if not stream:
+                deployment.in_flight -= 1
+            return response, deployment, first_chunk
+        except Exception as e:
+            deployment.in_flight -= 1
+            if stream and response is not None:
+                await response.close()
+            retry_after = get_retry_after(e)
+            ## a rejected request says nothing about the deployment's health
+            if is_retryable(e) and not isinstance(e, CircuitOpenError):
+                deployment.record_error()
+                deployment.breaker.record_failure(retry_after)
+
+            attempt += 1
+            if not is_retryable(e) or attempt >= llm_retry_policy.max_attempts:
+                logging.exception("Exception in send_chat_request")
+                raise e
+
+            # fail over at once when another deployment is available,
+            # otherwise back off before retrying the same one
+            failed.add(deployment.name)
+            delay = 0
+            if not llm_router.has_alternative(gptModel, failed):
+                delay = llm_retry_policy.backoff(attempt, retry_after)
+                failed.clear()
+            if time.monotonic() + delay > deadline:
+                logging.exception("Exception in send_chat_request")
+                raise e
+            logging.warning(
+                "Chat request to %s failed (%s), retrying in %.2fs",
+                deployment.name, e, delay,
+            )
+            await asyncio.sleep(delay)
+
+
+async def get_question_embedding(question):
+    start = time.monotonic()
     try:
-        client = init_openai_client()
-        response = await client.chat.completions.create(**model_args)
-        print("Response: ", response)
-    except Exception as e:
-        logging.exception("Exception in send_chat_request")
-        raise e
+        client = get_openai_client("embedding")
+        response = await asyncio.wait_for(
+            client.embeddings.create(
+                model=get_embedding_deployment(), input=question),
+            timeout=SEMANTIC_CACHE_EMBEDDING_TIMEOUT,
+        )
+        return response.data[0].embedding
+    except Exception:
+        logging.warning("Question embedding failed, skipping semantic cache")
+        return None
+    finally:
+        semantic_cache.record_embedding_time(time.monotonic() - start)
 
-    return response
+
+def append_text(message, text):
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return dict(message, content=f"{content}\n\n{text}")
+    return dict(message, content=content + [{"type": "text", "text": text}])
+
+
+def get_message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+
+async def embed_texts(texts, batch_size=16, slots=None):
+    # slots, a semaphore, limits how many batches are embedded at a time
+    client = get_openai_client("embedding")
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+
+    async def embed(batch):
+        if slots is None:
+            return await client.embeddings.create(model=get_embedding_deployment(), input=batch)
+        async with slots:
+            return await client.embeddings.create(model=get_embedding_deployment(), input=batch)
+
+    responses = await asyncio.gather(*map(embed, batches))
+    return [item.embedding for response in responses for item in response.data]
+
+
+async def index_attachment(key, file, chunks):
+    try:
+        chunks = chunks[:ATTACHMENT_INDEX_MAX_CHUNKS]
+        embeddings = await embed_texts(chunks, slots=attachment_embedding_slots)
+        await attachment_index.add(key, file.sha256, file.filename, chunks, embeddings)
+    except Exception:
+        logging.exception("Exception while indexing attachment %s", file.filename)
+    finally:
+        indexing_attachments.discard((key, file.sha256))
+
+
+async def search_attachment_index(request_body, extracted):
+    # Look up the chunks of every attachment in the conversation that are
+    # closest to the question. New attachments are indexed in the background;
+    # until then the caller sends the first chunks of this turn's attachments
+    conversation_id = request_body.get("history_metadata", {}).get("conversation_id")
+    if not conversation_id:
+        return None
+    key = f"{request_body.get('user_id')}:{conversation_id}"
+    index = await attachment_index.get(key)
+    pending = False
+    for file, chunks in extracted:
+        if chunks and (index is None or not index.has_file(file.sha256)):
+            pending = True
+            if (key, file.sha256) not in indexing_attachments:
+                indexing_attachments.add((key, file.sha256))
+                run_in_background(index_attachment(key, file, chunks))
+    if index is None or pending:
+        return None
+    try:
+        [question_embedding] = await asyncio.wait_for(
+            embed_texts([get_message_text(request_body["messages"][-1])]),
+            timeout=ATTACHMENT_INDEX_EMBEDDING_TIMEOUT,
+        )
+    except asyncio.TimeoutError:
+        logging.warning("Question embedding timed out, skipping attachment retrieval")
+        return None
+    return index.search(question_embedding, ATTACHMENT_INDEX_TOP_K)
+
+
+async def prepare_attachment_image(file):
+    image = await image_preprocessor.process(file)
+    logging.info(
+        "Image %s: %d -> %d bytes, %d -> %d tokens",
+        file.filename, image["original_bytes"], len(image["data"]),
+        image["original_tokens"], image["tokens"],
+    )
+    data = base64.b64encode(image["data"]).decode("ascii")
+    return {"url": f"data:{image['media_type']};base64,{data}", "tokens": image["tokens"]}
+
+
+async def prepare_attachment_images(files, gptModel):
+    if not get_model_spec(gptModel).vision:
+        for file in files:
+            logging.info("Image %s not sent, the model does not accept images", file.filename)
+        return []
+    images = []
+    for file in files:
+        try:
+            images.append(await prepare_attachment_image(file))
+        except Exception:
+            logging.exception("Exception while preparing image %s", file.filename)
+    return images
+
+
+async def extract_attachment(file):
+    try:
+        return (await attachment_extractor.extract(file))["chunks"]
+    except UnsupportedAttachmentError as e:
+        logging.info("Attachment not extracted: %s", e)
+    except Exception:
+        logging.exception("Exception while extracting attachment %s", file.filename)
+    return []
+
+
+async def add_attachment_context(request_body):
+    # Find the attachment text worth sending with this turn. prepare_model_args
+    # adds it to the question, as many chunks as fit
+    files = request_body.get("files") or []
+    images = [file for file in files if file.content_type.startswith("image/")]
+    documents = [file for file in files if not file.content_type.startswith("image/")]
+    if images:
+        attachment_images = await prepare_attachment_images(images, request_body.get("gptModel"))
+        if attachment_images:
+            request_body = dict(request_body, attachment_images=attachment_images)
+    extracted = list(zip(documents, await asyncio.gather(*map(extract_attachment, documents))))
+
+    context_chunks = None
+    if attachment_index:
+        try:
+            context_chunks = await search_attachment_index(request_body, extracted)
+        except Exception:
+            logging.exception("Exception while searching the attachment index")
+    if context_chunks is None:
+        ## without an index, send the attachments of this turn from the start
+        context_chunks = [
+            {"filename": file.filename, "text": chunk}
+            for file, chunks in extracted for chunk in chunks
+        ]
+    if not context_chunks:
+        return request_body
+    return dict(request_body, attachment_context=context_chunks)
 
 
 async def complete_chat_request(request_body):
-    response = await send_chat_request(request_body)
+    request_body = await add_attachment_context(request_body)
+    model_args = dict(prepare_model_args(request_body), stream=False)
+    response, _, _ = await send_chat_request(request_body, model_args)
     history_metadata = request_body.get("history_metadata", {})
     return format_non_streaming_response(response, history_metadata)
 
 
 async def stream_chat_request(request_body):
+    request_body = await add_attachment_context(request_body)
     logging.debug("RequestBody: %s", request_body.get("messages"))
-    response = await send_chat_request(request_body)
-    file = request_body.get("file", None)
-    if file:
-        print("File found")
-        with open(f'usr/{file.filename}', 'wb') as f:
-            f.write(file.read())
+    model_args = prepare_model_args(request_body)
     history_metadata = request_body.get("history_metadata", {})
     logging.debug("History Metadata: %s", history_metadata)
 
+    cache_key = None
+    if response_cache and not request_body.get("files"):
+        cache_key = response_cache.make_key(model_args)
+        cached_response = response_cache.get(cache_key) if cache_key else None
+        if cached_response:
+            return response_cache.replay(cached_response, history_metadata)
+
+    question_embedding = None
+    request_messages = [
+        message for message in request_body.get("messages", []) if message
+    ]
+    if (
+        semantic_cache
+        and not request_body.get("files")
+        and len(request_messages) == 1
+        and request_messages[0]["role"] == "user"
+    ):
+        question_embedding = await get_question_embedding(
+            request_messages[0]["content"])
+        if question_embedding is not None:
+            cached_response = semantic_cache.get(
+                model_args["model"], question_embedding)
+            if cached_response:
+                return semantic_cache.replay(cached_response, history_metadata)
+
+    response, deployment, first_chunk = await send_chat_request(
+        request_body, model_args)
+    closed = False
+
+    async def close_upstream():
+        nonlocal closed
+        if closed:
+            return
+        closed = True
+        deployment.in_flight -= 1
+        # stop the upstream completion when the stream is closed early
+        await response.close()
+
     async def generate():
-        async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata)
+        try:
+            if first_chunk is not None:
+                yield format_stream_response(first_chunk, history_metadata)
+            async for completionChunk in response:
+                yield format_stream_response(completionChunk, history_metadata)
+        except Exception:
+            deployment.record_error()
+            raise
+        finally:
+            await close_upstream()
+
+    ## the upstream is open already, so it is closed even if generate never starts
+    result = ClosingStream(generate(), close_upstream)
+    if cache_key:
+        result = response_cache.record(cache_key, result)
+    if question_embedding is not None:
+        result = semantic_cache.record(
+            model_args["model"], question_embedding, result)
+    result = drop_finish_frames(result)
+    if STREAM_COALESCE_INTERVAL_MS > 0:
+        result = coalesce_stream_response(
+            result,
+            flush_interval=STREAM_COALESCE_INTERVAL_MS / 1000,
+            flush_bytes=STREAM_COALESCE_MAX_BYTES,
+        )
+    if STREAM_BUFFER_SIZE > 0:
+        # Quart cancels the response when the client disconnects, which
+        # closes the buffer and with it the upstream completion
+        result = buffer_stream_response(result, max_size=STREAM_BUFFER_SIZE)
+    return result
 
-    return generate()
+
+async def wait_for_title(title_task):
+    try:
+        return await asyncio.wait_for(asyncio.shield(title_task), TITLE_GENERATION_WAIT)
+    except Exception:
+        return None
 
 
-async def conversation_internal(request_body):
+@closes_source
+async def stream_with_title(r, title_task, history_metadata):
+    # Send the generated title of a new conversation as a late frame
+    try:
+        async for event in r:
+            yield event
+        title = await wait_for_title(title_task)
+        if title:
+            yield {"history_metadata": dict(history_metadata, title=title)}
+    finally:
+        await r.aclose()
+
+
+async def conversation_internal(request_body, user_id=None, priority=PRIORITY_STANDARD,
+                                title_task=None, history_task=None, cosmos_conversation_client=None,
+                                flight=None):
     logging.debug("RequestBody: %s", request_body)
+    slot = None
+    conversation_id = request_body.get("history_metadata", {}).get("conversation_id")
+    encoding = get_model_spec(request_body.get("gptModel")).encoding
     try:
+        if admission_controller:
+            slot = await admission_controller.acquire(user_id, priority)
         if SHOULD_STREAM:
             result = await stream_chat_request(request_body)
+            if slot:
+                result = slot.hold(result)
+            if history_task:
+                result = stream_after_history(result, history_task)
+                result = record_reply(result, cosmos_conversation_client, user_id,
+                                      conversation_id, encoding, history_task)
+            if title_task:
+                result = stream_with_title(
+                    result, title_task, request_body.get("history_metadata", {}))
+            if replay_store:
+                result = replay_store.start(user_id, result)
+            if flight:
+                result = flight.start(result)
             response = await make_response(format_as_ndjson(result))
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
         else:
-            result = await complete_chat_request(request_body)
+            try:
+                result = await complete_chat_request(request_body)
+            finally:
+                if slot:
+                    slot.release()
+            if history_task:
+                await wait_for_history(history_task)
+                reply = new_reply()
+                collect_reply(result, reply)
+                result = with_reply_id(result, reply)
+                add_reply_to_tail(user_id, conversation_id, reply)
+                await save_reply(cosmos_conversation_client, user_id, conversation_id, reply,
+                                 encoding, history_task)
+            title = await wait_for_title(title_task) if title_task else None
+            if title:
+                ## an empty completion is formatted without metadata
+                metadata = result.get("history_metadata", request_body.get("history_metadata", {}))
+                result["history_metadata"] = dict(metadata, title=title)
+            if flight:
+                flight.publish(result)
+                flight.close()
             return jsonify(result)
 
     except Exception as ex:
+        if slot:
+            slot.release()
+        if flight:
+            flight.close(ex)
         logging.exception(ex)
+        retry_after = get_retry_after(ex)
+        headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after else {}
         if hasattr(ex, "status_code"):
-            return jsonify({"error": str(ex)}), ex.status_code
+            return jsonify({"error": str(ex)}), ex.status_code, headers
         else:
             return jsonify({"error": str(ex)}), 500
 
@@ -448,60 +1446,134 @@ def get_frontend_settings():
         logging.exception("Exception in /frontend_settings")
         return jsonify({"error": "An unexpected error occurred"}), 500
 
+@bp.route("/stats", methods=["GET"])
+async def get_stats():
+    stats = {
+        "response_cache": response_cache.stats() if response_cache else None,
+        "semantic_cache": semantic_cache.stats() if semantic_cache else None,
+        "attachments": attachment_store.stats(),
+        "attachment_extraction": attachment_extractor.stats(),
+        "attachment_index": attachment_index.stats() if attachment_index else None,
+        "images": image_preprocessor.stats(),
+        "single_flight": single_flight.stats() if single_flight else None,
+        "resumable_streams": replay_store.stats() if replay_store else None,
+        "conversation_tails": conversation_tails.stats(),
+        "conversation_summaries": (
+            conversation_summaries.stats() if conversation_summaries else None
+        ),
+        "llm_deployments": llm_router.stats(),
+        "admission": admission_controller.stats() if admission_controller else None,
+    }
+    return jsonify(stats), 200
+
+async def read_chat_form():
+    # Multipart bodies are parsed as they arrive and uploads spooled to disk,
+    # instead of being buffered by request.form/request.files
+    if request.mimetype != "multipart/form-data":
+        return await request.form, {}
+    boundary = request.mimetype_params.get("boundary", "").encode("latin-1")
+    return await asyncio.wait_for(
+        upload_spooler.parse(request.body, boundary), timeout=request.body_timeout)
+
+
 @bp.route("/conversation", methods=["POST"])
 async def conversation():
-    if 'file' not in await request.files:
-        return jsonify({"error": "No file part"}), 400
-
-    file = await request.files['file']
-    if file.filename == '':
-        return jsonify({"error": "No selected file"}), 400
+    try:
+        form_data, files = await read_chat_form()
+    except UploadRejected as e:
+        return jsonify({"error": str(e)}), e.status_code
 
-    # ファイルを保存する処理をここに追加
-    file.save(os.path.join('/path/to/save', file.filename))
+    # empty file inputs are dropped while parsing
+    files = files.getlist("file")
+    if not files:
+        return jsonify({"error": "No file part"}), 400
 
     # その他のデータを処理
-    request_json = await request.form['messages']
-    messages = json.loads(request_json)
-    gptModel = await request.form['gptModel']
+    messages = json.loads(form_data['messages'])
+    gptModel = form_data['gptModel']
 
     # チャットリクエストを処理
-    result = await stream_chat_request({
-        "messages": messages,
-        "gptModel": gptModel,
-        "file": file
-    })
+    # attachment requests count against the same concurrency limits as chat turns
+    slot = None
+    try:
+        if admission_controller:
+            user_details = get_authenticated_user_details(request_headers=request.headers)
+            user_id = user_details.get("uid", user_details.get("user_principal_id"))
+            slot = await admission_controller.acquire(user_id, PRIORITY_STANDARD)
+        result = await stream_chat_request({
+            "messages": messages,
+            "gptModel": gptModel,
+            "files": files
+        })
+    except Exception as ex:
+        if slot:
+            slot.release()
+        logging.exception("Exception in /conversation")
+        retry_after = get_retry_after(ex)
+        headers = {"Retry-After": str(math.ceil(retry_after))} if retry_after else {}
+        return jsonify({"error": str(ex)}), getattr(ex, "status_code", 500), headers
+    if slot:
+        result = slot.hold(result)
+
+    response = await make_response(format_as_ndjson(result))
+    response.timeout = None
+    response.mimetype = "application/json-lines"
+    return response
+
+@bp.route("/conversation/resume", methods=["POST"])
+async def resume_conversation():
+    # Continue a /history/generate stream from the number of frames
+    # the client already has
+    user_details = get_authenticated_user_details(request_headers=request.headers)
+    user_id = user_details.get("uid", user_details.get("user_principal_id"))
+    request_json = await request.get_json()
+    message_id = request_json.get("message_id")
+    offset = request_json.get("offset", 0)
+    if not message_id or not isinstance(offset, int) or offset < 0:
+        return jsonify({"error": "message_id and a non-negative offset are required"}), 400
+    if not replay_store:
+        return jsonify({"error": "Resumable streams are not enabled"}), 404
+
+    try:
+        result = replay_store.resume(user_id, message_id, offset)
+    except ReplayExpired as e:
+        return jsonify({"error": str(e)}), e.status_code
+    if result is None:
+        ## or it runs in another worker, see RESUMABLE_STREAMS_ENABLED
+        return jsonify({"error": f"Stream {message_id} was not found or has expired"}), 404
 
     response = await make_response(format_as_ndjson(result))
     response.timeout = None
     response.mimetype = "application/json-lines"
     return response
 
+
 ## Conversation History API ##
 
 @bp.route("/history/generate", methods=["POST"])
 async def add_conversation():
     
-    user_id = get_userid(request_headers=request.headers)
+    # the verified token carries the custom claims used for scheduling
+    user_details = get_authenticated_user_details(request_headers=request.headers)
+    user_id = user_details.get("uid", user_details.get("user_principal_id"))
+    priority = priority_from_claims(user_details, ADMISSION_PRIORITY_CLAIMS)
     # check request for conversation_id
     try:
-        form_data = await request.form
+        form_data, files = await read_chat_form()
         logging.info("form_data: %s", form_data)
         logging.info("messages: %s", form_data.get('messages'))
         logging.info("gptModel: %s", form_data.get('gptModel'))
-        try:
-            files = await request.files
-            file = files.get('file')
-            logging.info("file: %s", file)
-            logging.info("files: %s", files)
-        except Exception as e:
-            logging.exception("Exception in /history/generate")
-            return jsonify({"error": str(e)}), 500
+        files = files.getlist("file")
+        logging.info("files: %s", [file.filename for file in files])
+    except UploadRejected as e:
+        logging.warning("Upload rejected in /history/generate: %s", e)
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
         logging.exception("Exception in /history/generate")
         return jsonify({"error": str(e)}), 500
 
     conversation_id = form_data.get("conversation_id", None)
+    flight = None
     try:
         # make sure cosmos is configured
         cosmos_conversation_client = init_conversation_cosmosdb_client()
@@ -510,55 +1582,232 @@ async def add_conversation():
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
-        messages = json.loads(form_data.get("messages"))
         gptModel = form_data.get("gptModel")
-        file = form_data.get("file")
+        # delta mode: only the new message, the history comes from the conversation tail
+        delta = conversation_id and form_data.get("message")
+        if delta:
+            messages = [json.loads(form_data.get("message"))]
+        else:
+            messages = json.loads(form_data.get("messages"))
+
+        if len(messages) == 0 or messages[-1]["role"] != "user":
+            raise Exception("No user message found")
 
+        if single_flight:
+            ## the history position tells a retry from the same words asked again
+            position = form_data.get("version") if delta else len(messages)
+            flight_key = single_flight_key(
+                user_id, conversation_id, gptModel, position, messages[-1], files)
+            joined = single_flight.join(flight_key)
+            if joined:
+                return await join_flight(joined)
+            ## nothing is awaited between join and begin, so only one request starts it
+            flight = single_flight.begin(flight_key)
+
+        if delta:
+            version = form_data.get("version")
+            tail = await load_conversation_tail(
+                cosmos_conversation_client, user_id, conversation_id,
+                int(version) if version else None)
+            messages = tail["messages"] + messages
+
+        new_conversation = None
         if not conversation_id:
-            title = await generate_title(messages)
-            conversation_dict = await cosmos_conversation_client.create_conversation(
-                user_id=user_id, title=title
-            )
-            conversation_id = conversation_dict["id"]
+            # start with a provisional title and generate the real one alongside the answer
+            title = provisional_title(messages)
+            conversation_id = str(uuid.uuid4())
+            new_conversation = {
+                "user_id": user_id,
+                "title": title,
+                "conversation_id": conversation_id,
+                "created_at": datetime.utcnow().isoformat(),
+            }
             history_metadata["title"] = title
-            history_metadata["date"] = conversation_dict["createdAt"]
-
-        if file:
-            file.save(os.path.join('/path/to/save', file.filename))
+            history_metadata["date"] = new_conversation["created_at"]
+
+        # the tail is updated right away, so the next turn sees this message
+        # even before it is saved
+        if new_conversation:
+            conversation_tails.start(user_id, conversation_id)
+        elif not delta:
+            ## the client sent the full history, a cached tail may predate a clear
+            conversation_tails.discard(user_id, conversation_id)
+        tail = conversation_tails.append(user_id, conversation_id, messages[-1])
+        history_metadata["version"] = (
+            tail["version"] if tail
+            else sum(1 for message in messages if message["role"] == "user")
+        )
 
-        token = form_data.get("token", 0)
-        if len(messages) > 0 and messages[-1]["role"] == "user":
-            createdMessageValue = await cosmos_conversation_client.create_message(
-                uuid=str(uuid.uuid4()),
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1],
-                token=token
+        summary = None
+        generation = 0
+        if conversation_summaries and not new_conversation:
+            generation = (
+                tail["generation"] if tail
+                else await cosmos_conversation_client.get_history_generation(user_id, conversation_id)
             )
-            if createdMessageValue == "Conversation not found":
-                raise Exception(
-                    "Conversation not found for the given conversation ID: "
-                    + conversation_id
-                    + "."
-                )
-        else:
-            raise Exception("No user message found")
+            if generation is not None:
+                summary = await get_conversation_summary(
+                    cosmos_conversation_client, user_id, conversation_id, generation)
+            ## a summary of more turns than there are belongs to a cleared history
+            if summary and summary["summarizedTurns"] >= history_metadata["version"]:
+                summary = None
+            if summary:
+                messages = apply_summary(messages, history_metadata["version"], summary)
+
+        # save the user message while the completion request is in flight
+        token = form_data.get("token", 0)
+        history_task = run_in_background(save_user_message(
+            cosmos_conversation_client, user_id, conversation_id, messages[-1], token,
+            new_conversation, files))
+        if conversation_summaries and generation is not None:
+            maybe_update_summary(
+                cosmos_conversation_client, user_id, conversation_id, messages, summary,
+                history_metadata["version"], get_model_spec(gptModel).encoding, history_task,
+                generation)
+        title_task = None
+        if new_conversation:
+            title_task = run_in_background(update_conversation_title(
+                cosmos_conversation_client, user_id, conversation_id, messages,
+                new_conversation["title"], history_task))
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         history_metadata["conversation_id"] = conversation_id
         request_body = {
+            "user_id": user_id,
             "messages": messages,
             "gptModel": gptModel,
-            "file": file,
+            "files": files,
+            "summary": summary and summary["content"],
             "history_metadata": history_metadata
         }
-        return await conversation_internal(request_body)
-
+        return await conversation_internal(
+            request_body, user_id=user_id, priority=priority, title_task=title_task,
+            history_task=history_task, cosmos_conversation_client=cosmos_conversation_client,
+            flight=flight)
+
+    except StaleHistoryError as e:
+        logging.info("Stale history in /history/generate: %s", e)
+        if flight:
+            flight.close(e)
+        return jsonify({"error": str(e), "version": e.version}), e.status_code
     except Exception as e:
         logging.exception("Exception in /history/generate")
+        if flight:
+            flight.close(e)
         return jsonify({"error": str(e)}), 500
 
 
+async def get_conversation_summary(cosmos_conversation_client, user_id, conversation_id,
+                                   generation):
+    # Cached summary, read again when the conversation's history generation
+    # has moved on since it was cached
+    key = (user_id, conversation_id)
+    found, summary = conversation_summaries.get(key, generation)
+    if not found:
+        summary = await cosmos_conversation_client.get_summary(user_id, conversation_id)
+        ## written by a summary job that ran across a clear
+        if summary and summary.get("historyGeneration", 0) != generation:
+            summary = None
+        conversation_summaries.put(key, summary, generation)
+    return summary
+
+
+def maybe_update_summary(cosmos_conversation_client, user_id, conversation_id, messages, summary,
+                         total_turns, encoding, history_task, generation):
+    # Start a summary update when the turns sent in full have grown too long
+    key = (user_id, conversation_id)
+    summarized_turns = summary["summarizedTurns"] if summary else 0
+    if key in conversation_summaries.running or total_turns - summarized_turns <= SUMMARY_KEEP_TURNS:
+        return
+    tokens = sum(token_counter.count_message(message, encoding) for message in messages)
+    if tokens <= SUMMARY_TRIGGER_TOKENS:
+        return
+    conversation_summaries.running.add(key)
+    run_in_background(update_conversation_summary(
+        cosmos_conversation_client, user_id, conversation_id, summary, total_turns, history_task,
+        generation))
+
+
+async def update_conversation_summary(cosmos_conversation_client, user_id, conversation_id, summary,
+                                      total_turns, history_task, generation):
+    # Fold the turns after the current summary, except the most recent ones,
+    # into it. Only the new turns are sent with the previous summary.
+    key = (user_id, conversation_id)
+    slot = None
+    try:
+        await history_task
+        history = await cosmos_conversation_client.get_messages(user_id, conversation_id)
+        history.sort(key=lambda message: message.get("createdAt", ""))
+        summarized_turns = summary["summarizedTurns"] if summary else 0
+        through_turn = total_turns - SUMMARY_KEEP_TURNS
+        turns = select_turns(history, summarized_turns, through_turn)
+        if not turns:
+            return
+        if admission_controller:
+            slot = await admission_controller.acquire(user_id, PRIORITY_BACKGROUND)
+        response, _, _ = await send_chat_request(
+            {"gptModel": SUMMARY_MODEL},
+            model_args={
+                "messages": summary_request(summary, turns),
+                "temperature": 0,
+                "max_tokens": SUMMARY_MAX_TOKENS,
+            },
+        )
+        summary = await cosmos_conversation_client.upsert_summary(
+            user_id, conversation_id, response.choices[0].message.content, through_turn, generation)
+        conversation_summaries.put(key, summary, generation)
+        conversation_summaries.updates += 1
+        logging.info("Summarized turns %d to %d of conversation %s",
+                     summarized_turns + 1, through_turn, conversation_id)
+    finally:
+        if slot:
+            slot.release()
+        conversation_summaries.running.discard(key)
+
+
+async def load_conversation_tail(cosmos_conversation_client, user_id, conversation_id, version):
+    # Cached tail of the conversation, reloaded from history when this worker
+    # has not seen it, is behind the client, or another worker has cleared or
+    # rewritten the conversation since it was read
+    generation = await cosmos_conversation_client.get_history_generation(user_id, conversation_id)
+    if generation is None:
+        conversation_tails.discard(user_id, conversation_id)
+        raise Exception("Conversation not found for the given conversation ID: " + conversation_id + ".")
+    tail = conversation_tails.get(user_id, conversation_id, generation)
+    if tail is None or (version is not None and tail["version"] < version):
+        tail = conversation_tails.load(
+            user_id, conversation_id,
+            await cosmos_conversation_client.get_messages(user_id, conversation_id), generation)
+    if version is not None and tail["version"] != version:
+        raise StaleHistoryError(tail["version"])
+    return tail
+
+
+def single_flight_key(user_id, conversation_id, gptModel, position, message, files):
+    idempotency_key = request.headers.get("Idempotency-Key")
+    if idempotency_key:
+        return (user_id, "idempotency", idempotency_key)
+    digest = hashlib.sha256(json.dumps(message, sort_keys=True).encode())
+    for file in files or []:
+        digest.update(file.sha256.encode())
+    return (user_id, conversation_id or "", gptModel, position, digest.hexdigest())
+
+
+async def join_flight(flight):
+    # Answer a duplicate request from the completion already running for it
+    await flight.ready()
+    if flight.done and not flight.frames:
+        ex = flight.error
+        if hasattr(ex, "status_code"):
+            return jsonify({"error": str(ex)}), ex.status_code
+        return jsonify({"error": str(ex)}), 500
+    if not SHOULD_STREAM:
+        return jsonify(await flight.result())
+    response = await make_response(format_as_ndjson(flight.subscribe()))
+    response.timeout = None
+    response.mimetype = "application/json-lines"
+    return response
+
+
 @bp.route("/history/update", methods=["POST"])
 async def update_conversation():
     
@@ -583,11 +1832,15 @@ async def update_conversation():
         messages = request_json["messages"]
         logging.debug("Received request_json: %s", request_json)
         token = request_json.get("token", 0)
+        # /history/generate saves replies itself; this stays for older clients and
+        # uses the same ids so a reply saved twice is overwritten, not duplicated
+        await cosmos_conversation_client.bump_history_generation(user_id, conversation_id)
+        conversation_tails.discard(user_id, conversation_id)
         if len(messages) > 0 and messages[-1]["role"] == "assistant":
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
                 await cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
+                    uuid=f"{messages[-1]['id']}-tool",
                     conversation_id=conversation_id,
                     user_id=user_id,
                     input_message=messages[-2],
@@ -605,7 +1858,6 @@ async def update_conversation():
             raise Exception("No bot messages found")
 
         # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
         response = {"success": True}
         return jsonify(response), 200
 
@@ -688,8 +1940,11 @@ async def delete_conversation():
         deleted_conversation = await cosmos_conversation_client.delete_conversation(
             user_id, conversation_id
         )
-
-        await cosmos_conversation_client.cosmosdb_client.close()
+        conversation_tails.discard(user_id, conversation_id)
+        if conversation_summaries:
+            conversation_summaries.discard((user_id, conversation_id))
+        if attachment_index:
+            await attachment_index.discard(f"{user_id}:{conversation_id}")
 
         return (
             jsonify(
@@ -721,7 +1976,6 @@ async def list_conversations():
     conversations = await cosmos_conversation_client.get_conversations(
         user_id, offset=offset, limit=25
     )
-    await cosmos_conversation_client.cosmosdb_client.close()
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
@@ -766,6 +2020,9 @@ async def get_conversation():
         user_id, conversation_id
     )
 
+    tail = conversation_tails.load(
+        user_id, conversation_id, conversation_messages, conversation.get("historyGeneration", 0))
+
     # format the messages in the bot frontend format
     messages = [
         {
@@ -778,8 +2035,11 @@ async def get_conversation():
         for msg in conversation_messages
     ]
 
-    await cosmos_conversation_client.cosmosdb_client.close()
-    return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
+    return jsonify({
+        "conversation_id": conversation_id,
+        "messages": messages,
+        "version": tail["version"],
+    }), 200
 
 
 @bp.route("/history/rename", methods=["POST"])
@@ -822,7 +2082,6 @@ async def rename_conversation():
         conversation
     )
 
-    await cosmos_conversation_client.cosmosdb_client.close()
     return jsonify(updated_conversation), 200
 
 
@@ -856,7 +2115,11 @@ async def delete_all_conversations():
             deleted_conversation = await cosmos_conversation_client.delete_conversation(
                 user_id, conversation["id"]
             )
-        await cosmos_conversation_client.cosmosdb_client.close()
+            conversation_tails.discard(user_id, conversation["id"])
+            if conversation_summaries:
+                conversation_summaries.discard((user_id, conversation["id"]))
+            if attachment_index:
+                await attachment_index.discard(f"{user_id}:{conversation['id']}")
         return (
             jsonify(
                 {
@@ -893,6 +2156,13 @@ async def clear_messages():
         deleted_messages = await cosmos_conversation_client.delete_messages(
             conversation_id, user_id
         )
+        # other workers reload their cached tail on the next turn
+        await cosmos_conversation_client.bump_history_generation(user_id, conversation_id)
+        conversation_tails.discard(user_id, conversation_id)
+        if conversation_summaries:
+            conversation_summaries.discard((user_id, conversation_id))
+        if attachment_index:
+            await attachment_index.discard(f"{user_id}:{conversation_id}")
 
         return (
             jsonify(
@@ -919,7 +2189,6 @@ async def ensure_cosmos():
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDBが構成されていないか、動作していません"}), 500
 
-        await cosmos_conversation_client.cosmosdb_client.close()
         return jsonify({"message": "CosmosDBは構成されており、動作しています"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -957,7 +2226,6 @@ async def get_prompts():
 
         # CosmosDBからプロンプトを取得
         prompts = await cosmos_prompt_client.get_prompts()
-        await cosmos_prompt_client.cosmosdb_client.close()
 
         return jsonify(prompts), 200
     except Exception as e:
@@ -982,8 +2250,6 @@ async def add_prompt():
 
             await cosmos_prompt_client.create_prompt(user_name, prompt, tags)
 
-            await cosmos_prompt_client.cosmosdb_client.close()
-
             return jsonify({"message": "プロンプトが正常に追加されました"}), 200
         except Exception as e:
             logging.exception("プロンプトの追加中にエラーが発生しました")
@@ -1082,7 +2348,155 @@ async def users():
 
 
 ##タイトル生成用関数##
-async def generate_title(conversation_messages):
+def provisional_title(messages):
+    content = messages[-1]["content"] if messages else ""
+    return content if isinstance(content, str) else "New chat"
+
+
+async def save_user_message(cosmos_conversation_client, user_id, conversation_id, message, token,
+                            new_conversation=None, files=None):
+    started = time.monotonic()
+    try:
+        attachments = [await attachment_store.put(file) for file in files] if files else None
+        if new_conversation:
+            await cosmos_conversation_client.create_conversation(**new_conversation)
+        createdMessageValue = await cosmos_conversation_client.create_message(
+            uuid=str(uuid.uuid4()),
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message=message,
+            token=token,
+            attachments=attachments
+        )
+        if createdMessageValue == "Conversation not found":
+            raise Exception(
+                "Conversation not found for the given conversation ID: "
+                + conversation_id
+                + "."
+            )
+    except Exception:
+        ## the cached tail already has the message, reload it from history next time
+        conversation_tails.discard(user_id, conversation_id)
+        raise
+    return time.monotonic() - started
+
+
+async def wait_for_history(history_task):
+    started = time.monotonic()
+    duration = await history_task
+    blocked = time.monotonic() - started
+    logging.info(
+        "Saved user message in %.0f ms, %.0f ms of it overlapped with the completion request",
+        duration * 1000, max(duration - blocked, 0) * 1000,
+    )
+
+
+@closes_source
+async def stream_after_history(r, history_task):
+    # Hold back the answer until the user message is saved, so a failed write
+    # is reported in the stream before any of the answer
+    try:
+        await wait_for_history(history_task)
+        async for event in r:
+            yield event
+    finally:
+        await r.aclose()
+
+
+def new_reply():
+    # Replies are saved under an id of their own. The completion id is not
+    # unique: the response caches replay it in every conversation they answer
+    return {"id": str(uuid.uuid4()), "content": [], "tool": None}
+
+
+def with_reply_id(event, reply):
+    # the client keys the message by this id, as /history/update and resume do
+    if "id" not in event:
+        return event
+    return dict(event, id=reply["id"])
+
+
+def collect_reply(event, reply):
+    choices = event.get("choices")
+    if not choices:
+        return
+    for message in choices[0].get("messages", []):
+        if message.get("role") == "tool":
+            reply["tool"] = message
+        elif message.get("context"):
+            reply["tool"] = {"role": "tool", "content": message["context"]}
+        elif message.get("content"):
+            reply["content"].append(message["content"])
+
+
+async def save_reply(cosmos_conversation_client, user_id, conversation_id, reply, encoding,
+                     history_task):
+    content = "".join(reply["content"])
+    if not content and not reply["tool"]:
+        return
+    await history_task
+    reply_id = reply["id"]
+    if reply["tool"]:
+        tool_message = dict(reply["tool"])
+        if not isinstance(tool_message["content"], str):
+            tool_message["content"] = json.dumps(tool_message["content"])
+        await cosmos_conversation_client.create_message(
+            uuid=f"{reply_id}-tool",
+            conversation_id=conversation_id,
+            user_id=user_id,
+            input_message=tool_message,
+        )
+    await cosmos_conversation_client.create_message(
+        uuid=reply_id,
+        conversation_id=conversation_id,
+        user_id=user_id,
+        input_message={"role": "assistant", "content": content},
+        token=token_counter.count_text(content, encoding),
+    )
+
+
+@closes_source
+async def record_reply(r, cosmos_conversation_client, user_id, conversation_id, encoding,
+                       history_task):
+    # Tee the stream and save whatever was answered once it completes, fails
+    # or is cancelled because the client went away
+    reply = new_reply()
+    try:
+        async for event in r:
+            collect_reply(event, reply)
+            yield with_reply_id(event, reply)
+    finally:
+        add_reply_to_tail(user_id, conversation_id, reply)
+        run_in_background(save_reply(
+            cosmos_conversation_client, user_id, conversation_id, reply, encoding, history_task))
+        await r.aclose()
+
+
+def add_reply_to_tail(user_id, conversation_id, reply):
+    # the same messages save_reply writes, so the tail matches the history
+    content = "".join(reply["content"])
+    if not content and not reply["tool"]:
+        return
+    if reply["tool"]:
+        tool_message = dict(reply["tool"])
+        if not isinstance(tool_message["content"], str):
+            tool_message["content"] = json.dumps(tool_message["content"])
+        conversation_tails.append(user_id, conversation_id, tool_message)
+    conversation_tails.append(user_id, conversation_id, {"role": "assistant", "content": content})
+
+
+async def update_conversation_title(cosmos_conversation_client, user_id, conversation_id, messages,
+                                    provisional, history_task):
+    title = await generate_title(messages, user_id=user_id)
+    if title == provisional:
+        return None
+    # the conversation has to exist before its title can be patched
+    await history_task
+    await cosmos_conversation_client.update_conversation_title(user_id, conversation_id, title)
+    return title
+
+
+async def generate_title(conversation_messages, user_id=None):
     # make sure the messages are sorted by _ts descending
     title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
 
@@ -1092,16 +2506,23 @@ async def generate_title(conversation_messages):
     ]
     messages.append({"role": "user", "content": title_prompt})
 
+    slot = None
     try:
-        azure_openai_client = init_openai_client(use_data=False)
-        response = await azure_openai_client.chat.completions.create(
-            model=AZURE_OPENAI_GPT35_TURBO_16K_MODEL, messages=messages, temperature=1, max_tokens=64
+        # titles are nice to have, so they wait behind interactive turns and are shed first
+        if admission_controller:
+            slot = await admission_controller.acquire(user_id, PRIORITY_BACKGROUND)
+        response, _, _ = await send_chat_request(
+            {"gptModel": "az-gpt-3.5"},
+            model_args={"messages": messages, "temperature": 1, "max_tokens": 64},
         )
 
         title = json.loads(response.choices[0].message.content)["title"]
         return title
     except Exception as e:
         return messages[-2]["content"]
+    finally:
+        if slot:
+            slot.release()
 
 
 app = create_app()
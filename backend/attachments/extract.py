@@ -0,0 +1,115 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from cachetools import LRUCache
+
+# formats that need Document Intelligence to crack
+CRACKED_FORMATS = ["pdf", "docx", "pptx"]
+
+
+class UnsupportedAttachmentError(Exception):
+    pass
+
+
+def extract_text(path, filename, num_tokens=256, token_overlap=0):
+    # Runs in a worker process. data_utils pulls in the ingestion dependencies
+    # (langchain, bs4, markdown, Document Intelligence), so it is imported here
+    # and never on the web worker itself.
+    from scripts import data_utils
+
+    file_format = data_utils._get_file_format(filename, data_utils.FILE_FORMAT_DICT.keys())
+    if file_format is None:
+        raise UnsupportedAttachmentError(f"{filename} is not supported")
+    if file_format in CRACKED_FORMATS:
+        ## the per-process client is a placeholder object when no endpoint or key is configured
+        form_recognizer_client = data_utils.SingletonFormRecognizerClient()
+        if not isinstance(form_recognizer_client, data_utils.DocumentAnalysisClient):
+            raise UnsupportedAttachmentError(
+                f"{filename} needs FORM_RECOGNIZER_ENDPOINT and FORM_RECOGNIZER_KEY")
+        content = data_utils.extract_pdf_content(path, form_recognizer_client)
+    else:
+        with open(path, "rb") as f:
+            content = f.read().decode("utf-8", "replace")
+
+    result = data_utils.chunk_content(
+        content=content,
+        file_name=filename,
+        ignore_errors=False,
+        num_tokens=num_tokens,
+        token_overlap=token_overlap,
+        cracked_pdf=file_format in CRACKED_FORMATS,
+    )
+    return {"chunks": [chunk.content for chunk in result.chunks]}
+
+
+class AttachmentExtractor():
+    # Extracts the chunks of attachments in an executor, caching them by
+    # content hash so a file sent again is not parsed again. Concurrent
+    # requests for the same file share one extraction.
+
+    def __init__(self, executor=None, max_workers: int = 2, max_size: int = 64 * 1024 * 1024,
+                 num_tokens: int = 256, token_overlap: int = 0, parse=extract_text):
+        self.executor = executor
+        self.max_workers = max_workers
+        # max_size is measured in characters of cached chunks
+        self.cache = LRUCache(
+            maxsize=max_size, getsizeof=lambda result: sum(map(len, result["chunks"])) or 1)
+        self.pending = {}
+        self.num_tokens = num_tokens
+        self.token_overlap = token_overlap
+        self.parse = parse
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def get_executor(self):
+        if self.executor is None:
+            ## spawn, because forking a process that runs an event loop and threads is unsafe
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self.executor
+
+    async def extract(self, upload):
+        cached = self.cache.get(upload.sha256)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        if upload.sha256 in self.pending:
+            self.hits += 1
+            return await asyncio.shield(self.pending[upload.sha256])
+
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.get_executor(), self.parse, upload.path, upload.filename, self.num_tokens,
+            self.token_overlap)
+        self.pending[upload.sha256] = future
+        ## cache from a callback, so the result is kept even if this request goes away first
+        future.add_done_callback(lambda future: self._finish(upload.sha256, future))
+        return await asyncio.shield(future)
+
+    def _finish(self, sha256, future):
+        del self.pending[sha256]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.errors += 1
+        else:
+            try:
+                self.cache[sha256] = future.result()
+            except ValueError:
+                ## larger than the whole cache
+                pass
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        return {
+            "entries": len(self.cache),
+            "size": self.cache.currsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
@@ -0,0 +1,144 @@
+import asyncio
+import io
+import math
+from cachetools import LRUCache
+
+# how the vision models see an image at detail "high": scaled to fit in
+# 2048x2048, then so the short side is at most 768, and billed per 512px tile
+MAX_SIDE = 2048
+MAX_SHORT_SIDE = 768
+TILE_SIZE = 512
+BASE_TOKENS = 85
+TOKENS_PER_TILE = 170
+# detail "low" is one 512px image at the base cost
+LOW_DETAIL_SIDE = 512
+
+MEDIA_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def fit_image(width, height, detail="high", max_tiles=None):
+    # Largest size the model actually uses, never larger than the image.
+    # max_tiles caps the tile grid at detail "high" for a lower token cost
+    if detail == "low":
+        scale = min(1, LOW_DETAIL_SIDE / max(width, height))
+    else:
+        scale = min(1, MAX_SIDE / max(width, height), MAX_SHORT_SIDE / min(width, height))
+        if max_tiles and tile_count(width * scale, height * scale) > max_tiles:
+            ## the best grid of at most max_tiles tiles, columns x rows
+            scale = max(
+                min(columns * TILE_SIZE / width, (max_tiles // columns) * TILE_SIZE / height)
+                for columns in range(1, max_tiles + 1)
+            )
+    return max(1, math.floor(width * scale)), max(1, math.floor(height * scale))
+
+
+def tile_count(width, height):
+    return math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+
+
+def estimate_image_tokens(width, height, detail="high"):
+    if detail == "low":
+        return BASE_TOKENS
+    return BASE_TOKENS + TOKENS_PER_TILE * tile_count(*fit_image(width, height))
+
+
+def prepare_image(path, detail="high", max_tiles=None, output_format="JPEG", quality=85):
+    # Runs in an executor. Pillow is only needed once images are attached.
+    from PIL import Image, ImageOps
+
+    with open(path, "rb") as f:
+        original = f.read()
+    with Image.open(io.BytesIO(original)) as image:
+        ## phone photos are often stored sideways with an EXIF rotation
+        image = ImageOps.exif_transpose(image)
+        original_size = image.size
+        size = fit_image(*image.size, detail=detail, max_tiles=max_tiles)
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            ## JPEG has no alpha, so flatten transparent images onto white
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+            image = background
+        output = io.BytesIO()
+        image.save(output, format=output_format, quality=quality, optimize=True)
+
+    data = output.getvalue()
+    media_type = MEDIA_TYPES[output_format]
+    if size == original_size and len(original) <= len(data):
+        ## already small enough, re-encoding would only lose quality
+        with Image.open(io.BytesIO(original)) as image:
+            media_type = Image.MIME.get(image.format, media_type)
+        data = original
+    return {
+        "data": data,
+        "media_type": media_type,
+        "width": size[0],
+        "height": size[1],
+        "original_bytes": len(original),
+        "original_tokens": estimate_image_tokens(*original_size),
+        "tokens": estimate_image_tokens(*size, detail=detail),
+    }
+
+
+class ImagePreprocessor():
+    # Downscales image attachments to what the vision model uses and
+    # re-encodes them, caching the result by content hash. Concurrent
+    # requests for the same image share one conversion.
+
+    def __init__(self, executor=None, max_entries: int = 64, detail: str = "high",
+                 max_tiles: int = None, output_format: str = "JPEG", quality: int = 85,
+                 prepare=prepare_image):
+        self.executor = executor
+        self.cache = LRUCache(maxsize=max_entries)
+        self.pending = {}
+        self.detail = detail
+        self.max_tiles = max_tiles
+        self.output_format = output_format
+        self.quality = quality
+        self.prepare = prepare
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.bytes_saved = 0
+        self.tokens_saved = 0
+
+    async def process(self, upload):
+        result = self.cache.get(upload.sha256)
+        if result is not None:
+            self.hits += 1
+        elif upload.sha256 in self.pending:
+            self.hits += 1
+            result = await asyncio.shield(self.pending[upload.sha256])
+        else:
+            self.misses += 1
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self.executor, self.prepare, upload.path, self.detail, self.max_tiles,
+                self.output_format, self.quality)
+            self.pending[upload.sha256] = future
+            future.add_done_callback(lambda future: self._finish(upload.sha256, future))
+            result = await asyncio.shield(future)
+        ## savings are counted per request, cached or not
+        self.bytes_saved += result["original_bytes"] - len(result["data"])
+        self.tokens_saved += result["original_tokens"] - result["tokens"]
+        return result
+
+    def _finish(self, sha256, future):
+        del self.pending[sha256]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.errors += 1
+        else:
+            self.cache[sha256] = future.result()
+
+    def stats(self):
+        return {
+            "entries": len(self.cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "bytes_saved": self.bytes_saved,
+            "tokens_saved": self.tokens_saved,
+        }
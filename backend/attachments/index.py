@@ -0,0 +1,149 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+
+
+class ConversationIndex():
+    # Attachment chunks of one conversation with their embeddings as unit
+    # vectors, so a search is one matrix-vector product
+
+    def __init__(self, vectors=None, chunks=None):
+        self.vectors = vectors
+        self.chunks = chunks or []
+
+    def has_file(self, sha256):
+        return any(chunk["sha256"] == sha256 for chunk in self.chunks)
+
+    def add(self, sha256, filename, texts, embeddings):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        self.vectors = vectors if self.vectors is None else np.vstack([self.vectors, vectors])
+        self.chunks.extend({"sha256": sha256, "filename": filename, "text": text} for text in texts)
+
+    def search(self, embedding, k):
+        if self.vectors is None or not len(self.chunks):
+            return []
+        vector = np.asarray(embedding, dtype=np.float32)
+        scores = self.vectors @ (vector / (np.linalg.norm(vector) or 1))
+        top = np.argsort(-scores)[:k]
+        ## keep document order so neighbouring chunks read naturally
+        return [self.chunks[index] for index in sorted(top)]
+
+    def nbytes(self):
+        text_bytes = sum(len(chunk["text"]) for chunk in self.chunks)
+        return (self.vectors.nbytes if self.vectors is not None else 0) + text_bytes
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.tmp.npz"
+        np.savez(temp_path, vectors=self.vectors, chunks=np.array(json.dumps(self.chunks)))
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return cls(data["vectors"], json.loads(str(data["chunks"])))
+        except FileNotFoundError:
+            return None
+
+
+def modified_at(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class AttachmentIndex():
+    # Per-conversation indexes kept in memory, least recently used first out
+    # once there are more than max_conversations or they take more than
+    # max_bytes. With persist_dir set, indexes are also written to disk so
+    # they survive a worker restart and come back after eviction, and the
+    # file is what other workers check their copy against.
+
+    def __init__(self, max_conversations: int = 1000, max_bytes: int = 256 * 1024 * 1024,
+                 persist_dir=None):
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir
+        self.indexes = OrderedDict()
+        ## modification time of the file each index in memory was loaded from or saved to
+        self.versions = {}
+        self.total_bytes = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        ## conversation ids come from clients, so they never become file names directly
+        return os.path.join(self.persist_dir, hashlib.sha256(key.encode()).hexdigest() + ".npz")
+
+    async def get(self, key):
+        index = self.indexes.get(key)
+        if not self.persist_dir:
+            if index is not None:
+                self.indexes.move_to_end(key)
+            return index
+        version = await asyncio.to_thread(modified_at, self._path(key))
+        if index is not None and version == self.versions.get(key):
+            self.indexes.move_to_end(key)
+            return index
+        ## deleted or rewritten by another worker since this copy was made
+        self._remove(key)
+        if version is None:
+            return None
+        index = await asyncio.to_thread(ConversationIndex.load, self._path(key))
+        if index is not None:
+            self.loads += 1
+            self._put(key, index)
+            self.versions[key] = version
+        return index
+
+    async def add(self, key, sha256, filename, texts, embeddings):
+        index = await self.get(key)
+        if index is None:
+            index = ConversationIndex()
+        else:
+            self._remove(key)
+        index.add(sha256, filename, texts, embeddings)
+        self._put(key, index)
+        if self.persist_dir:
+            await asyncio.to_thread(index.save, self._path(key))
+            self.versions[key] = await asyncio.to_thread(modified_at, self._path(key))
+        return index
+
+    async def discard(self, key):
+        self._remove(key)
+        if self.persist_dir:
+            try:
+                await asyncio.to_thread(os.remove, self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _put(self, key, index):
+        self.indexes[key] = index
+        self.total_bytes += index.nbytes()
+        while len(self.indexes) > 1 and (
+            len(self.indexes) > self.max_conversations or self.total_bytes > self.max_bytes
+        ):
+            oldest = next(iter(self.indexes))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        self.versions.pop(key, None)
+        index = self.indexes.pop(key, None)
+        if index is not None:
+            self.total_bytes -= index.nbytes()
+
+    def stats(self):
+        return {
+            "conversations": len(self.indexes),
+            "bytes": self.total_bytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+
+class LocalBlobContainer():
+    # Local-disk stand-in for an Azure Storage blob container, with the same
+    # method names so a blob-backed container can be swapped in
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        ## shard by prefix so no single directory grows too large
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def _exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def _upload(self, name, source):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=".upload-", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if isinstance(source, bytes):
+                    f.write(source)
+                else:
+                    with open(source, "rb") as src:
+                        shutil.copyfileobj(src, f)
+            ## readers never see a partially written blob
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def _download(self, name):
+        with open(self._path(name), "rb") as f:
+            return f.read()
+
+    def _touch(self, name):
+        os.utime(self._path(name))
+
+    def _delete(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def _list(self):
+        blobs = []
+        for directory, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith("."):
+                    continue
+                stat = os.stat(os.path.join(directory, filename))
+                blobs.append({"name": filename, "size": stat.st_size, "last_modified": stat.st_mtime})
+        return blobs
+
+    async def exists(self, name):
+        return await asyncio.to_thread(self._exists, name)
+
+    async def upload_blob(self, name, source):
+        await asyncio.to_thread(self._upload, name, source)
+
+    async def download_blob(self, name):
+        return await asyncio.to_thread(self._download, name)
+
+    async def touch_blob(self, name):
+        await asyncio.to_thread(self._touch, name)
+
+    async def delete_blob(self, name):
+        await asyncio.to_thread(self._delete, name)
+
+    async def list_blobs(self):
+        return await asyncio.to_thread(self._list)
+
+
+class AttachmentStore():
+    # Content-addressed attachments: each file is stored once under the
+    # SHA-256 of its content, however many messages refer to it. Blobs no
+    # message refers to are removed by collect_garbage once they are older
+    # than grace_period, which covers uploads whose message is not saved yet.
+
+    def __init__(self, container, grace_period: float = 3600):
+        self.container = container
+        self.grace_period = grace_period
+        self.writes = 0
+        self.dedupe_hits = 0
+        self.collected = 0
+
+    async def put(self, upload):
+        if await self.container.exists(upload.sha256):
+            ## refresh it so garbage collection does not race the message that is about to refer to it
+            await self.container.touch_blob(upload.sha256)
+            self.dedupe_hits += 1
+        else:
+            await self.container.upload_blob(upload.sha256, upload.path)
+            self.writes += 1
+        return {
+            "sha256": upload.sha256,
+            "filename": upload.filename,
+            "content_type": upload.content_type,
+            "size": upload.size,
+        }
+
+    async def get(self, sha256):
+        return await self.container.download_blob(sha256)
+
+    async def collect_garbage(self, referenced):
+        referenced = set(referenced)
+        cutoff = time.time() - self.grace_period
+        deleted = 0
+        for blob in await self.container.list_blobs():
+            if blob["name"] not in referenced and blob["last_modified"] < cutoff:
+                await self.container.delete_blob(blob["name"])
+                deleted += 1
+        self.collected += deleted
+        return deleted
+
+    def stats(self):
+        return {
+            "writes": self.writes,
+            "dedupe_hits": self.dedupe_hits,
+            "collected": self.collected,
+        }
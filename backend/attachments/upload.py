@@ -0,0 +1,156 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import weakref
+import aiofiles
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+
+class UploadRejected(Exception):
+
+    def __init__(self, message, status_code=413):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def copy_file(source, destination):
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    shutil.copyfile(source, destination)
+
+
+class SpooledUpload():
+    # An uploaded file spooled to disk. The content is read lazily and off the
+    # event loop; the spool file is removed on close() or once the upload is
+    # no longer referenced.
+
+    def __init__(self, path, filename, content_type, size, name="file", sha256=None):
+        self.path = path
+        self.filename = filename
+        self.content_type = content_type
+        self.size = size
+        self.name = name
+        self.sha256 = sha256
+        self._finalizer = weakref.finalize(self, remove_file, path)
+
+    def open(self):
+        return aiofiles.open(self.path, "rb")
+
+    async def read(self):
+        async with self.open() as f:
+            return await f.read()
+
+    async def chunks(self, chunk_size=64 * 1024):
+        async with self.open() as f:
+            while chunk := await f.read(chunk_size):
+                yield chunk
+
+    async def save(self, destination):
+        await asyncio.to_thread(copy_file, self.path, destination)
+
+    def close(self):
+        self._finalizer()
+
+
+class UploadSpooler():
+    # Parses multipart bodies as they arrive, writing file parts to spool
+    # files in chunk_size writes on a worker thread. Size and type limits are
+    # checked while streaming, so a rejected upload is never read in full.
+
+    def __init__(self, max_file_size: int = 20 * 1024 * 1024, allowed_types=None, spool_dir=None,
+                 chunk_size: int = 64 * 1024, max_form_memory_size: int = 16 * 1024 * 1024):
+        self.max_file_size = max_file_size
+        self.allowed_types = set(allowed_types or [])
+        self.spool_dir = spool_dir
+        self.chunk_size = chunk_size
+        self.max_form_memory_size = max_form_memory_size
+
+    def get_content_type(self, filename, content_type=None):
+        if not content_type or content_type == "application/octet-stream":
+            content_type = mimetypes.guess_type(filename)[0] or content_type
+        return (content_type or "application/octet-stream").split(";")[0].strip().lower()
+
+    def is_allowed(self, content_type):
+        if not self.allowed_types:
+            return True
+        return (content_type in self.allowed_types
+                or f"{content_type.split('/')[0]}/*" in self.allowed_types)
+
+    async def parse(self, body, boundary):
+        parser = MultipartDecoder(boundary, self.max_form_memory_size)
+        fields = []
+        files = []
+        part = None
+        spool = None
+        buffer = bytearray()
+        try:
+            async for data in body:
+                parser.receive_data(data)
+                event = parser.next_event()
+                while not isinstance(event, (Epilogue, NeedData)):
+                    if isinstance(event, Field):
+                        part = event
+                    elif isinstance(event, File):
+                        part = event
+                        if event.filename:
+                            spool = await self.start_file(event)
+                    elif isinstance(event, Data):
+                        ## an empty file input sends a part without a filename, which is dropped
+                        if isinstance(part, Field) or spool is not None:
+                            buffer.extend(event.data)
+                        if spool is not None:
+                            spool["size"] += len(event.data)
+                            spool["hash"].update(event.data)
+                            if spool["size"] > self.max_file_size:
+                                raise UploadRejected(
+                                    f"File {part.filename} is larger than {self.max_file_size} bytes")
+                            if len(buffer) >= self.chunk_size or not event.more_data:
+                                await spool["file"].write(bytes(buffer))
+                                buffer.clear()
+                        if not event.more_data:
+                            if isinstance(part, Field):
+                                fields.append((part.name, buffer.decode("utf-8", "replace")))
+                                buffer.clear()
+                            elif spool is not None:
+                                files.append((part.name, await self.finish_file(part, spool)))
+                                spool = None
+                    event = parser.next_event()
+            if spool is not None:
+                raise UploadRejected(f"Upload of {part.filename} is incomplete", status_code=400)
+        except BaseException as e:
+            if spool is not None:
+                await spool["file"].close()
+                remove_file(spool["path"])
+            for _, upload in files:
+                upload.close()
+            if isinstance(e, RequestEntityTooLarge):
+                ## a form field over max_form_memory_size
+                raise UploadRejected("A form field is too large", status_code=413) from e
+            if isinstance(e, ValueError):
+                raise UploadRejected(str(e), status_code=400) from e
+            raise
+        return MultiDict(fields), MultiDict(files)
+
+    async def start_file(self, event):
+        content_type = self.get_content_type(event.filename, event.headers.get("content-type"))
+        if not self.is_allowed(content_type):
+            raise UploadRejected(f"File type {content_type} is not allowed", status_code=415)
+        fd, path = tempfile.mkstemp(prefix="upload-", dir=self.spool_dir)
+        return {"file": await aiofiles.open(fd, "wb"), "path": path, "size": 0,
+                "content_type": content_type, "hash": hashlib.sha256()}
+
+    async def finish_file(self, event, spool):
+        await spool["file"].close()
+        return SpooledUpload(spool["path"], event.filename, spool["content_type"], spool["size"],
+                             name=event.name, sha256=spool["hash"].hexdigest())
@@ -31,6 +31,23 @@ def initialize_firebase():
         firebase_admin.initialize_app(cred)
 
 
+def warm_up_firebase():
+    # Initialize the app and fetch the public keys ID tokens are verified
+    # with, so the first signed-in request does not wait for them.
+    # The verifier keeps the keys in its HTTP cache until they expire.
+    initialize_firebase()
+    ## firebase_admin has no public way to fill the verifier's key cache, so
+    ## this reaches into its internals (as of the pinned 6.5.0). If they
+    ## change, skip the warm-up and let the first sign-in fetch the keys.
+    try:
+        verifier = auth._get_client(firebase_admin.get_app())._token_verifier
+        cert_url = verifier.id_token_verifier.cert_url
+    except AttributeError:
+        logging.warning("Cannot warm up the Firebase key cache with this firebase_admin version")
+        return
+    verifier.request(cert_url, method="GET")
+
+
 def get_authenticated_user_details(request_headers):
     try:
         initialize_firebase()
@@ -0,0 +1,105 @@
+import hashlib
+import json
+from cachetools import TTLCache
+from backend.utils import closes_source
+
+# model_args fields that decide the completion of a deterministic request
+CACHE_KEY_FIELDS = ["model", "messages", "temperature", "top_p", "stop"]
+
+
+async def replay_response(entry, history_metadata):
+    yield {
+        "id": entry["id"],
+        "model": entry["model"],
+        "created": entry["created"],
+        "object": entry["object"],
+        "choices": [{"messages": [{"role": "assistant", "content": entry["content"]}]}],
+        "history_metadata": history_metadata,
+    }
+
+
+@closes_source
+async def record_response(r, on_complete):
+    # pass the stream through and hand the answer to on_complete once the
+    # stream completed with finish_reason "stop", so answers cut off by
+    # length or the content filter are not replayed as complete
+    entry = None
+    contents = []
+    cacheable = True
+    finish_reason = None
+    try:
+        async for event in r:
+            if event and event.get("choices"):
+                finish_reason = event["choices"][0].get("finish_reason") or finish_reason
+                if entry is None:
+                    entry = {field: event[field] for field in ["id", "model", "created", "object"]}
+                for message in event["choices"][0]["messages"]:
+                    if message.get("role") != "assistant" or "context" in message:
+                        ## tool / citation frames are not replayed
+                        cacheable = False
+                    elif message.get("content"):
+                        contents.append(message["content"])
+            yield event
+    finally:
+        await r.aclose()
+
+    if cacheable and finish_reason == "stop" and entry is not None and contents:
+        entry["content"] = "".join(contents)
+        on_complete(entry)
+
+
+class ResponseCache():
+
+    def __init__(self, max_size: int, ttl: float):
+        # max_size is measured in characters of cached answer content
+        self.cache = TTLCache(maxsize=max_size, ttl=ttl, getsizeof=lambda entry: len(entry["content"]) or 1)
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, model_args):
+        ## only requests without sampling randomness are cacheable
+        if float(model_args.get("temperature") or 0) != 0:
+            return None
+
+        key_args = {field: model_args.get(field) for field in CACHE_KEY_FIELDS}
+        key_args["messages"] = [
+            {"role": message["role"], "content": (message["content"] or "").strip()}
+            for message in model_args.get("messages", [])
+        ]
+        encoded = json.dumps(key_args, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, key, entry):
+        try:
+            self.cache[key] = entry
+        except ValueError:
+            ## the answer alone is larger than the whole cache
+            pass
+
+    async def replay(self, entry, history_metadata):
+        async for event in replay_response(entry, history_metadata):
+            yield event
+
+    @closes_source
+    async def record(self, key, r):
+        async for event in record_response(r, lambda entry: self.set(key, entry)):
+            yield event
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "entries": len(self.cache),
+            "size": self.cache.currsize,
+            "max_size": self.cache.maxsize,
+        }
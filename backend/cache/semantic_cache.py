@@ -0,0 +1,135 @@
+import time
+import numpy as np
+from backend.cache.response_cache import record_response, replay_response
+from backend.utils import closes_source
+
+
+class SemanticNamespace():
+    # Question embeddings of one model, stored as unit vectors in a single
+    # matrix so a lookup is one matrix-vector product. The matrix starts
+    # small and doubles when full, up to max_entries rows.
+
+    def __init__(self, max_entries: int, dimensions: int, initial_entries: int = 16):
+        self.max_entries = max_entries
+        self.size = 0
+        self.entries = []
+        self._allocate(min(initial_entries, max_entries), dimensions)
+
+    def _allocate(self, capacity, dimensions):
+        vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        created = np.full(capacity, -np.inf)
+        last_used = np.full(capacity, -np.inf)
+        if self.size:
+            vectors[:self.size] = self.vectors[:self.size]
+            created[:self.size] = self.created[:self.size]
+            last_used[:self.size] = self.last_used[:self.size]
+        self.vectors = vectors
+        self.created = created
+        self.last_used = last_used
+        self.entries += [None] * (capacity - len(self.entries))
+
+    @property
+    def capacity(self):
+        return len(self.entries)
+
+    def search(self, vector, threshold, expires_before):
+        live = self.created[:self.size] > expires_before
+        if not live.any():
+            return None
+        scores = self.vectors[:self.size] @ vector
+        scores[~live] = -np.inf
+        index = int(np.argmax(scores))
+        if scores[index] < threshold:
+            return None
+        self.last_used[index] = time.monotonic()
+        return self.entries[index]
+
+    def add(self, vector, entry, expires_before):
+        ## reuse an expired slot first, then a free one (growing the matrix
+        ## if needed), otherwise evict the least recently used one
+        expired = np.flatnonzero(self.created[:self.size] <= expires_before)
+        if len(expired):
+            index = int(expired[0])
+        elif self.size < self.max_entries:
+            if self.size == self.capacity:
+                self._allocate(min(2 * self.capacity, self.max_entries), self.vectors.shape[1])
+            index = self.size
+            self.size += 1
+        else:
+            index = int(np.argmin(self.last_used))
+        now = time.monotonic()
+        self.vectors[index] = vector
+        self.entries[index] = entry
+        self.created[index] = now
+        self.last_used[index] = now
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        return self.vectors.nbytes + self.created.nbytes + self.last_used.nbytes
+
+
+class SemanticCache():
+
+    def __init__(self, threshold: float, max_entries: int, ttl: float):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.namespaces = {}
+        self.hits = 0
+        self.misses = 0
+        self.embedding_calls = 0
+        self.embedding_seconds = 0.0
+
+    def normalize(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, namespace, embedding):
+        entry = None
+        if namespace in self.namespaces:
+            entry = self.namespaces[namespace].search(
+                self.normalize(embedding), self.threshold, time.monotonic() - self.ttl
+            )
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def set(self, namespace, embedding, entry):
+        vector = self.normalize(embedding)
+        if namespace not in self.namespaces:
+            self.namespaces[namespace] = SemanticNamespace(self.max_entries, len(vector))
+        self.namespaces[namespace].add(vector, entry, time.monotonic() - self.ttl)
+
+    def record_embedding_time(self, seconds):
+        self.embedding_calls += 1
+        self.embedding_seconds += seconds
+
+    async def replay(self, entry, history_metadata):
+        async for event in replay_response(entry, history_metadata):
+            yield event
+
+    @closes_source
+    async def record(self, namespace, embedding, r):
+        async for event in record_response(r, lambda entry: self.set(namespace, embedding, entry)):
+            yield event
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "entries": {namespace: len(index) for namespace, index in self.namespaces.items()},
+            "allocated_entries": {
+                namespace: index.capacity for namespace, index in self.namespaces.items()
+            },
+            "allocated_bytes": sum(index.nbytes() for index in self.namespaces.values()),
+            "embedding_avg_ms": (
+                1000 * self.embedding_seconds / self.embedding_calls if self.embedding_calls else 0
+            ),
+        }
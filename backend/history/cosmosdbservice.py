@@ -5,14 +5,15 @@ from azure.cosmos import exceptions
   
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, cosmosdb_client: CosmosClient = None):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            # reuse the worker-wide client when one is given, so its caches and connections survive across requests
+            self.cosmosdb_client = cosmosdb_client or CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -46,12 +47,14 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
-    async def create_conversation(self, user_id, title = ''):
+    async def create_conversation(self, user_id, title = '', conversation_id = None, created_at = None):
+        ## callers may pick the id and timestamp up front to hand them out before the write completes
+        created_at = created_at or datetime.utcnow().isoformat()
         conversation = {
-            'id': str(uuid.uuid4()),  
+            'id': conversation_id or str(uuid.uuid4()),  
             'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
+            'createdAt': created_at,  
+            'updatedAt': created_at,  
             'userId': user_id,
             'title': title
         }
@@ -69,6 +72,18 @@ class CosmosConversationClient():
         else:
             return False
 
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        ## patch only the title so concurrent updatedAt writes are not lost
+        resp = await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[{'op': 'set', 'path': '/title', 'value': title}]
+        )
+        if resp:
+            return resp
+        else:
+            return False
+
     async def delete_conversation(self, user_id, conversation_id):
         conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
         if conversation:
@@ -79,6 +94,8 @@ class CosmosConversationClient():
 
         
     async def delete_messages(self, conversation_id, user_id):
+        ## the summary is made from the messages, so it goes with them
+        await self.delete_summary(user_id, conversation_id)
         ## get a list of all the messages in the conversation
         messages = await self.get_messages(user_id, conversation_id)
         response_list = []
@@ -128,7 +145,7 @@ class CosmosConversationClient():
         else:
             return conversations[0]
  
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict, token: int = 0):
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict, token: int = 0, attachments: list = None):
         message = {
             'id': uuid,
             'type': 'message',
@@ -140,22 +157,49 @@ class CosmosConversationClient():
             'content': input_message['content'],
             'token': token
         }
+        if attachments:
+            ## references into the content-addressed attachment store
+            message['attachments'] = attachments
 
         if self.enable_message_feedback:
             message['feedback'] = ''
         
         resp = await self.container_client.upsert_item(message)  
         if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value,
+            ## patched so a concurrent history generation bump is not overwritten
+            try:
+                await self.container_client.patch_item(
+                    item=conversation_id,
+                    partition_key=user_id,
+                    patch_operations=[{'op': 'set', 'path': '/updatedAt', 'value': message['createdAt']}]
+                )
+            except exceptions.CosmosResourceNotFoundError:
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
             return resp
         else:
             return False
     
+    async def get_history_generation(self, user_id, conversation_id):
+        ## None when the conversation does not exist
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        return conversation.get('historyGeneration', 0)
+
+    async def bump_history_generation(self, user_id, conversation_id):
+        ## tells every worker that messages it may have cached were removed or rewritten
+        try:
+            conversation = await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'incr', 'path': '/historyGeneration', 'value': 1}]
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        return conversation.get('historyGeneration', 0)
+
     async def update_message_feedback(self, user_id, message_id, feedback):
         message = await self.container_client.read_item(item=message_id, partition_key=user_id)
         if message:
@@ -165,6 +209,14 @@ class CosmosConversationClient():
         else:
             return False
 
+    async def get_attachment_hashes(self):
+        query = "SELECT DISTINCT VALUE a.sha256 FROM c JOIN a IN c.attachments WHERE c.type='message'"
+        hashes = []
+        async for item in self.container_client.query_items(query=query):
+            hashes.append(item)
+
+        return hashes
+
     async def get_messages(self, user_id, conversation_id):
         parameters = [
             {
@@ -183,3 +235,30 @@ class CosmosConversationClient():
 
         return messages
 
+    async def get_summary(self, user_id, conversation_id):
+        try:
+            return await self.container_client.read_item(
+                item=f"{conversation_id}-summary", partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    async def upsert_summary(self, user_id, conversation_id, content, summarized_turns, generation=0):
+        summary = {
+            'id': f"{conversation_id}-summary",
+            'type': 'summary',
+            'userId': user_id,
+            'conversationId': conversation_id,
+            'content': content,
+            'summarizedTurns': summarized_turns,
+            ## the history generation of the messages it summarizes
+            'historyGeneration': generation,
+            'updatedAt': datetime.utcnow().isoformat(),
+        }
+        return await self.container_client.upsert_item(summary)
+
+    async def delete_summary(self, user_id, conversation_id):
+        try:
+            await self.container_client.delete_item(
+                item=f"{conversation_id}-summary", partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
@@ -0,0 +1,96 @@
+from cachetools import LRUCache
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new turns below. Keep names, numbers, decisions, "
+    "open questions and anything the user asked to remember. Write it in the "
+    "language of the conversation, in at most 300 words, with no preamble."
+)
+
+
+def message_text(message):
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if part.get("type") == "text")
+
+
+def turn_starts(messages):
+    # index of the user message that starts each turn
+    return [index for index, message in enumerate(messages) if message["role"] == "user"]
+
+
+def select_turns(messages, after_turn, through_turn):
+    # Messages of turns after_turn + 1 to through_turn, counting from 1
+    starts = turn_starts(messages) + [len(messages)]
+    if after_turn >= len(starts) - 1:
+        return []
+    end = starts[min(through_turn, len(starts) - 1)]
+    return messages[starts[after_turn]:end]
+
+
+def apply_summary(messages, total_turns, summary):
+    # Drop the turns the summary covers. messages may be only the last part
+    # of a conversation of total_turns turns, as the conversation tail is.
+    starts = turn_starts(messages)
+    first_turn = total_turns - len(starts) + 1
+    keep_from_turn = summary["summarizedTurns"] + 1
+    if keep_from_turn <= first_turn:
+        ## replies before the first user message belong to a summarized turn
+        return messages[starts[0]:] if starts else messages
+    if keep_from_turn - first_turn >= len(starts):
+        ## never drop the question being asked
+        return messages[starts[-1]:]
+    return messages[starts[keep_from_turn - first_turn]:]
+
+
+def summary_request(previous, turns):
+    transcript = "\n\n".join(
+        f"{message['role']}: {message_text(message)}"
+        for message in turns
+        if message["role"] in ("user", "assistant")
+    )
+    if previous:
+        transcript = f"Summary so far:\n{previous['content']}\n\nNew turns:\n{transcript}"
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript},
+    ]
+
+
+class SummaryCache():
+    # Latest summary of recently used conversations (None when there is none
+    # yet) with the history generation it was read at, and the conversations
+    # a summary is being made for, so there is one job per conversation at a
+    # time. An entry of another generation (the conversation was cleared or
+    # rewritten since, maybe by another worker) is a miss.
+
+    def __init__(self, max_entries: int = 1000):
+        self.summaries = LRUCache(maxsize=max_entries)
+        self.running = set()
+        self.hits = 0
+        self.misses = 0
+        self.updates = 0
+
+    def get(self, key, generation=0):
+        entry = self.summaries.get(key)
+        if entry is not None and entry[0] == generation:
+            self.hits += 1
+            return True, entry[1]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, summary, generation=0):
+        self.summaries[key] = (generation, summary)
+
+    def discard(self, key):
+        self.summaries.pop(key, None)
+
+    def stats(self):
+        return {
+            "conversations": len(self.summaries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "updates": self.updates,
+            "running": len(self.running),
+        }
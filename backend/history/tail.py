@@ -0,0 +1,83 @@
+from cachetools import LRUCache
+
+ROLES = ("user", "assistant", "tool")
+
+
+class StaleHistoryError(Exception):
+    status_code = 409
+
+    def __init__(self, version):
+        super().__init__("The conversation has changed since it was loaded, please send the full history")
+        self.version = version
+
+
+def tail_from_history(messages, max_messages, generation=0):
+    # Stored messages (as returned by get_messages) to a tail. The version
+    # is the number of user turns, which both sides can count; the generation
+    # is the conversation's history generation the messages were read at.
+    messages = sorted(messages, key=lambda message: message.get("createdAt", ""))
+    version = sum(1 for message in messages if message["role"] == "user")
+    tail = [
+        {"role": message["role"], "content": message["content"]}
+        for message in messages
+        if message["role"] in ROLES
+    ]
+    return {"version": version, "generation": generation, "messages": tail[-max_messages:]}
+
+
+class ConversationTailCache():
+    # The last max_messages messages of recently used conversations, so a
+    # client can send only its new turn. Each worker has its own cache; a
+    # client whose version is ahead of it makes the caller reload from history,
+    # and so does a history generation other than the one the tail was read at
+    # (another worker cleared or rewrote the conversation).
+
+    def __init__(self, max_conversations: int = 1000, max_messages: int = 50):
+        self.max_messages = max_messages
+        self.tails = LRUCache(maxsize=max_conversations)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, conversation_id, generation=None):
+        tail = self.tails.get((user_id, conversation_id))
+        if tail is not None and generation is not None and tail["generation"] != generation:
+            del self.tails[(user_id, conversation_id)]
+            tail = None
+        if tail is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return tail
+
+    def load(self, user_id, conversation_id, messages, generation=0):
+        tail = tail_from_history(messages, self.max_messages, generation)
+        self.tails[(user_id, conversation_id)] = tail
+        return tail
+
+    def append(self, user_id, conversation_id, message):
+        # only conversations already cached are kept up to date
+        tail = self.tails.get((user_id, conversation_id))
+        if tail is None:
+            return None
+        if message["role"] == "user":
+            tail["version"] += 1
+        tail["messages"] = (tail["messages"] + [
+            {"role": message["role"], "content": message["content"]}
+        ])[-self.max_messages:]
+        return tail
+
+    def start(self, user_id, conversation_id):
+        # a new conversation starts with an empty tail
+        tail = {"version": 0, "generation": 0, "messages": []}
+        self.tails[(user_id, conversation_id)] = tail
+        return tail
+
+    def discard(self, user_id, conversation_id):
+        self.tails.pop((user_id, conversation_id), None)
+
+    def stats(self):
+        return {
+            "conversations": len(self.tails),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,184 @@
+import asyncio
+import time
+import weakref
+from collections import defaultdict, deque
+from backend.utils import ClosingStream
+
+PRIORITY_BACKGROUND = 0
+PRIORITY_STANDARD = 1
+PRIORITY_PREMIUM = 2
+
+
+class AdmissionRejected(Exception):
+    status_code = 429
+
+    def __init__(self, reason, retry_after=None):
+        super().__init__(f"Too many concurrent chat requests ({reason}), please retry later")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionSlot():
+
+    def __init__(self, controller, user_id, priority=PRIORITY_STANDARD):
+        self.controller = controller
+        self.user_id = user_id
+        self.priority = priority
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.controller.release(self)
+
+    def hold(self, r):
+        # Keep the slot until the stream is exhausted or closed
+        async def stream():
+            try:
+                async for event in r:
+                    yield event
+            finally:
+                await close()
+
+        async def close():
+            self.release()
+            await r.aclose()
+
+        ## closing a stream that was never started releases the slot too
+        guarded = ClosingStream(stream(), close)
+        ## a response that is never started is never closed either, so also release when it is collected
+        weakref.finalize(guarded, self.release)
+        return guarded
+
+
+def priority_from_claims(claims, claim_priorities, default=PRIORITY_STANDARD):
+    # claim_priorities maps "claim" (any truthy value) or "claim=value" to a priority
+    priorities = []
+    for key, priority in claim_priorities.items():
+        claim, _, value = key.partition("=")
+        if value and str(claims.get(claim)) == value or not value and claims.get(claim):
+            priorities.append(priority)
+    return max(priorities, default=default)
+
+
+class AdmissionController():
+    # Caps concurrent completions per worker and per user. Requests over the
+    # cap wait in a bounded queue for at most queue_timeout seconds, highest
+    # priority first and FIFO within a priority; when the queue is full or the
+    # wait runs out they are rejected with 429. The last `reserved` slots are
+    # kept for premium requests, and a full queue sheds its lowest priority
+    # waiter to make room for a more important one.
+
+    def __init__(self, max_concurrency: int = 64, max_per_user: int = 4, max_queue: int = 128,
+                 queue_timeout: float = 10, reserved: int = 0):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.reserved = reserved
+        self.active = 0
+        self.active_by_user = defaultdict(int)
+        self.waiters = deque()
+        self.admitted = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.avg_hold = 1.0
+
+    def can_run(self, user_id, priority=PRIORITY_STANDARD):
+        limit = self.max_concurrency if priority >= PRIORITY_PREMIUM else self.max_concurrency - self.reserved
+        return (self.active < limit
+                and (not self.max_per_user or self.active_by_user[user_id] < self.max_per_user))
+
+    def retry_after(self):
+        ## roughly how long until the current queue drains
+        return max(1.0, self.avg_hold * (len(self.waiters) + 1) / self.max_concurrency)
+
+    def _grant(self, user_id, priority, waited):
+        self.active += 1
+        self.active_by_user[user_id] += 1
+        self.admitted[priority] += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return AdmissionSlot(self, user_id, priority)
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        raise AdmissionRejected(reason, self.retry_after())
+
+    def _shed(self, priority):
+        ## drop the newest of the least important waiters, if it matters less than this request
+        if not self.waiters:
+            return False
+        victim = min(self.waiters, key=lambda entry: (entry[1], -entry[2]))
+        if victim[1] >= priority:
+            return False
+        self.waiters.remove(victim)
+        self.rejected["shed"] += 1
+        victim[3].set_exception(AdmissionRejected("shed", self.retry_after()))
+        return True
+
+    async def acquire(self, user_id=None, priority=PRIORITY_STANDARD):
+        # Free capacity is always handed to eligible waiters first, so nobody
+        # still queued could run now and this request does not jump the queue
+        if self.can_run(user_id, priority):
+            return self._grant(user_id, priority, 0.0)
+        if len(self.waiters) >= self.max_queue and not self._shed(priority):
+            self._reject("queue_full")
+
+        started = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        entry = (user_id, priority, started, waiter)
+        self.waiters.append(entry)
+        try:
+            await asyncio.wait([waiter], timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            if not waiter.done():
+                self.waiters.remove(entry)
+            elif waiter.exception() is None:
+                waiter.result().release()
+            raise
+        if not waiter.done():
+            self.waiters.remove(entry)
+            waiter.cancel()
+            self._reject("queue_timeout")
+        return waiter.result()
+
+    def release(self, slot):
+        self.active -= 1
+        self.active_by_user[slot.user_id] -= 1
+        if not self.active_by_user[slot.user_id]:
+            del self.active_by_user[slot.user_id]
+        held = time.monotonic() - slot.acquired_at
+        self.avg_hold = 0.9 * self.avg_hold + 0.1 * held
+        self._wake()
+
+    def _wake(self):
+        now = time.monotonic()
+        for entry in sorted(self.waiters, key=lambda entry: (-entry[1], entry[2])):
+            if self.active >= self.max_concurrency:
+                break
+            user_id, priority, started, waiter = entry
+            if not self.can_run(user_id, priority):
+                continue
+            self.waiters.remove(entry)
+            waiter.set_result(self._grant(user_id, priority, now - started))
+
+    def stats(self):
+        admitted = sum(self.admitted.values())
+        queued = defaultdict(int)
+        for _, priority, _, _ in self.waiters:
+            queued[priority] += 1
+        return {
+            "active": self.active,
+            "queue_depth": len(self.waiters),
+            "queue_depth_by_priority": dict(queued),
+            "admitted": admitted,
+            "admitted_by_priority": dict(self.admitted),
+            "rejected": dict(self.rejected),
+            "avg_wait_ms": round(self.total_wait / admitted * 1000, 1) if admitted else 0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "avg_hold_seconds": round(self.avg_hold, 2),
+        }
@@ -0,0 +1,109 @@
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from cachetools import LRUCache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    context_window: int
+    encoding: str
+    # room always left for the answer when the history is packed
+    output_reserve: int
+    max_output_tokens: int
+    # accepts image parts
+    vision: bool = False
+
+
+# keyed by the gptModel values sent by the frontend
+MODEL_REGISTRY = {
+    "gpt-3.5-turbo-0125": ModelSpec(16385, "cl100k_base", 1024, 4096),
+    "gpt-4": ModelSpec(8192, "cl100k_base", 1024, 4096),
+    "gpt-4o": ModelSpec(128000, "o200k_base", 1024, 4096, vision=True),
+    "az-gpt-3.5": ModelSpec(16385, "cl100k_base", 1024, 4096),
+    "az-gpt-4": ModelSpec(8192, "cl100k_base", 1024, 4096),
+}
+DEFAULT_MODEL = "gpt-3.5-turbo-0125"
+
+# tokens the chat format adds per message and to prime the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+# rough cost of an image part when the real one is unknown
+TOKENS_PER_IMAGE = 765
+
+
+def get_model_spec(gptModel):
+    return MODEL_REGISTRY.get(gptModel, MODEL_REGISTRY[DEFAULT_MODEL])
+
+
+@lru_cache(maxsize=None)
+def get_encoder(encoding):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(encoding)
+    except Exception:
+        logging.warning("tiktoken encoding %s is not available, estimating token counts", encoding)
+        return None
+
+
+class TokenCounter():
+
+    def __init__(self, max_cached_messages: int = 10000):
+        self.cache = LRUCache(maxsize=max_cached_messages)
+
+    def count_text(self, text, encoding):
+        encoder = get_encoder(encoding)
+        if encoder is None:
+            ## about one token per 3 UTF-8 bytes, on the safe side for English and Japanese
+            return (len(text.encode("utf-8")) + 2) // 3
+        return len(encoder.encode(text, disallowed_special=()))
+
+    def count_message(self, message, encoding):
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            tokens = TOKENS_PER_MESSAGE
+            for part in content:
+                if part.get("type") == "text":
+                    tokens += self.count_text(part["text"], encoding)
+                else:
+                    tokens += part.get("tokens", TOKENS_PER_IMAGE)
+            return tokens
+
+        key = (encoding, message["role"], content)
+        tokens = self.cache.get(key)
+        if tokens is None:
+            tokens = TOKENS_PER_MESSAGE + self.count_text(message["role"], encoding) + self.count_text(content, encoding)
+            self.cache[key] = tokens
+        return tokens
+
+
+def pack_messages(messages, spec, max_tokens, counter):
+    # Drop the oldest turns until the prompt fits the context window with
+    # spec.output_reserve left over, then size max_tokens to what is left.
+    # The system message and the newest message are always kept.
+    counts = [counter.count_message(message, spec.encoding) for message in messages]
+    budget = spec.context_window - spec.output_reserve - TOKENS_PER_REPLY
+    prompt_tokens = sum(counts)
+
+    first = 1 if messages and messages[0]["role"] == "system" else 0
+    keep_from = first
+    while prompt_tokens > budget and keep_from < len(messages) - 1:
+        prompt_tokens -= counts[keep_from]
+        keep_from += 1
+        ## never start the kept history in the middle of a turn
+        while keep_from < len(messages) - 1 and messages[keep_from]["role"] != "user":
+            prompt_tokens -= counts[keep_from]
+            keep_from += 1
+
+    if keep_from > first:
+        logging.debug("Dropped %d messages to fit the context window", keep_from - first)
+
+    prompt_tokens += TOKENS_PER_REPLY
+    max_tokens = min(max_tokens, spec.max_output_tokens, spec.context_window - prompt_tokens)
+    return messages[:first] + messages[keep_from:], max(max_tokens, 1), prompt_tokens
@@ -0,0 +1,169 @@
+import asyncio
+from collections import OrderedDict, deque
+
+
+class ReplayExpired(Exception):
+    status_code = 410
+
+    def __init__(self):
+        super().__init__("The requested part of the stream is no longer available, please regenerate")
+
+
+class ReplayBuffer():
+    # The last max_frames frames of one generation. The generation runs in a
+    # task of its own, so it keeps going while its reader reconnects; with
+    # no reader for grace seconds it is cancelled. Readers that are still
+    # connected hold the generation back rather than miss frames.
+
+    def __init__(self, store, user_id, max_frames: int = 2048, grace: float = 15):
+        self.store = store
+        self.user_id = user_id
+        self.message_id = None
+        self.max_frames = max_frames
+        self.grace = grace
+        self.frames = deque()
+        ## offset of frames[0] in the whole stream
+        self.offset = 0
+        self.done = False
+        self.error = None
+        self.task = None
+        self.positions = {}
+        self.idle_timer = None
+        self._changed = asyncio.Event()
+        self._consumed = asyncio.Event()
+
+    @property
+    def end(self):
+        return self.offset + len(self.frames)
+
+    def start(self, source, key_of):
+        async def pump():
+            try:
+                async for frame in source:
+                    if self.message_id is None and key_of(frame):
+                        self.message_id = key_of(frame)
+                        self.store._register(self)
+                    await self._publish(frame)
+            except asyncio.CancelledError:
+                self._close(ConnectionAbortedError("The stream was abandoned"))
+                raise
+            except Exception as error:
+                self._close(error)
+            else:
+                self._close()
+            finally:
+                await source.aclose()
+
+        self.task = asyncio.create_task(pump())
+        return self.read(0)
+
+    async def _publish(self, frame):
+        ## do not drop a frame a connected reader has not read yet
+        while len(self.frames) >= self.max_frames and self.positions and min(self.positions.values()) <= self.offset:
+            self._consumed.clear()
+            await self._consumed.wait()
+        if len(self.frames) >= self.max_frames:
+            self.frames.popleft()
+            self.offset += 1
+        self.frames.append(frame)
+        self._changed.set()
+
+    def _close(self, error=None):
+        self.done = True
+        self.error = error
+        self._changed.set()
+        if self.idle_timer:
+            self.idle_timer.cancel()
+        self.store._finish(self)
+
+    def available(self, offset):
+        return self.offset <= offset <= self.end
+
+    async def read(self, offset=0):
+        if not self.available(offset):
+            raise ReplayExpired()
+        reader = object()
+        self.positions[reader] = offset
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        try:
+            while True:
+                while self.positions[reader] < self.end:
+                    position = self.positions[reader]
+                    yield self.frames[position - self.offset]
+                    self.positions[reader] = position + 1
+                    self._consumed.set()
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self._changed.clear()
+                await self._changed.wait()
+        finally:
+            del self.positions[reader]
+            self._consumed.set()
+            if not self.positions and not self.done:
+                self.idle_timer = asyncio.get_running_loop().call_later(self.grace, self._abandon)
+
+    def _abandon(self):
+        self.idle_timer = None
+        if not self.positions and self.task and not self.task.done():
+            self.task.cancel()
+
+
+class ReplayStore():
+    # Generations by user and message id (the id of their frames), kept for
+    # ttl seconds after they end so a client that lost the connection can
+    # resume from the last frame it received
+
+    def __init__(self, max_frames: int = 2048, ttl: float = 60, grace: float = 15,
+                 max_streams: int = 1000):
+        self.max_frames = max_frames
+        self.ttl = ttl
+        self.grace = grace
+        self.max_streams = max_streams
+        self.buffers = OrderedDict()
+        self.started = 0
+        self.resumed = 0
+        self.expired = 0
+
+    def start(self, user_id, source, key_of=lambda frame: frame.get("id")):
+        self.started += 1
+        buffer = ReplayBuffer(self, user_id, self.max_frames, self.grace)
+        return buffer.start(source, key_of)
+
+    def resume(self, user_id, message_id, offset):
+        buffer = self.buffers.get((user_id, message_id))
+        if buffer is None:
+            return None
+        if not buffer.available(offset):
+            self.expired += 1
+            raise ReplayExpired()
+        self.resumed += 1
+        return buffer.read(offset)
+
+    def _register(self, buffer):
+        self.buffers[(buffer.user_id, buffer.message_id)] = buffer
+        while len(self.buffers) > self.max_streams:
+            ## the oldest is no longer resumable, it still runs for its reader
+            self.buffers.popitem(last=False)
+
+    def _finish(self, buffer):
+        if buffer.message_id is None:
+            return
+        asyncio.get_running_loop().call_later(self.ttl, self._forget, buffer)
+
+    def _forget(self, buffer):
+        key = (buffer.user_id, buffer.message_id)
+        if self.buffers.get(key) is buffer:
+            del self.buffers[key]
+
+    def stats(self):
+        return {
+            "streams": len(self.buffers),
+            "live": sum(1 for buffer in self.buffers.values() if not buffer.done),
+            "started": self.started,
+            "resumed": self.resumed,
+            "expired": self.expired,
+        }
@@ -0,0 +1,131 @@
+import random
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import openai
+
+# "1s", "6m0s", "20ms", "1h2m3.5s" as sent in x-ratelimit-reset-* headers
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class CircuitOpenError(Exception):
+    status_code = 503
+
+    def __init__(self, name, retry_after=None):
+        super().__init__(f"Deployment {name} is temporarily unavailable")
+        self.retry_after = retry_after
+
+
+def parse_duration(value):
+    parts = DURATION_PATTERN.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def get_retry_after(error):
+    # seconds the upstream asked us to wait, from Retry-After or x-ratelimit-* headers
+    response = getattr(error, "response", None)
+    if response is None:
+        return getattr(error, "retry_after", None)
+    headers = response.headers
+
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(headers["retry-after"])
+                return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+            except (TypeError, ValueError):
+                pass
+
+    ## wait for whichever rate limit is exhausted to reset
+    resets = [
+        parse_duration(headers.get(f"x-ratelimit-reset-{limit}"))
+        for limit in ["requests", "tokens"]
+        if headers.get(f"x-ratelimit-remaining-{limit}") == "0"
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def is_retryable(error):
+    if isinstance(error, (CircuitOpenError, openai.APIConnectionError, openai.RateLimitError,
+                          openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in (408, 409)
+
+
+class RetryPolicy():
+
+    def __init__(self, max_attempts: int = 3, deadline: float = 20, base_delay: float = 0.5,
+                 max_delay: float = 8):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            ## honour the server's hint, plus a little jitter so retries do not arrive together
+            return retry_after + random.uniform(0, min(1, retry_after * 0.1))
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker():
+    # Opens after failure_threshold consecutive failures, or at once for as
+    # long as a rate-limited upstream asked us to wait. Once open time is over
+    # a single probe request is let through; its result closes or reopens it.
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probe_started_at = None
+
+    def is_open(self):
+        return time.monotonic() < self.opened_until
+
+    def retry_after(self):
+        return max(self.opened_until - time.monotonic(), 0)
+
+    def allow(self):
+        if self.is_open():
+            return False
+        if self.failures >= self.failure_threshold:
+            now = time.monotonic()
+            ## a probe that never reported back does not block the breaker forever
+            if self.probe_started_at is not None and now - self.probe_started_at < self.reset_timeout:
+                return False
+            self.probe_started_at = now
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_until = 0.0
+        self.probe_started_at = None
+
+    def record_failure(self, retry_after=None):
+        now = time.monotonic()
+        self.failures += 1
+        self.probe_started_at = None
+        if retry_after:
+            self.opened_until = max(self.opened_until, now + retry_after)
+        elif self.failures >= self.failure_threshold:
+            self.opened_until = max(self.opened_until, now + self.reset_timeout)
+
+    def state(self):
+        if self.is_open():
+            return "open"
+        if self.failures >= self.failure_threshold:
+            return "half_open"
+        return "closed"
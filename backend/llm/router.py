@@ -0,0 +1,129 @@
+import random
+import time
+from collections import deque
+from backend.llm.resilience import CircuitOpenError
+
+
+class Deployment():
+    # One upstream deployment of a logical model, with a moving window of
+    # time-to-first-token and error samples.
+
+    def __init__(self, name: str, backend: str, model: str, endpoint: str = None, api_key: str = None,
+                 window_seconds: float = 60, window_size: int = 100, breaker=None):
+        self.name = name
+        self.backend = backend
+        self.model = model
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.window_seconds = window_seconds
+        ## (timestamp, ttft in seconds or None for an error)
+        self.samples = deque(maxlen=window_size)
+        self.in_flight = 0
+        self.breaker = breaker
+
+    def _trim(self):
+        expires_before = time.monotonic() - self.window_seconds
+        while self.samples and self.samples[0][0] < expires_before:
+            self.samples.popleft()
+
+    def record_first_token(self, ttft):
+        self.samples.append((time.monotonic(), ttft))
+
+    def record_error(self):
+        self.samples.append((time.monotonic(), None))
+
+    def error_rate(self):
+        self._trim()
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, ttft in self.samples if ttft is None) / len(self.samples)
+
+    def avg_ttft(self):
+        self._trim()
+        ttfts = [ttft for _, ttft in self.samples if ttft is not None]
+        return sum(ttfts) / len(ttfts) if ttfts else None
+
+    def stats(self):
+        avg_ttft = self.avg_ttft()
+        return {
+            "name": self.name,
+            "backend": self.backend,
+            "model": self.model,
+            "samples": len(self.samples),
+            "avg_ttft_ms": 1000 * avg_ttft if avg_ttft is not None else None,
+            "error_rate": self.error_rate(),
+            "in_flight": self.in_flight,
+            "circuit": self.breaker.state() if self.breaker else None,
+        }
+
+
+class DeploymentRouter():
+    # Sends each request to the healthy deployment with the lowest recent
+    # error rate, then time-to-first-token. Deployments without samples are
+    # tried first, and a small share of traffic explores the others so their
+    # stats stay fresh.
+
+    def __init__(self, deployments: dict, default_model: str = None, max_error_rate: float = 0.5,
+                 min_samples: int = 5, explore_ratio: float = 0.05):
+        self.deployments = deployments
+        self.default_model = default_model
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.explore_ratio = explore_ratio
+
+    def is_healthy(self, deployment):
+        ## too few samples to judge, unless every one of them is an error
+        if len(deployment.samples) < self.min_samples:
+            return not deployment.samples or deployment.avg_ttft() is not None
+        return deployment.error_rate() <= self.max_error_rate
+
+    def candidates(self, logical_model, exclude=()):
+        deployments = self.deployments.get(logical_model) or self.deployments.get(self.default_model, [])
+        if not deployments:
+            raise Exception(f"No deployment is configured for {logical_model}")
+        available = [
+            deployment for deployment in deployments
+            if deployment.breaker is None or not deployment.breaker.is_open()
+        ]
+        if not available:
+            ## every circuit is open: fail fast until the first one closes
+            raise CircuitOpenError(
+                logical_model, retry_after=min(deployment.breaker.retry_after() for deployment in deployments)
+            )
+        preferred = [deployment for deployment in available if deployment.name not in exclude] or available
+        healthy = [deployment for deployment in preferred if self.is_healthy(deployment)]
+        return healthy or preferred
+
+    def has_alternative(self, logical_model, exclude):
+        try:
+            return any(deployment.name not in exclude for deployment in self.candidates(logical_model, exclude))
+        except CircuitOpenError:
+            return False
+
+    def choose(self, logical_model, exclude=()):
+        candidates = self.candidates(logical_model, exclude)
+        if len(candidates) > 1 and random.random() < self.explore_ratio:
+            return random.choice(candidates)
+
+        def score(deployment):
+            deployment._trim()
+            if not deployment.samples:
+                return (0, 0, 0, deployment.in_flight)
+            avg_ttft = deployment.avg_ttft()
+            return (1, deployment.error_rate(), avg_ttft if avg_ttft is not None else float("inf"),
+                    deployment.in_flight)
+
+        return min(candidates, key=score)
+
+    def all_deployments(self):
+        unique = {}
+        for deployments in self.deployments.values():
+            for deployment in deployments:
+                unique.setdefault(deployment.name, deployment)
+        return list(unique.values())
+
+    def stats(self):
+        return {
+            logical_model: [deployment.stats() for deployment in deployments]
+            for logical_model, deployments in self.deployments.items()
+        }
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+
+class Flight():
+    # One completion shared by every request with the same key. Frames are
+    # kept, so a request that joins late replays them from the start and then
+    # follows the live stream.
+
+    def __init__(self, group, key):
+        self.group = group
+        self.key = key
+        self.frames = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, frame):
+        self.frames.append(frame)
+        self._changed.set()
+
+    def close(self, error=None):
+        if self.done:
+            return
+        self.done = True
+        self.error = error
+        self._changed.set()
+        self.group._finish(self)
+
+    def start(self, source):
+        # Pump the source in a task of its own, so the stream does not end
+        # when the request that started it goes away while others still read
+        async def pump():
+            try:
+                async for frame in source:
+                    self.publish(frame)
+            except asyncio.CancelledError:
+                self.close(ConnectionAbortedError("The shared completion was cancelled"))
+                raise
+            except Exception as error:
+                self.close(error)
+            else:
+                self.close()
+            finally:
+                await source.aclose()
+
+        self.task = asyncio.create_task(pump())
+        return self.subscribe()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                while index < len(self.frames):
+                    yield self.frames[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                self._changed.clear()
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            ## nobody is left to read it, stop the upstream generation
+            if self.subscribers == 0 and self.task and not self.task.done():
+                self.task.cancel()
+
+    async def ready(self):
+        # wait for the first frame, or for the flight to end without one
+        while not self.frames and not self.done:
+            self._changed.clear()
+            await self._changed.wait()
+
+    async def result(self):
+        # the single frame of a non-streaming completion
+        frames = self.subscribe()
+        try:
+            return await frames.__anext__()
+        finally:
+            await frames.aclose()
+
+
+class SingleFlight():
+    # In-flight completions by key. A finished flight stays joinable for
+    # linger seconds, which covers a client retry that arrives right after
+    # the first answer ended.
+
+    def __init__(self, linger: float = 5):
+        self.linger = linger
+        self.flights = {}
+        self.started = 0
+        self.joined = 0
+
+    def join(self, key):
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.joined += 1
+            logging.info("Joined in-flight completion %s", key)
+        return flight
+
+    def begin(self, key):
+        flight = Flight(self, key)
+        self.flights[key] = flight
+        self.started += 1
+        return flight
+
+    def _finish(self, flight):
+        if self.flights.get(flight.key) is not flight:
+            return
+        if flight.error is not None or self.linger <= 0:
+            ## a failed completion is not replayed, a retry starts a new one
+            del self.flights[flight.key]
+        else:
+            asyncio.get_running_loop().call_later(self.linger, self._forget, flight)
+
+    def _forget(self, flight):
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def stats(self):
+        return {
+            "in_flight": sum(1 for flight in self.flights.values() if not flight.done),
+            "started": self.started,
+            "joined": self.joined,
+        }
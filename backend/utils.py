@@ -1,8 +1,19 @@
 import os
 import json
+import fcntl
+import asyncio
 import logging
 import requests
 import dataclasses
+import functools
+import inspect
+from json.encoder import encode_basestring_ascii
+from quart.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
@@ -20,13 +31,259 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
+class ORJSONProvider(DefaultJSONProvider):
+    # jsonify through orjson; datetimes still go through the default hook so
+    # the output matches the standard provider
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs):
+        indent = kwargs.pop("indent", None)
+        kwargs.pop("separators", None)
+        if orjson is None or kwargs:
+            if indent:
+                kwargs["indent"] = indent
+            return super().dumps(obj, **kwargs)
+
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+class StreamFrameEncoder:
+    # Encodes the frames of one streamed response. The envelope around an
+    # assistant content delta (id, model, created, object, history_metadata)
+    # is the same for every chunk, so it is encoded once and only the escaped
+    # content is spliced in.
+    _CONTENT_PLACEHOLDER = "\x00content\x00"
+
+    def __init__(self):
+        self._envelope = None
+        self._prefix = None
+        self._suffix = None
+
+    def encode(self, event):
+        if not _is_content_delta(event):
+            return json.dumps(event, cls=JSONEncoder) + "\n"
+
+        envelope = tuple((key, value) for key, value in event.items() if key != "choices")
+        if envelope != self._envelope:
+            template = dict(event)
+            template["choices"] = [
+                {"messages": [{"role": "assistant", "content": self._CONTENT_PLACEHOLDER}]}
+            ]
+            self._prefix, _, self._suffix = json.dumps(template, cls=JSONEncoder).partition(
+                encode_basestring_ascii(self._CONTENT_PLACEHOLDER)
+            )
+            self._suffix += "\n"
+            self._envelope = envelope
+
+        content = event["choices"][0]["messages"][0]["content"]
+        return self._prefix + encode_basestring_ascii(content) + self._suffix
+
+
+class ClosingStream():
+    # An async iterator over r whose aclose also runs close. The finally of
+    # an async generator that was never started does not run when it is
+    # closed, so cleanup that must happen either way goes here.
+
+    def __init__(self, r, close):
+        self.r = r
+        self.close = close
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.r.__anext__()
+
+    async def aclose(self):
+        try:
+            await self.r.aclose()
+        finally:
+            await self.close()
+
+
+def closes_source(wrapper):
+    # For stream wrappers taking their source as r: closing the wrapper
+    # closes r too, even when the wrapper was never iterated
+    signature = inspect.signature(wrapper)
+
+    @functools.wraps(wrapper)
+    def wrapped(*args, **kwargs):
+        r = signature.bind(*args, **kwargs).arguments["r"]
+        return ClosingStream(wrapper(*args, **kwargs), r.aclose)
+
+    return wrapped
+
+
 async def format_as_ndjson(r):
+    encoder = StreamFrameEncoder()
     try:
         async for event in r:
-            yield json.dumps(event, cls=JSONEncoder) + "\n"
+            yield encoder.encode(event)
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
+    finally:
+        await r.aclose()
+
+
+def _is_content_delta(event):
+    if not event or not event.get("choices"):
+        return False
+    messages = event["choices"][0].get("messages", [])
+    return (
+        len(messages) == 1
+        and len(messages[0]) == 2
+        and messages[0].get("role") == "assistant"
+        and isinstance(messages[0].get("content"), str)
+    )
+
+
+def _merge_content_deltas(event, contents):
+    merged = dict(event)
+    merged["choices"] = [
+        {"messages": [{"role": "assistant", "content": "".join(contents)}]}
+    ]
+    return merged
+
+
+@closes_source
+async def coalesce_stream_response(r, flush_interval=0.03, flush_bytes=1024):
+    # Merge consecutive assistant content deltas into fewer frames. The first
+    # delta is sent at once, later ones are flushed every flush_interval
+    # seconds or once flush_bytes of content are pending.
+    loop = asyncio.get_running_loop()
+    iterator = r.__aiter__()
+    next_event = None
+    pending_event = None
+    pending_contents = []
+    pending_bytes = 0
+    deadline = None
+    first_delta_sent = False
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(iterator.__anext__())
+            timeout = None
+            if pending_contents:
+                timeout = max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_event}, timeout=timeout)
+            if not done:
+                yield _merge_content_deltas(pending_event, pending_contents)
+                pending_contents, pending_bytes = [], 0
+                continue
+
+            task, next_event = next_event, None
+            try:
+                event = task.result()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                if pending_contents:
+                    yield _merge_content_deltas(pending_event, pending_contents)
+                raise
+
+            if not _is_content_delta(event):
+                if pending_contents:
+                    yield _merge_content_deltas(pending_event, pending_contents)
+                    pending_contents, pending_bytes = [], 0
+                yield event
+                continue
+
+            if not first_delta_sent:
+                first_delta_sent = True
+                yield event
+                continue
+
+            content = event["choices"][0]["messages"][0]["content"]
+            if not pending_contents:
+                pending_event = event
+                deadline = loop.time() + flush_interval
+            pending_contents.append(content)
+            pending_bytes += len(content.encode("utf-8"))
+            if pending_bytes >= flush_bytes or loop.time() >= deadline:
+                yield _merge_content_deltas(pending_event, pending_contents)
+                pending_contents, pending_bytes = [], 0
+
+        if pending_contents:
+            yield _merge_content_deltas(pending_event, pending_contents)
+    finally:
+        if next_event is not None:
+            next_event.cancel()
+            await asyncio.gather(next_event, return_exceptions=True)
+        await r.aclose()
+
+
+@closes_source
+async def drop_finish_frames(r):
+    # A frame with no messages, only the finish_reason of the completion,
+    # goes to the client as the empty frame it skips
+    try:
+        async for event in r:
+            if event and event.get("choices") and not event["choices"][0].get("messages"):
+                yield {}
+            else:
+                yield event
+    finally:
+        await r.aclose()
+
+
+@closes_source
+async def buffer_stream_response(r, max_size=32):
+    # Read r ahead in its own task into a queue of at most max_size frames,
+    # so a slow reader holds back the upstream instead of piling up frames.
+    # Closing or cancelling this generator (e.g. when the client disconnects)
+    # closes r as well.
+    queue = asyncio.Queue(maxsize=max_size)
+    end_of_stream = object()
+
+    async def read_ahead():
+        try:
+            async for event in r:
+                await queue.put((event, None))
+            await queue.put((end_of_stream, None))
+        except Exception as error:
+            await queue.put((end_of_stream, error))
+        finally:
+            await r.aclose()
+
+    reader = asyncio.ensure_future(read_ahead())
+    try:
+        while True:
+            event, error = await queue.get()
+            if event is end_of_stream:
+                if error:
+                    raise error
+                break
+            yield event
+    except (asyncio.CancelledError, GeneratorExit):
+        if not reader.done():
+            logging.info("Stream closed by the client, cancelling upstream completion")
+        raise
+    finally:
+        reader.cancel()
+
+
+def try_lock_file(path):
+    # An exclusive lock on path for as long as the returned file stays open
+    # (or the process lives), or None when another process holds it
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    lock_file = open(path, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
 
 
 def parse_multi_columns(columns: str) -> list:
@@ -114,7 +371,12 @@ def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=N
         "history_metadata": history_metadata,
     }
 
+    finish_reason = None
     if len(chatCompletionChunk.choices) > 0:
+        ## read by the response caches, which keep only answers that completed
+        finish_reason = getattr(chatCompletionChunk.choices[0], "finish_reason", None)
+        if finish_reason:
+            response_obj["choices"][0]["finish_reason"] = finish_reason
         delta = chatCompletionChunk.choices[0].delta
         if delta:
             if hasattr(delta, "context"):
@@ -137,4 +399,4 @@ def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=N
                     response_obj["choices"][0]["messages"].append(messageObj)
                     return response_obj
 
-    return {}
+    return response_obj if finish_reason else {}
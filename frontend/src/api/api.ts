@@ -112,8 +112,8 @@ export async function conversationApi(options: ConversationRequest, abortSignal:
     formData.append("messages", JSON.stringify(options.messages));
     formData.append("gptModel", options.gptModel);
     if (options.file) {
-        options.file.forEach((file, index) => {
-            formData.append(`file${index}`, file);
+        options.file.forEach((file) => {
+            formData.append("file", file);
         });
     }
     console.log("formData: ", formData)
@@ -146,20 +146,20 @@ export const historyList = async (offset=0,idToken?:string): Promise<Conversatio
             return null;
         }
         const conversations: Conversation[] = await Promise.all(payload.map(async (conv: any) => {
-            let convMessages: ChatMessage[] = [];
-            convMessages = await historyRead(conv.id,idToken)
+            const convHistory = await historyRead(conv.id,idToken)
             .then((res) => {
                 return res
             })
             .catch((err) => {
                 console.error("error fetching messages: ", err)
-                return []
+                return { messages: [] }
             })
             const conversation: Conversation = {
                 id: conv.id,
                 title: conv.title,
                 date: conv.createdAt,
-                messages: convMessages
+                messages: convHistory.messages,
+                version: convHistory.version
             };
             return conversation;
         }));
@@ -172,7 +172,7 @@ export const historyList = async (offset=0,idToken?:string): Promise<Conversatio
     return response
 }
 
-export const historyRead = async (convId: string,idToken?:string): Promise<ChatMessage[]> => {
+export const historyRead = async (convId: string,idToken?:string): Promise<{ messages: ChatMessage[], version?: number }> => {
     const response = await fetch("/history/read", {
         method: "POST",
         body: JSON.stringify({
@@ -185,7 +185,7 @@ export const historyRead = async (convId: string,idToken?:string): Promise<ChatM
     })
     .then(async (res) => {
         if(!res){
-            return []
+            return { messages: [] }
         }
         const payload = await res.json();
         let messages: ChatMessage[] = [];
@@ -201,21 +201,29 @@ export const historyRead = async (convId: string,idToken?:string): Promise<ChatM
                 messages.push(message)
             });
         }
-        return messages;
+        // lets a reopened conversation send only its new messages
+        return { messages, version: payload?.version };
     }).catch((err) => {
         console.error("There was an issue fetching your data.");
-        return []
+        return { messages: [] }
     })
     return response
 }
 
 export const historyGenerate = async (options: ConversationRequest, abortSignal: AbortSignal, idToken?:string, convId?: string): Promise<Response> => {
+    // with a known version only the new message is sent, the server has the rest
+    const delta = !!convId && options.version !== undefined;
     var formData = new FormData();
-    formData.append("messages", JSON.stringify(options.messages));
+    if (delta) {
+        formData.append("message", JSON.stringify(options.messages[options.messages.length - 1]));
+        formData.append("version", String(options.version));
+    } else {
+        formData.append("messages", JSON.stringify(options.messages));
+    }
     formData.append("gptModel", options.gptModel);
     if (options.file) {
-        options.file.forEach((file, index) => {
-            formData.append(`file${index}`, file);
+        options.file.forEach((file) => {
+            formData.append("file", file);
         });
     }
     if(convId){
@@ -229,6 +237,10 @@ export const historyGenerate = async (options: ConversationRequest, abortSignal:
         body: formData,
         signal: abortSignal
     }).then((res) => {
+        // 409: the server history has moved on, send the whole conversation instead
+        if (delta && res.status === 409) {
+            return historyGenerate({ ...options, version: undefined }, abortSignal, idToken, convId)
+        }
         return res
     })
     .catch((err) => {
@@ -238,6 +250,27 @@ export const historyGenerate = async (options: ConversationRequest, abortSignal:
     return response
 }
 
+export const conversationResume = async (messageId: string, offset: number, abortSignal: AbortSignal, idToken?:string): Promise<Response> => {
+    // continue an interrupted /history/generate stream after the frames already received
+    const response = await fetch("/conversation/resume", {
+        method: "POST",
+        headers: {
+            "Authorization": `Bearer ${idToken}`,
+            "Content-Type": "application/json"
+        },
+        body: JSON.stringify({
+            message_id: messageId,
+            offset: offset
+        }),
+        signal: abortSignal
+    })
+    .catch((err) => {
+        console.error("There was an issue resuming the answer.");
+        return new Response;
+    })
+    return response
+}
+
 export const historyUpdate = async (messages: ChatMessage[], convId: string,idToken?:string): Promise<Response> => {
     const response = await fetch("/history/update", {
         method: "POST",
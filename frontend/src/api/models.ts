@@ -46,6 +46,8 @@ export type Conversation = {
     title: string;
     messages: ChatMessage[];
     date: string;
+    // number of user turns the server has, sent back for delta requests
+    version?: number;
 }
 
 export enum ChatCompletionType {
@@ -67,6 +69,7 @@ export type ChatResponse = {
         conversation_id: string;
         title: string;
         date: string;
+        version?: number;
     }
     error?: any;
 }
@@ -75,6 +78,7 @@ export type ConversationRequest = {
     messages: ChatMessage[];
     gptModel: string;
     file?: File[];
+    version?: number;
 };
 
 export type UserInfo = {
@@ -51,7 +51,7 @@ import {
   getUserInfo,
   Conversation,
   historyGenerate,
-  historyUpdate,
+  conversationResume,
   historyClear,
   ChatHistoryLoadingState,
   CosmosDBStatus,
@@ -84,6 +84,9 @@ const ExamplePrompts = [
   "プロンプト3",
 ];
 
+// reconnects to an answer whose stream dropped, see /conversation/resume
+const MAX_RESUME_ATTEMPTS = 3;
+
 const AuthChat = () => {
   const appStateContext = useContext(AppStateContext);
   const ui = appStateContext?.state.frontendSettings?.ui;
@@ -430,6 +433,7 @@ const AuthChat = () => {
           ],
           gptModel: gptModel,
           file: file ? file : undefined,
+          version: conversation.version,
         };
       }
     } else {
@@ -496,21 +500,56 @@ const AuthChat = () => {
         return;
       }
       if (response?.body) {
-        const reader = response.body.getReader();
+        let reader = response.body.getReader();
 
         let runningText = "";
+        // complete frames received, a resumed stream continues after them
+        let framesReceived = 0;
+        let messageId: string | undefined;
+        let resumeAttempts = 0;
         while (true) {
           setProcessMessages(messageStatus.Processing);
-          const { done, value } = await reader.read();
+          let chunk: ReadableStreamReadResult<Uint8Array>;
+          try {
+            chunk = await reader.read();
+          } catch (readError) {
+            // the connection dropped mid-answer, pick it up where it left off
+            if (abortController.signal.aborted || !messageId || resumeAttempts >= MAX_RESUME_ATTEMPTS) {
+              throw readError;
+            }
+            resumeAttempts += 1;
+            const resumed = await conversationResume(
+              messageId,
+              framesReceived,
+              abortController.signal,
+              user ? await user.getIdToken() : ""
+            );
+            if (!resumed.ok || !resumed.body) {
+              throw readError;
+            }
+            reader = resumed.body.getReader();
+            runningText = "";
+            continue;
+          }
+          const { done, value } = chunk;
           if (done) break;
 
           var text = new TextDecoder("utf-8").decode(value);
           const objects = text.split("\n");
           objects.forEach((obj) => {
             try {
-              if (obj !== "" && obj !== "{}") {
+              if (obj === "{}") {
+                framesReceived += 1;
+              } else if (obj !== "") {
                 runningText += obj;
                 result = JSON.parse(runningText);
+                framesReceived += 1;
+                messageId = result.id ?? messageId;
+                // late frame with the generated title of a new conversation
+                if (!result.choices && result.history_metadata) {
+                  runningText = "";
+                  return;
+                }
                 if (!result.choices?.[0]?.messages?.[0].content) {
                   errorResponseMessage = NO_CONTENT_ERROR;
                   throw Error();
@@ -567,12 +606,14 @@ const AuthChat = () => {
           isEmpty(toolMessage)
             ? resultConversation.messages.push(assistantMessage)
             : resultConversation.messages.push(toolMessage, assistantMessage);
+          resultConversation.version = result.history_metadata?.version;
         } else {
           resultConversation = {
             id: result.history_metadata.conversation_id,
             title: result.history_metadata.title,
             messages: [userMessage],
             date: result.history_metadata.date,
+            version: result.history_metadata.version,
           };
           isEmpty(toolMessage)
             ? resultConversation.messages.push(assistantMessage)
@@ -735,48 +776,12 @@ const AuthChat = () => {
   }, [appStateContext?.state.currentChat]);
 
   useLayoutEffect(() => {
-    const saveToDB = async (messages: ChatMessage[], id: string) => {
-      const idToken = user ? await user.getIdToken() : "";
-      const response = await historyUpdate(messages, id, idToken);
-      return response;
-    };
-
+    // /history/generate saves the reply on the server, so only local state is updated here
     if (
       appStateContext &&
       appStateContext.state.currentChat &&
       processMessages === messageStatus.Done
     ) {
-      if (appStateContext.state.isCosmosDBAvailable.cosmosDB) {
-        if (!appStateContext?.state.currentChat?.messages) {
-          console.error("Failure fetching current chat state.");
-          return;
-        }
-        // ここでエラーメッセージのフィルタリングを行わず、全メッセージを保存
-        saveToDB(
-          appStateContext.state.currentChat.messages,
-          appStateContext.state.currentChat.id
-        )
-          .then((res) => {
-            if (!res.ok) {
-              let errorMessage =
-                "エラーが発生しました。回答を保存できませんでした。問題が解決しない場合は、サイト管理者に連絡してください。";
-              let errorChatMsg: ChatMessage = {
-                id: uuid(),
-                role: ERROR,
-                content: errorMessage,
-                date: new Date().toISOString(),
-              };
-              setMessages([
-                ...(appStateContext?.state.currentChat?.messages || []),
-                errorChatMsg,
-              ]);
-            }
-            return res as Response;
-          })
-          .catch((err) => {
-            console.error("Error: ", err);
-          });
-      }
       appStateContext?.dispatch({
         type: "UPDATE_CHAT_HISTORY",
         payload: appStateContext.state.currentChat,
@@ -55,7 +55,9 @@ export const appStateReducer = (state: AppState, action: Action): AppState => {
             }
             const updatedCurrentChat = {
                 ...state.currentChat,
-                messages: []
+                messages: [],
+                // the server counts turns from zero again after a clear
+                version: 0
             };
             return {
                 ...state,
@@ -1,4 +1,5 @@
 import multiprocessing
+import os
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -9,5 +10,7 @@ timeout = 230
 # https://learn.microsoft.com/en-us/troubleshoot/azure/app-service/web-apps-performance-faqs#why-does-my-request-time-out-after-230-seconds
 
 num_cpus = multiprocessing.cpu_count()
-workers = (num_cpus * 2) + 1
+# Per-worker state (resumable streams, caches) is not shared between workers;
+# set WEB_CONCURRENCY=1 and scale out with sticky sessions to resume streams
+workers = int(os.environ.get("WEB_CONCURRENCY", (num_cpus * 2) + 1))
 worker_class = "uvicorn.workers.UvicornWorker"
\ No newline at end of file
@@ -0,0 +1,67 @@
+"""Micro-benchmark for encoding streamed chat frames.
+
+Compares the previous per-chunk json.dumps path with StreamFrameEncoder.
+Run from the repository root:
+
+    python -m scripts.bench_stream_frames
+"""
+import json
+import timeit
+
+from openai.types.chat import ChatCompletionChunk
+
+from backend.utils import JSONEncoder, StreamFrameEncoder, format_stream_response
+
+CHUNK_COUNT = 1000
+REPEAT = 5
+
+
+def build_chunks():
+    return [
+        ChatCompletionChunk.model_validate(
+            {
+                "id": "chatcmpl-benchmark",
+                "model": "gpt-4o",
+                "created": 1700000000,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"role": "assistant", "content": f"トークン{i} "},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+        )
+        for i in range(CHUNK_COUNT)
+    ]
+
+
+def main():
+    chunks = build_chunks()
+    history_metadata = {
+        "conversation_id": "00000000-0000-0000-0000-000000000000",
+        "title": "Benchmark conversation",
+        "date": "2024-01-01T00:00:00",
+    }
+    frames = [format_stream_response(chunk, history_metadata) for chunk in chunks]
+
+    def json_dumps_path():
+        for frame in frames:
+            json.dumps(frame, cls=JSONEncoder) + "\n"
+
+    def frame_encoder_path():
+        encoder = StreamFrameEncoder()
+        for frame in frames:
+            encoder.encode(frame)
+
+    for name, func in [
+        ("json.dumps", json_dumps_path),
+        ("StreamFrameEncoder", frame_encoder_path),
+    ]:
+        best = min(timeit.repeat(func, number=10, repeat=REPEAT)) / (10 * CHUNK_COUNT)
+        print(f"{name:>20}: {best * 1e6:.2f} us/frame")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import asyncio
+import pytest
+from backend.llm.admission import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_PREMIUM,
+    PRIORITY_STANDARD,
+    AdmissionController,
+    AdmissionRejected,
+    priority_from_claims,
+)
+
+
+@pytest.mark.asyncio
+async def test_per_user_cap_queues_until_release():
+    controller = AdmissionController(max_concurrency=2, max_per_user=1, max_queue=2, queue_timeout=1)
+    first = await controller.acquire("alice")
+    waiting = asyncio.create_task(controller.acquire("alice"))
+    await asyncio.sleep(0)
+    # bob is not held up by alice's queued request
+    other = await controller.acquire("bob")
+    assert controller.stats()["queue_depth"] == 1
+
+    first.release()
+    second = await waiting
+    assert second.user_id == "alice"
+    second.release()
+    other.release()
+    assert controller.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_queue_full_or_timed_out():
+    controller = AdmissionController(max_concurrency=1, max_per_user=0, max_queue=1, queue_timeout=0.01)
+    slot = await controller.acquire("alice")
+    waiting = asyncio.create_task(controller.acquire("bob"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("carol")
+    assert rejected.value.status_code == 429
+    assert rejected.value.retry_after >= 1
+    with pytest.raises(AdmissionRejected):
+        await waiting
+
+    slot.release()
+    assert controller.stats()["rejected"] == {"queue_full": 1, "queue_timeout": 1}
+    assert controller.stats()["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_slot_held_until_stream_closed():
+    controller = AdmissionController(max_concurrency=1)
+
+    async def stream():
+        yield "a"
+        yield "b"
+
+    slot = await controller.acquire("alice")
+    held = slot.hold(stream())
+    assert await held.__anext__() == "a"
+    assert controller.active == 1
+    await held.aclose()
+    assert controller.active == 0
+
+    # a stream that is never iterated releases its slot once dropped
+    slot = await controller.acquire("alice")
+    held = slot.hold(stream())
+    del held
+    assert controller.active == 0
+
+
+@pytest.mark.asyncio
+async def test_priority_order_reserve_and_shedding():
+    controller = AdmissionController(max_concurrency=2, max_per_user=0, max_queue=2, queue_timeout=1,
+                                     reserved=1)
+    standard = await controller.acquire("alice", PRIORITY_STANDARD)
+    # the last slot is kept for premium requests
+    title = asyncio.create_task(controller.acquire("bob", PRIORITY_BACKGROUND))
+    later = asyncio.create_task(controller.acquire("carol", PRIORITY_STANDARD))
+    await asyncio.sleep(0)
+    premium = await controller.acquire("dave", PRIORITY_PREMIUM)
+
+    # a full queue sheds the background waiter for a premium one
+    queued_premium = asyncio.create_task(controller.acquire("erin", PRIORITY_PREMIUM))
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected) as shed:
+        await title
+    assert shed.value.reason == "shed"
+
+    premium.release()
+    erin = await queued_premium
+    standard.release()
+    # with one slot reserved, standard requests run only while nothing else does
+    assert not later.done()
+    erin.release()
+    assert (await later).user_id == "carol"
+    assert controller.stats()["rejected"] == {"shed": 1}
+
+
+def test_priority_from_claims():
+    claim_priorities = {"admin": 3, "level=premium": 2}
+    assert priority_from_claims({"admin": True, "level": "premium"}, claim_priorities) == 3
+    assert priority_from_claims({"admin": False, "level": "premium"}, claim_priorities) == 2
+    assert priority_from_claims({"level": "user"}, claim_priorities) == PRIORITY_STANDARD
@@ -0,0 +1,555 @@
+import asyncio
+import io
+import httpx
+import openai
+import pytest
+from werkzeug.datastructures import FileStorage
+import app
+from backend.llm.resilience import CircuitBreaker
+from backend.llm.router import Deployment, DeploymentRouter
+
+
+@pytest.mark.asyncio
+async def test_openai_client_is_reused(monkeypatch):
+    monkeypatch.setattr(app, "OPENAI_API_KEY", "test-key")
+    monkeypatch.setattr(app, "openai_clients", {})
+
+    client = app.get_deployment_client(app.llm_router.choose("gpt-4o"))
+    assert app.get_deployment_client(app.llm_router.choose("gpt-4")) is client
+    assert app.get_openai_client("openai") is client
+
+    await app.close_openai_clients()
+    assert app.openai_clients == {}
+
+
+def test_llm_router_default_deployments():
+    assert app.llm_router.choose("az-gpt-4").backend == "azure"
+    assert app.llm_router.choose("gpt-4").backend == "openai"
+    assert app.llm_router.choose(None).model == "gpt-3.5-turbo-0125"
+
+
+@pytest.mark.asyncio
+async def test_cosmosdb_client_is_shared(monkeypatch):
+    monkeypatch.setattr(app, "AZURE_COSMOSDB_ACCOUNT", "test-account")
+    monkeypatch.setattr(app, "AZURE_COSMOSDB_ACCOUNT_KEY", "dGVzdC1rZXk=")
+    monkeypatch.setattr(app, "cosmosdb_clients", {})
+
+    conversation_client = app.init_conversation_cosmosdb_client()
+    prompt_client = app.init_prompt_cosmosdb_client()
+    assert app.init_conversation_cosmosdb_client() is conversation_client
+    assert conversation_client.cosmosdb_client is prompt_client.cosmosdb_client
+
+    await app.close_cosmosdb_clients()
+    assert app.cosmosdb_clients == {}
+
+
+@pytest.mark.asyncio
+async def test_warm_up_reports_each_step(monkeypatch):
+    class Models():
+        async def list(self):
+            raise httpx.ConnectError("no route to host")
+
+    class Client():
+        models = Models()
+
+        async def close(self):
+            pass
+
+    monkeypatch.setattr(app, "openai_clients", {"openai": Client()})
+    monkeypatch.setattr(app, "cosmosdb_clients", {})
+    monkeypatch.setattr(app, "warmup_state", {"ready": False, "duration_ms": None, "steps": {}})
+    monkeypatch.delenv("FIREBASE_PRIVATE_KEY", raising=False)
+
+    # a failed step is logged and left to the first request, it does not stop the worker
+    await app.warm_up()
+    assert app.warmup_state["steps"] == {"openai": "failed", "tokenizers": "ok"}
+    assert app.warmup_state["duration_ms"] is not None
+
+    # readiness is only reported once the worker has warmed up
+    test_app = app.create_app()
+    assert (await test_app.test_client().get("/ready")).status_code == 503
+    async with test_app.test_app() as serving:
+        assert (await serving.test_client().get("/ready")).status_code == 200
+    assert not app.warmup_state["ready"]
+
+
+@pytest.mark.asyncio
+async def test_send_chat_request_fails_over_on_rate_limit(monkeypatch):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    rate_limited = openai.RateLimitError(
+        "rate limited",
+        response=httpx.Response(429, headers={"retry-after": "30"}, request=request),
+        body=None,
+    )
+
+    class FakeCompletions:
+        def __init__(self, name):
+            self.name = name
+
+        async def create(self, **kwargs):
+            if self.name == "primary":
+                raise rate_limited
+            return {"model": kwargs["model"]}
+
+    class FakeClient:
+        def __init__(self, name):
+            self.chat = type("Chat", (), {"completions": FakeCompletions(name)})()
+
+    router = DeploymentRouter(
+        {
+            "gpt-4o": [
+                Deployment(name="primary", backend="openai", model="gpt-4o", breaker=CircuitBreaker()),
+                Deployment(name="secondary", backend="azure", model="gpt-4o-2", breaker=CircuitBreaker()),
+            ]
+        },
+        explore_ratio=0,
+    )
+    monkeypatch.setattr(app, "llm_router", router)
+    monkeypatch.setattr(app, "get_deployment_client", lambda deployment: FakeClient(deployment.name))
+
+    response, deployment, _ = await app.send_chat_request(
+        {"gptModel": "gpt-4o"}, model_args={"messages": []}
+    )
+    assert response == {"model": "gpt-4o-2"}
+    assert deployment.name == "secondary"
+    assert router.deployments["gpt-4o"][0].breaker.state() == "open"
+
+
+@pytest.mark.asyncio
+async def test_rejected_request_does_not_count_against_the_deployment(monkeypatch):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    bad_request = openai.BadRequestError(
+        "content filtered", response=httpx.Response(400, request=request), body=None)
+
+    class FakeCompletions:
+        async def create(self, **kwargs):
+            raise bad_request
+
+    class FakeClient:
+        chat = type("Chat", (), {"completions": FakeCompletions()})()
+
+    router = DeploymentRouter(
+        {"gpt-4o": [Deployment(name="primary", backend="openai", model="gpt-4o", breaker=CircuitBreaker())]},
+        explore_ratio=0,
+    )
+    monkeypatch.setattr(app, "llm_router", router)
+    monkeypatch.setattr(app, "get_deployment_client", lambda deployment: FakeClient())
+
+    with pytest.raises(openai.BadRequestError):
+        await app.send_chat_request({"gptModel": "gpt-4o"}, model_args={"messages": []})
+    assert router.deployments["gpt-4o"][0].error_rate() == 0
+
+
+@pytest.mark.asyncio
+async def test_title_is_sent_as_late_frame():
+    async def stream():
+        yield {"choices": [{"messages": [{"role": "assistant", "content": "Hi"}]}]}
+
+    async def title():
+        return "Greeting"
+
+    history_metadata = {"conversation_id": "1", "title": "hello"}
+    title_task = app.run_in_background(title())
+    frames = [frame async for frame in app.stream_with_title(stream(), title_task, history_metadata)]
+
+    assert frames[-1] == {"history_metadata": {"conversation_id": "1", "title": "Greeting"}}
+    assert history_metadata["title"] == "hello"
+    assert not app.background_tasks
+
+
+@pytest.mark.asyncio
+async def test_history_write_failure_is_reported_in_stream():
+    class FakeConversationClient:
+        async def create_conversation(self, **conversation):
+            return conversation
+
+        async def create_message(self, **message):
+            return "Conversation not found"
+
+    async def stream():
+        yield {"choices": [{"messages": [{"role": "assistant", "content": "Hi"}]}]}
+
+    history_task = app.run_in_background(app.save_user_message(
+        FakeConversationClient(), "user", "1", {"role": "user", "content": "hello"}, 0))
+    frames = [frame async for frame in app.format_as_ndjson(
+        app.stream_after_history(stream(), history_task))]
+
+    assert frames == ['{"error": "Conversation not found for the given conversation ID: 1."}']
+
+
+@pytest.mark.asyncio
+async def test_upstream_is_closed_when_history_write_fails(monkeypatch):
+    class FakeStream():
+        closed = False
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            raise StopAsyncIteration
+
+        async def close(self):
+            self.closed = True
+
+    deployment = Deployment("openai", "openai", "gpt-4o")
+    upstream = FakeStream()
+
+    async def send_chat_request(request_body, model_args):
+        deployment.in_flight += 1
+        return upstream, deployment, None
+
+    async def fail():
+        raise Exception("Conversation not found")
+
+    monkeypatch.setattr(app, "send_chat_request", send_chat_request)
+    monkeypatch.setattr(app, "response_cache", None)
+    monkeypatch.setattr(app, "semantic_cache", None)
+    controller = app.AdmissionController(max_concurrency=1)
+    slot = await controller.acquire("user")
+
+    result = await app.stream_chat_request({"messages": [{"role": "user", "content": "hello"}]})
+    result = app.stream_after_history(slot.hold(result), app.run_in_background(fail()))
+    frames = [frame async for frame in app.format_as_ndjson(result)]
+
+    # the answer was never read, but the upstream and the slot are released anyway
+    assert frames == ['{"error": "Conversation not found"}']
+    assert upstream.closed
+    assert deployment.in_flight == 0
+    assert controller.stats()["active"] == 0
+
+
+@pytest.mark.asyncio
+async def test_reply_is_saved_when_stream_is_cancelled():
+    saved = []
+
+    class FakeConversationClient:
+        async def create_message(self, **message):
+            saved.append(message)
+
+    async def stream():
+        yield {"id": "chatcmpl-1", "choices": [{"messages": [{"role": "tool", "content": "{}"}]}]}
+        yield {"id": "chatcmpl-1", "choices": [{"messages": [{"role": "assistant", "content": "Hel"}]}]}
+        yield {"id": "chatcmpl-1", "choices": [{"messages": [{"role": "assistant", "content": "lo"}]}]}
+        yield {"id": "chatcmpl-1", "choices": [{"messages": [{"role": "assistant", "content": "!"}]}]}
+
+    history_task = app.run_in_background(asyncio.sleep(0))
+    reply = app.record_reply(stream(), FakeConversationClient(), "user", "1", "cl100k_base", history_task)
+    ids = {(await reply.__anext__())["id"] for _ in range(3)}
+    await reply.aclose()
+    await asyncio.gather(*app.background_tasks)
+
+    # the reply is sent and saved under its own id, never the completion id
+    [reply_id] = ids
+    assert reply_id != "chatcmpl-1"
+    assert [message["uuid"] for message in saved] == [f"{reply_id}-tool", reply_id]
+    assert saved[1]["input_message"] == {"role": "assistant", "content": "Hello"}
+
+    # a cached answer replayed in another conversation gets another id
+    saved.clear()
+    history_task = app.run_in_background(asyncio.sleep(0))
+    async for _ in app.record_reply(stream(), FakeConversationClient(), "user", "2", "cl100k_base",
+                                    history_task):
+        pass
+    await asyncio.gather(*app.background_tasks)
+    assert saved[1]["uuid"] not in (reply_id, "chatcmpl-1")
+
+
+@pytest.mark.asyncio
+async def test_conversation_tail_is_reloaded_or_rejected_by_version(monkeypatch):
+    class History():
+        def __init__(self):
+            self.reads = 0
+
+        async def get_history_generation(self, user_id, conversation_id):
+            return 0
+
+        async def get_messages(self, user_id, conversation_id):
+            self.reads += 1
+            return [
+                {"role": "user", "content": "hi", "createdAt": "2024-05-01T00:00:01"},
+                {"role": "assistant", "content": "hello", "createdAt": "2024-05-01T00:00:02"},
+            ]
+
+    history = History()
+    monkeypatch.setattr(app, "conversation_tails", app.ConversationTailCache())
+    tail = await app.load_conversation_tail(history, "u", "c1", 1)
+    assert tail["messages"][-1] == {"role": "assistant", "content": "hello"}
+    assert (await app.load_conversation_tail(history, "u", "c1", 1)) is tail
+    assert history.reads == 1
+
+    # a client ahead of this worker makes it reload, one behind is told to resend
+    with pytest.raises(app.StaleHistoryError):
+        await app.load_conversation_tail(history, "u", "c1", 2)
+    assert history.reads == 2
+    app.conversation_tails.append("u", "c1", {"role": "user", "content": "from another tab"})
+    with pytest.raises(app.StaleHistoryError) as error:
+        await app.load_conversation_tail(history, "u", "c1", 1)
+    assert error.value.version == 2
+
+
+@pytest.mark.asyncio
+async def test_conversation_tail_cleared_on_another_worker_is_reloaded(monkeypatch):
+    class History():
+        def __init__(self):
+            self.generation = 0
+            self.messages = [
+                {"role": "user", "content": "secret", "createdAt": "2024-05-01T00:00:01"},
+                {"role": "assistant", "content": "noted", "createdAt": "2024-05-01T00:00:02"},
+            ]
+
+        async def get_history_generation(self, user_id, conversation_id):
+            return self.generation
+
+        async def get_messages(self, user_id, conversation_id):
+            return list(self.messages)
+
+    history = History()
+    monkeypatch.setattr(app, "conversation_tails", app.ConversationTailCache())
+    await app.load_conversation_tail(history, "u", "c1", 1)
+
+    # another worker clears the conversation and answers one new turn
+    history.generation = 1
+    history.messages = [
+        {"role": "user", "content": "fresh start", "createdAt": "2024-05-02T00:00:01"},
+        {"role": "assistant", "content": "ok", "createdAt": "2024-05-02T00:00:02"},
+    ]
+    tail = await app.load_conversation_tail(history, "u", "c1", 1)
+    assert [message["content"] for message in tail["messages"]] == ["fresh start", "ok"]
+
+
+@pytest.mark.asyncio
+async def test_summary_is_updated_incrementally(monkeypatch):
+    class History():
+        def __init__(self):
+            self.summary = {"content": "turn one", "summarizedTurns": 1}
+
+        async def get_messages(self, user_id, conversation_id):
+            messages = []
+            for turn in range(1, 7):
+                messages.append({"role": "user", "content": f"q{turn}", "createdAt": f"{turn}a"})
+                messages.append({"role": "assistant", "content": f"a{turn}", "createdAt": f"{turn}b"})
+            return messages
+
+        async def upsert_summary(self, user_id, conversation_id, content, summarized_turns, generation):
+            self.summary = {"content": content, "summarizedTurns": summarized_turns}
+            return self.summary
+
+    sent = []
+
+    async def send_chat_request(request_body, model_args):
+        sent.append(model_args["messages"][1]["content"])
+        message = openai.types.chat.ChatCompletionMessage(role="assistant", content="turns one to four")
+        return type("Response", (), {"choices": [type("Choice", (), {"message": message})]}), None, None
+
+    async def saved():
+        return 0
+
+    history = History()
+    monkeypatch.setattr(app, "send_chat_request", send_chat_request)
+    monkeypatch.setattr(app, "admission_controller", None)
+    monkeypatch.setattr(app, "conversation_summaries", app.SummaryCache())
+    monkeypatch.setattr(app, "SUMMARY_KEEP_TURNS", 2)
+    monkeypatch.setattr(app, "SUMMARY_TRIGGER_TOKENS", 0)
+    messages = (await history.get_messages("u", "c1"))[2:]
+
+    app.maybe_update_summary(history, "u", "c1", messages, history.summary, 6, "cl100k_base",
+                             asyncio.ensure_future(saved()), 0)
+    # one job per conversation at a time
+    app.maybe_update_summary(history, "u", "c1", messages, history.summary, 6, "cl100k_base",
+                             asyncio.ensure_future(saved()), 0)
+    await asyncio.gather(*app.background_tasks)
+
+    assert len(sent) == 1
+    assert sent[0].startswith("Summary so far:\nturn one\n\nNew turns:\nuser: q2")
+    assert "q4" in sent[0] and "q5" not in sent[0]
+    assert history.summary == {"content": "turns one to four", "summarizedTurns": 4}
+    assert app.conversation_summaries.get(("u", "c1")) == (True, history.summary)
+
+
+@pytest.mark.asyncio
+async def test_summary_cached_before_a_clear_elsewhere_is_not_applied(monkeypatch):
+    class History():
+        def __init__(self):
+            self.summary = {"content": "old secrets", "summarizedTurns": 8, "historyGeneration": 0}
+
+        async def get_summary(self, user_id, conversation_id):
+            return self.summary
+
+    history = History()
+    monkeypatch.setattr(app, "conversation_summaries", app.SummaryCache())
+    assert await app.get_conversation_summary(history, "u", "c1", 0) == history.summary
+
+    # another worker clears the conversation, but a summary job still writes
+    history.summary = dict(history.summary)
+    assert await app.get_conversation_summary(history, "u", "c1", 1) is None
+    history.summary = None
+    assert await app.get_conversation_summary(history, "u", "c1", 1) is None
+
+
+@pytest.mark.asyncio
+async def test_resume_replays_the_rest_of_a_stream(monkeypatch):
+    async def frames():
+        for index in range(3):
+            yield {"id": "chatcmpl-1", "index": index}
+
+    monkeypatch.setattr(app, "replay_store", app.ReplayStore())
+    monkeypatch.setattr(app, "get_authenticated_user_details",
+                        lambda request_headers: {"user_principal_id": "alice"})
+    await app.replay_store.start("alice", frames()).aclose()
+    await asyncio.sleep(0.01)
+
+    client = app.create_app().test_client()
+    response = await client.post("/conversation/resume", json={"message_id": "chatcmpl-1", "offset": 1})
+    assert response.status_code == 200
+    body = await response.get_data(as_text=True)
+    assert [line for line in body.splitlines() if line] == [
+        '{"id": "chatcmpl-1", "index": 1}', '{"id": "chatcmpl-1", "index": 2}']
+
+    response = await client.post("/conversation/resume", json={"message_id": "chatcmpl-2"})
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_single_flight_key_tells_a_repeat_from_a_retry():
+    message = {"role": "user", "content": "yes"}
+    async with app.create_app().test_request_context("/history/generate", method="POST"):
+        retry = app.single_flight_key("u", "c1", "gpt-4o", "3", message, None)
+        assert app.single_flight_key("u", "c1", "gpt-4o", "3", dict(message), None) == retry
+        # the same words one turn later are a new question
+        assert app.single_flight_key("u", "c1", "gpt-4o", "4", message, None) != retry
+
+
+@pytest.mark.asyncio
+async def test_attachment_conversation_is_admission_controlled(monkeypatch, tmp_path):
+    controller = app.AdmissionController(max_concurrency=1, max_queue=0)
+    await controller.acquire("someone else")
+    monkeypatch.setattr(app, "admission_controller", controller)
+    monkeypatch.setattr(app, "attachment_store",
+                        app.AttachmentStore(app.LocalBlobContainer(str(tmp_path))))
+    monkeypatch.setattr(app, "get_authenticated_user_details",
+                        lambda request_headers: {"user_principal_id": "alice"})
+
+    client = app.create_app().test_client()
+    response = await client.post("/conversation", form={
+        "messages": '[{"role": "user", "content": "hello"}]',
+        "gptModel": "gpt-4o",
+    }, files={"file": FileStorage(io.BytesIO(b"notes"), "notes.txt", content_type="text/plain")})
+    assert response.status_code == 429
+    assert controller.stats()["active"] == 1
+
+
+@pytest.mark.asyncio
+async def test_every_file_the_ui_attaches_reaches_the_model(monkeypatch, tmp_path):
+    # the chat page appends each selected file as a "file" field
+    sent = {}
+
+    async def stream_chat_request(request_body):
+        sent.update(request_body)
+
+        async def frames():
+            yield {"id": "1"}
+
+        return frames()
+
+    monkeypatch.setattr(app, "admission_controller", None)
+    monkeypatch.setattr(app, "attachment_store",
+                        app.AttachmentStore(app.LocalBlobContainer(str(tmp_path))))
+    monkeypatch.setattr(app, "stream_chat_request", stream_chat_request)
+
+    body = b"".join(
+        b"--b\r\nContent-Disposition: form-data; name=" + name + b"\r\n" + headers + b"\r\n" + value + b"\r\n"
+        for name, headers, value in [
+            (b'"messages"', b"", b'[{"role": "user", "content": "compare"}]'),
+            (b'"gptModel"', b"", b"gpt-4o"),
+            (b'"file"; filename="a.txt"', b"Content-Type: text/plain\r\n", b"first"),
+            (b'"file"; filename="b.txt"', b"Content-Type: text/plain\r\n", b"second"),
+        ]
+    ) + b"--b--\r\n"
+    client = app.create_app().test_client()
+    response = await client.post("/conversation", data=body, headers={
+        "Content-Type": "multipart/form-data; boundary=b"})
+    assert response.status_code == 200
+    assert [file.filename for file in sent["files"]] == ["a.txt", "b.txt"]
+
+
+@pytest.mark.asyncio
+async def test_new_attachment_is_indexed_in_the_background(monkeypatch):
+    calls = {"active": 0, "peak": 0, "texts": 0}
+
+    class FakeEmbeddings:
+        async def create(self, model, input):
+            calls["active"] += 1
+            calls["peak"] = max(calls["peak"], calls["active"])
+            calls["texts"] += len(input)
+            await asyncio.sleep(0.01)
+            calls["active"] -= 1
+            return type("Response", (), {"data": [
+                type("Item", (), {"embedding": [1.0, 0.0]})() for _ in input]})()
+
+    class FakeClient:
+        embeddings = FakeEmbeddings()
+
+    monkeypatch.setattr(app, "get_openai_client", lambda backend: FakeClient())
+    monkeypatch.setattr(app, "get_embedding_deployment", lambda: "embedding")
+    monkeypatch.setattr(app, "attachment_index", app.AttachmentIndex())
+    monkeypatch.setattr(app, "attachment_embedding_slots", asyncio.Semaphore(2))
+    monkeypatch.setattr(app, "ATTACHMENT_INDEX_MAX_CHUNKS", 100)
+
+    file = type("Upload", (), {"sha256": "abc", "filename": "big.txt"})()
+    chunks = [f"chunk {number}" for number in range(1000)]
+    request_body = {
+        "user_id": "u",
+        "messages": [{"role": "user", "content": "what does it say?"}],
+        "history_metadata": {"conversation_id": "c1"},
+    }
+    # this turn falls back to the first chunks instead of waiting for the index
+    assert await app.search_attachment_index(request_body, [(file, chunks)]) is None
+    assert await app.search_attachment_index(request_body, [(file, chunks)]) is None
+    await asyncio.gather(*app.background_tasks)
+
+    assert calls["texts"] == 100
+    assert calls["peak"] == 2
+    assert len(await app.search_attachment_index(request_body, [(file, chunks)])) > 0
+
+
+@pytest.mark.asyncio
+async def test_slow_question_embedding_skips_attachment_retrieval(monkeypatch):
+    async def embed_texts(texts):
+        await asyncio.sleep(1)
+        return [[1, 0]]
+
+    index = app.AttachmentIndex()
+    await index.add("u:c1", "abc", "a.txt", ["chunk"], [[1, 0]])
+    monkeypatch.setattr(app, "attachment_index", index)
+    monkeypatch.setattr(app, "embed_texts", embed_texts)
+    monkeypatch.setattr(app, "ATTACHMENT_INDEX_EMBEDDING_TIMEOUT", 0.01)
+
+    request_body = {
+        "user_id": "u",
+        "messages": [{"role": "user", "content": "what does it say?"}],
+        "history_metadata": {"conversation_id": "c1"},
+    }
+    assert await app.search_attachment_index(request_body, []) is None
+
+
+@pytest.mark.asyncio
+async def test_empty_completion_still_gets_the_title(monkeypatch):
+    async def complete_chat_request(request_body):
+        return {}
+
+    async def title():
+        return "Greeting"
+
+    async def saved():
+        return 0
+
+    monkeypatch.setattr(app, "SHOULD_STREAM", False)
+    monkeypatch.setattr(app, "admission_controller", None)
+    monkeypatch.setattr(app, "complete_chat_request", complete_chat_request)
+    request_body = {"messages": [], "history_metadata": {"conversation_id": "c1"}}
+    async with app.create_app().test_request_context("/history/generate", method="POST"):
+        response = await app.conversation_internal(
+            request_body, user_id="u", title_task=app.run_in_background(title()),
+            history_task=app.run_in_background(saved()))
+    assert await response.get_json() == {
+        "history_metadata": {"conversation_id": "c1", "title": "Greeting"}}
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+from backend.attachments.index import AttachmentIndex, ConversationIndex
+
+
+def test_search_returns_closest_chunks_in_document_order():
+    index = ConversationIndex()
+    index.add("abc", "notes.txt", ["cats", "dogs", "cars", "cat food"],
+              [[1, 0, 0], [0, 1, 0], [0, 0, 1], [0.9, 0.1, 0]])
+
+    assert [chunk["text"] for chunk in index.search([1, 0, 0], 2)] == ["cats", "cat food"]
+    assert index.has_file("abc")
+    assert not index.has_file("def")
+
+
+@pytest.mark.asyncio
+async def test_indexes_are_evicted_and_reloaded_from_disk(tmp_path):
+    indexes = AttachmentIndex(max_conversations=1, persist_dir=str(tmp_path))
+    await indexes.add("u:1", "abc", "a.txt", ["first"], [[1, 0]])
+    await indexes.add("u:2", "def", "b.txt", ["second"], [[0, 1]])
+    assert indexes.stats()["conversations"] == 1
+    assert indexes.stats()["evictions"] == 1
+
+    reloaded = await indexes.get("u:1")
+    assert reloaded.chunks == [{"sha256": "abc", "filename": "a.txt", "text": "first"}]
+    assert np.allclose(reloaded.vectors, [[1, 0]])
+    assert indexes.stats()["loads"] == 1
+
+    await indexes.discard("u:1")
+    assert await indexes.get("u:1") is None
+
+
+@pytest.mark.asyncio
+async def test_memory_only_index_is_bounded_by_bytes():
+    indexes = AttachmentIndex(max_bytes=100)
+    await indexes.add("u:1", "abc", "a.txt", ["x" * 60], [[1, 0]])
+    await indexes.add("u:2", "def", "b.txt", ["y" * 60], [[0, 1]])
+
+    assert await indexes.get("u:1") is None
+    assert (await indexes.get("u:2")).has_file("def")
+    assert indexes.stats()["bytes"] <= 100
+
+
+@pytest.mark.asyncio
+async def test_workers_drop_indexes_cleared_by_another_worker(tmp_path):
+    first = AttachmentIndex(persist_dir=str(tmp_path))
+    second = AttachmentIndex(persist_dir=str(tmp_path))
+    await first.add("u:1", "abc", "a.txt", ["old"], [[1, 0]])
+    assert (await second.get("u:1")).has_file("abc")
+
+    await first.discard("u:1")
+    assert await second.get("u:1") is None
+
+    await first.add("u:1", "def", "b.txt", ["new"], [[0, 1]])
+    index = await second.get("u:1")
+    assert not index.has_file("abc") and index.has_file("def")
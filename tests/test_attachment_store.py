@@ -0,0 +1,38 @@
+import hashlib
+import pytest
+from backend.attachments.store import AttachmentStore, LocalBlobContainer
+from backend.attachments.upload import SpooledUpload
+
+
+def spooled(tmp_path, name, content):
+    path = tmp_path / name
+    path.write_bytes(content)
+    return SpooledUpload(str(path), name, "text/plain", len(content),
+                         sha256=hashlib.sha256(content).hexdigest())
+
+
+@pytest.mark.asyncio
+async def test_identical_uploads_are_stored_once(tmp_path):
+    store = AttachmentStore(LocalBlobContainer(str(tmp_path / "store")))
+    first = await store.put(spooled(tmp_path, "a.txt", b"same content"))
+    second = await store.put(spooled(tmp_path, "b.txt", b"same content"))
+
+    assert first["sha256"] == second["sha256"]
+    assert second["filename"] == "b.txt"
+    assert store.stats()["writes"] == 1
+    assert store.stats()["dedupe_hits"] == 1
+    assert await store.get(first["sha256"]) == b"same content"
+
+
+@pytest.mark.asyncio
+async def test_garbage_collection_keeps_referenced_and_recent_blobs(tmp_path):
+    store = AttachmentStore(LocalBlobContainer(str(tmp_path / "store")), grace_period=0)
+    kept = await store.put(spooled(tmp_path, "a.txt", b"referenced"))
+    await store.put(spooled(tmp_path, "b.txt", b"orphaned"))
+
+    assert await store.collect_garbage([kept["sha256"]]) == 1
+    assert [blob["name"] for blob in await store.container.list_blobs()] == [kept["sha256"]]
+
+    store.grace_period = 3600
+    await store.put(spooled(tmp_path, "c.txt", b"just uploaded"))
+    assert await store.collect_garbage([kept["sha256"]]) == 0
@@ -0,0 +1,53 @@
+from backend.llm.context import ModelSpec, TokenCounter, get_model_spec, pack_messages
+
+
+class WordCounter(TokenCounter):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def count_text(self, text, encoding):
+        self.calls += 1
+        return len(text.split())
+
+
+def _messages(turns):
+    messages = [{"role": "system", "content": "system prompt"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i} " + "word " * 10})
+        messages.append({"role": "assistant", "content": f"answer {i} " + "word " * 10})
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+
+def test_pack_messages_keeps_everything_that_fits():
+    spec = ModelSpec(context_window=1000, encoding="cl100k_base", output_reserve=100, max_output_tokens=200)
+    messages = _messages(3)
+    packed, max_tokens, prompt_tokens = pack_messages(messages, spec, 10000, WordCounter())
+    assert packed == messages
+    assert max_tokens == 200
+    assert prompt_tokens < 1000
+
+
+def test_pack_messages_drops_oldest_turns():
+    spec = ModelSpec(context_window=120, encoding="cl100k_base", output_reserve=20, max_output_tokens=200)
+    messages = _messages(5)
+    packed, max_tokens, prompt_tokens = pack_messages(messages, spec, 10000, WordCounter())
+
+    assert packed[0] == messages[0]
+    assert packed[-1] == messages[-1]
+    assert packed[1]["role"] == "user"
+    assert len(packed) < len(messages)
+    assert prompt_tokens <= 120 - 20
+    assert max_tokens == 120 - prompt_tokens
+
+
+def test_message_token_counts_are_cached():
+    counter = WordCounter()
+    message = {"role": "user", "content": "hello world"}
+    assert counter.count_message(message, "cl100k_base") == counter.count_message(dict(message), "cl100k_base")
+    assert counter.calls == 2
+
+
+def test_unknown_model_uses_default_spec():
+    assert get_model_spec("unknown") == get_model_spec("gpt-3.5-turbo-0125")
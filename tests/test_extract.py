@@ -0,0 +1,47 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from backend.attachments.extract import AttachmentExtractor
+from backend.attachments.upload import SpooledUpload
+
+calls = []
+
+
+def slow_parse(path, filename, num_tokens, token_overlap):
+    calls.append(filename)
+    time.sleep(0.05)
+    return {"chunks": ["hello", "world"]}
+
+
+@pytest.mark.asyncio
+async def test_extraction_is_cached_by_content_hash(tmp_path):
+    calls.clear()
+    extractor = AttachmentExtractor(executor=ThreadPoolExecutor(max_workers=2), parse=slow_parse)
+    path = tmp_path / "notes.txt"
+    path.write_text("hello world")
+    first = SpooledUpload(str(path), "notes.txt", "text/plain", 11, sha256="abc")
+    again = SpooledUpload(str(path), "copy.txt", "text/plain", 11, sha256="abc")
+
+    # concurrent requests for the same file share one parse
+    results = await asyncio.gather(extractor.extract(first), extractor.extract(again))
+    assert results[0] == results[1] == {"chunks": ["hello", "world"]}
+    assert (await extractor.extract(again))["chunks"] == ["hello", "world"]
+
+    assert calls == ["notes.txt"]
+    assert extractor.stats() == {"entries": 1, "size": 10, "hits": 2, "misses": 1, "errors": 0}
+    extractor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_cache_is_bounded_by_chunk_size(tmp_path):
+    def parse(path, filename, num_tokens, token_overlap):
+        return {"chunks": [filename * 10]}
+
+    extractor = AttachmentExtractor(executor=ThreadPoolExecutor(max_workers=1), max_size=25, parse=parse)
+    for name in ("a", "b", "c"):
+        await extractor.extract(SpooledUpload(str(tmp_path / name), name, "text/plain", 1, sha256=name))
+    # three 10-character results do not fit in 25, the least recently used one goes
+    assert extractor.stats()["entries"] == 2
+    assert extractor.stats()["size"] == 20
+    extractor.shutdown()
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from backend.attachments.image import (
+    ImagePreprocessor,
+    estimate_image_tokens,
+    fit_image,
+    prepare_image,
+)
+from backend.attachments.upload import SpooledUpload
+
+
+def test_images_are_fitted_to_the_tile_budget():
+    # a 12MP phone photo is seen as 1024x768, four tiles
+    assert fit_image(4032, 3024) == (1024, 768)
+    assert estimate_image_tokens(4032, 3024) == 765
+    assert fit_image(300, 200) == (300, 200)
+    assert fit_image(4032, 3024, detail="low") == (512, 384)
+
+    width, height = fit_image(4032, 3024, max_tiles=2)
+    assert estimate_image_tokens(width, height) == 425
+
+
+@pytest.mark.asyncio
+async def test_prepared_images_are_cached_by_content_hash(tmp_path):
+    calls = []
+
+    def prepare(path, detail, max_tiles, output_format, quality):
+        calls.append(path)
+        return {"data": b"small", "media_type": "image/jpeg", "width": 1024, "height": 768,
+                "original_bytes": 105, "original_tokens": 765, "tokens": 425}
+
+    preprocessor = ImagePreprocessor(prepare=prepare)
+    upload = SpooledUpload(str(tmp_path / "photo.jpg"), "photo.jpg", "image/jpeg", 105, sha256="abc")
+    await asyncio.gather(preprocessor.process(upload), preprocessor.process(upload))
+
+    assert len(calls) == 1
+    stats = preprocessor.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+    assert (stats["bytes_saved"], stats["tokens_saved"]) == (200, 680)
+
+
+def test_large_images_are_downscaled_and_reencoded(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    path = tmp_path / "photo.png"
+    Image.new("RGBA", (4032, 3024), (200, 100, 50, 255)).save(path)
+
+    image = prepare_image(str(path))
+    assert (image["width"], image["height"]) == (1024, 768)
+    assert image["media_type"] == "image/jpeg"
+    assert len(image["data"]) < image["original_bytes"]
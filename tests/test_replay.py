@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from backend.llm.replay import ReplayExpired, ReplayStore
+
+
+async def frames(count, delay=0.01):
+    for index in range(count):
+        await asyncio.sleep(delay)
+        yield {"id": "chatcmpl-1", "index": index}
+
+
+async def collect(r):
+    return [frame["index"] async for frame in r]
+
+
+@pytest.mark.asyncio
+async def test_stream_is_resumed_from_offset_after_disconnect():
+    store = ReplayStore(ttl=0.05)
+    reader = store.start("alice", frames(5))
+    assert [(await reader.__anext__())["index"] for _ in range(2)] == [0, 1]
+    await reader.aclose()
+
+    # the answer keeps being generated while the client reconnects
+    assert store.resume("bob", "chatcmpl-1", 2) is None
+    assert await collect(store.resume("alice", "chatcmpl-1", 2)) == [2, 3, 4]
+
+    await asyncio.sleep(0.1)
+    assert store.resume("alice", "chatcmpl-1", 0) is None
+    assert store.stats()["resumed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_old_frames_fall_out_of_the_ring_unless_a_reader_needs_them():
+    store = ReplayStore(max_frames=2)
+    reader = store.start("alice", frames(5, delay=0))
+    slow = []
+    async for frame in reader:
+        slow.append(frame["index"])
+        await asyncio.sleep(0.01)
+    # a connected reader holds the generation back instead of losing frames
+    assert slow == [0, 1, 2, 3, 4]
+
+    with pytest.raises(ReplayExpired):
+        store.resume("alice", "chatcmpl-1", 1)
+    assert await collect(store.resume("alice", "chatcmpl-1", 3)) == [3, 4]
+
+
+@pytest.mark.asyncio
+async def test_unread_stream_is_cancelled_after_the_grace_period():
+    store = ReplayStore(grace=0.02)
+    reader = store.start("alice", frames(100))
+    await reader.__anext__()
+    await reader.aclose()
+    await asyncio.sleep(0.05)
+
+    buffer = store.buffers[("alice", "chatcmpl-1")]
+    assert buffer.done and buffer.task.cancelled()
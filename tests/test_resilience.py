@@ -0,0 +1,53 @@
+import httpx
+import openai
+from backend.llm.resilience import CircuitBreaker, RetryPolicy, get_retry_after, is_retryable, parse_duration
+
+
+def _error(status_code, headers):
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(status_code, headers=headers, request=request)
+    if status_code == 429:
+        return openai.RateLimitError("rate limited", response=response, body=None)
+    return openai.BadRequestError("bad request", response=response, body=None)
+
+
+def test_get_retry_after():
+    assert get_retry_after(_error(429, {"retry-after-ms": "1500"})) == 1.5
+    assert get_retry_after(_error(429, {"retry-after": "3"})) == 3
+    assert get_retry_after(_error(429, {
+        "x-ratelimit-remaining-requests": "10",
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-remaining-tokens": "0",
+        "x-ratelimit-reset-tokens": "6m0s",
+    })) == 360
+    assert get_retry_after(_error(429, {})) is None
+    assert get_retry_after(Exception("test exception")) is None
+    assert parse_duration("1h2m3.5s") == 3723.5
+    assert parse_duration("20ms") == 0.02
+
+
+def test_is_retryable():
+    assert is_retryable(_error(429, {}))
+    assert not is_retryable(_error(400, {}))
+
+
+def test_backoff_honours_retry_after():
+    policy = RetryPolicy(base_delay=0.5, max_delay=8)
+    assert 2 <= policy.backoff(1, retry_after=2) <= 2.2
+    assert 0 <= policy.backoff(10) <= 8
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+    breaker.record_failure()
+    assert breaker.state() == "closed"
+    breaker.record_failure()
+    assert breaker.state() == "half_open"
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state() == "closed"
+
+    breaker.record_failure(retry_after=60)
+    assert breaker.state() == "open"
+    assert not breaker.allow()
+    assert 59 < breaker.retry_after() <= 60
@@ -0,0 +1,86 @@
+import pytest
+from backend.cache.response_cache import ResponseCache
+
+
+def _model_args(content, temperature=0.0):
+    return {
+        "messages": [{"role": "system", "content": None}, {"role": "user", "content": content}],
+        "temperature": temperature,
+        "max_tokens": 1000,
+        "top_p": 1.0,
+        "stop": None,
+        "stream": True,
+        "model": "gpt-4o",
+    }
+
+
+def _delta(content, finish_reason=None):
+    choice = {"messages": [{"role": "assistant", "content": content}] if content else []}
+    if finish_reason:
+        choice["finish_reason"] = finish_reason
+    return {
+        "id": "chatcmpl-1",
+        "model": "gpt-4o",
+        "created": 1,
+        "object": "chat.completion.chunk",
+        "choices": [choice],
+        "history_metadata": {},
+    }
+
+
+def test_make_key():
+    cache = ResponseCache(max_size=1000, ttl=60)
+    assert cache.make_key(_model_args("hello")) == cache.make_key(_model_args(" hello\n"))
+    assert cache.make_key(_model_args("hello")) != cache.make_key(_model_args("bye"))
+    assert cache.make_key(_model_args("hello", temperature=0.7)) is None
+
+
+@pytest.mark.asyncio
+async def test_record_and_replay():
+    cache = ResponseCache(max_size=1000, ttl=60)
+    key = cache.make_key(_model_args("hello"))
+
+    async def dummy_generator():
+        yield {}
+        yield _delta("Hel")
+        yield _delta("lo")
+        yield _delta(None, finish_reason="stop")
+
+    assert cache.get(key) is None
+    events = [event async for event in cache.record(key, dummy_generator())]
+    assert len(events) == 4
+
+    entry = cache.get(key)
+    replayed = [event async for event in cache.replay(entry, {"conversation_id": "c1"})]
+    assert replayed[0]["choices"][0]["messages"][0]["content"] == "Hello"
+    assert replayed[0]["history_metadata"] == {"conversation_id": "c1"}
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_incomplete_stream_is_not_cached():
+    cache = ResponseCache(max_size=1000, ttl=60)
+    key = cache.make_key(_model_args("hello"))
+
+    async def dummy_generator():
+        yield _delta("Hel")
+        yield _delta("lo")
+
+    stream = cache.record(key, dummy_generator())
+    await stream.__anext__()
+    await stream.aclose()
+    assert cache.get(key) is None
+
+
+@pytest.mark.asyncio
+async def test_truncated_answer_is_not_cached():
+    cache = ResponseCache(max_size=1000, ttl=60)
+    key = cache.make_key(_model_args("hello"))
+
+    async def dummy_generator():
+        yield _delta("Hel")
+        yield _delta("lo", finish_reason="length")
+
+    assert len([event async for event in cache.record(key, dummy_generator())]) == 2
+    assert cache.get(key) is None
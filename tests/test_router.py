@@ -0,0 +1,55 @@
+import pytest
+from backend.llm.router import Deployment, DeploymentRouter
+
+
+def _router(**kwargs):
+    deployments = {
+        "gpt-4o": [
+            Deployment(name="openai", backend="openai", model="gpt-4o"),
+            Deployment(name="aoai-eastus", backend="azure", model="gpt-4o-eastus"),
+        ]
+    }
+    return DeploymentRouter(deployments, default_model="gpt-4o", explore_ratio=0, **kwargs)
+
+
+def test_untried_deployment_is_chosen_first():
+    router = _router()
+    openai, azure = router.deployments["gpt-4o"]
+    openai.record_first_token(0.2)
+    assert router.choose("gpt-4o") is azure
+
+
+def test_lowest_ttft_is_chosen():
+    router = _router()
+    openai, azure = router.deployments["gpt-4o"]
+    openai.record_first_token(0.5)
+    azure.record_first_token(0.2)
+    assert router.choose("gpt-4o") is azure
+    assert router.choose("unknown-model") is azure
+
+
+def test_unhealthy_deployment_is_skipped():
+    router = _router(min_samples=2, max_error_rate=0.5)
+    openai, azure = router.deployments["gpt-4o"]
+    openai.record_first_token(0.5)
+    azure.record_first_token(0.1)
+    azure.record_error()
+    azure.record_error()
+    assert router.choose("gpt-4o") is openai
+    assert router.stats()["gpt-4o"][1]["error_rate"] == pytest.approx(2 / 3)
+
+
+def test_failing_deployment_ranks_after_a_healthy_one():
+    router = _router(min_samples=5)
+    openai, azure = router.deployments["gpt-4o"]
+    openai.record_first_token(0.8)
+    azure.record_error()
+    azure.record_error()
+    assert router.choose("gpt-4o") is openai
+
+    # with errors on both, the one failing less often wins even if slower
+    azure.record_first_token(0.1)
+    openai.record_error()
+    openai.record_first_token(0.8)
+    openai.record_first_token(0.8)
+    assert router.choose("gpt-4o") is openai
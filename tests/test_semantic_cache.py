@@ -0,0 +1,53 @@
+import pytest
+import numpy as np
+from backend.cache.semantic_cache import SemanticCache
+
+
+def _entry(content):
+    return {"id": "chatcmpl-1", "model": "gpt-4o", "created": 1, "object": "chat.completion", "content": content}
+
+
+def test_lookup_by_cosine_similarity():
+    cache = SemanticCache(threshold=0.9, max_entries=10, ttl=60)
+    cache.set("gpt-4o", [1.0, 0.0, 0.0], _entry("answer"))
+
+    assert cache.get("gpt-4o", [0.99, 0.05, 0.0])["content"] == "answer"
+    assert cache.get("gpt-4o", [0.0, 1.0, 0.0]) is None
+    assert cache.get("gpt-3.5-turbo-0125", [1.0, 0.0, 0.0]) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_evicts_least_recently_used():
+    cache = SemanticCache(threshold=0.9, max_entries=2, ttl=60)
+    cache.set("gpt-4o", [1.0, 0.0], _entry("first"))
+    cache.set("gpt-4o", [0.0, 1.0], _entry("second"))
+    cache.get("gpt-4o", [1.0, 0.0])
+    cache.set("gpt-4o", [-1.0, 0.0], _entry("third"))
+
+    assert cache.get("gpt-4o", [1.0, 0.0])["content"] == "first"
+    assert cache.get("gpt-4o", [0.0, 1.0]) is None
+    assert cache.get("gpt-4o", [-1.0, 0.0])["content"] == "third"
+
+
+def test_expired_entries_are_ignored():
+    cache = SemanticCache(threshold=0.9, max_entries=2, ttl=0)
+    cache.set("gpt-4o", [1.0, 0.0], _entry("answer"))
+    assert cache.get("gpt-4o", [1.0, 0.0]) is None
+
+
+def test_matrix_grows_as_entries_arrive():
+    cache = SemanticCache(threshold=0.9, max_entries=40, ttl=60)
+    cache.set("gpt-4o", [1.0, 0.0], _entry("first"))
+    assert cache.stats()["allocated_entries"] == {"gpt-4o": 16}
+
+    for angle in range(1, 20):
+        cache.set("gpt-4o", [np.cos(angle), np.sin(angle)], _entry(str(angle)))
+    stats = cache.stats()
+    assert stats["entries"] == {"gpt-4o": 20}
+    assert stats["allocated_entries"] == {"gpt-4o": 32}
+    assert cache.get("gpt-4o", [1.0, 0.0])["content"] == "first"
+
+    for angle in range(20, 60):
+        cache.set("gpt-4o", [np.cos(angle), np.sin(angle)], _entry(str(angle)))
+    assert cache.stats()["allocated_entries"] == {"gpt-4o": 40}
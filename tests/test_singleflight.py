@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+from backend.llm.singleflight import SingleFlight
+
+
+async def frames(count, started, delay=0.01):
+    started.append(True)
+    for index in range(count):
+        await asyncio.sleep(delay)
+        yield {"index": index}
+
+
+async def collect(r):
+    return [frame["index"] async for frame in r]
+
+
+@pytest.mark.asyncio
+async def test_duplicate_requests_share_one_stream():
+    group = SingleFlight(linger=0.05)
+    started = []
+    leader = group.begin("key").start(frames(3, started))
+    first = asyncio.create_task(collect(leader))
+    await asyncio.sleep(0.015)
+
+    # a request that joins late replays the frames it missed
+    joined = group.join("key")
+    assert await collect(joined.subscribe()) == [0, 1, 2]
+    assert await first == [0, 1, 2]
+    assert started == [True]
+
+    # a retry right after the end still replays, later ones start over
+    assert group.join("key") is joined
+    await asyncio.sleep(0.1)
+    assert group.join("key") is None
+    assert group.stats() == {"in_flight": 0, "started": 1, "joined": 2}
+
+
+@pytest.mark.asyncio
+async def test_failed_flight_is_not_replayed():
+    group = SingleFlight()
+
+    async def failing():
+        yield {"index": 0}
+        raise RuntimeError("upstream failed")
+
+    flight = group.begin("key")
+    with pytest.raises(RuntimeError):
+        await collect(flight.start(failing()))
+    assert group.join("key") is None
+
+
+@pytest.mark.asyncio
+async def test_upstream_is_cancelled_when_every_reader_leaves():
+    group = SingleFlight()
+    flight = group.begin("key")
+    reader = flight.start(frames(100, []))
+    await reader.__anext__()
+    await reader.aclose()
+    await asyncio.sleep(0)
+
+    assert flight.task.cancelled()
+    assert group.join("key") is None
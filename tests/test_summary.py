@@ -0,0 +1,32 @@
+from backend.history.summary import apply_summary, select_turns, summary_request
+
+
+def conversation(turns):
+    messages = []
+    for turn in range(1, turns + 1):
+        messages.append({"role": "user", "content": f"q{turn}"})
+        messages.append({"role": "assistant", "content": f"a{turn}"})
+    return messages
+
+
+def test_turns_are_selected_by_number():
+    messages = conversation(4)
+    assert [m["content"] for m in select_turns(messages, 1, 3)] == ["q2", "a2", "q3", "a3"]
+    assert select_turns(messages, 4, 6) == []
+
+
+def test_summarized_turns_are_dropped():
+    messages = conversation(5)[:-1]
+    summary = {"content": "earlier", "summarizedTurns": 3}
+    assert [m["content"] for m in apply_summary(messages, 5, summary)] == ["q4", "a4", "q5"]
+
+    # a tail that starts with the reply of a summarized turn
+    tail = messages[5:]
+    assert [m["content"] for m in apply_summary(tail, 5, summary)] == ["q4", "a4", "q5"]
+    assert apply_summary(messages, 5, {"content": "all", "summarizedTurns": 9})[-1]["content"] == "q5"
+
+
+def test_update_sends_previous_summary_and_new_turns_only():
+    request = summary_request({"content": "they like tea"}, conversation(1))
+    assert request[0]["role"] == "system"
+    assert request[1]["content"] == "Summary so far:\nthey like tea\n\nNew turns:\nuser: q1\n\nassistant: a1"
@@ -0,0 +1,33 @@
+from backend.history.tail import ConversationTailCache, tail_from_history
+
+
+def test_tail_is_rebuilt_from_history_in_order():
+    history = [
+        {"role": "assistant", "content": "hello", "createdAt": "2024-05-01T00:00:02"},
+        {"role": "user", "content": "hi", "createdAt": "2024-05-01T00:00:01"},
+        {"role": "user", "content": "again", "createdAt": "2024-05-01T00:00:03"},
+    ]
+    tail = tail_from_history(history, max_messages=2)
+    assert tail["version"] == 2
+    assert tail["messages"] == [
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "again"},
+    ]
+
+
+def test_only_cached_tails_are_appended_to():
+    tails = ConversationTailCache(max_messages=3)
+    assert tails.append("u", "c1", {"role": "user", "content": "lost"}) is None
+
+    tails.start("u", "c1")
+    for content in ("one", "two"):
+        tails.append("u", "c1", {"role": "user", "content": content, "id": "x"})
+        tails.append("u", "c1", {"role": "assistant", "content": content.upper()})
+
+    tail = tails.get("u", "c1")
+    assert tail["version"] == 2
+    assert [message["content"] for message in tail["messages"]] == ["ONE", "two", "TWO"]
+
+    tails.discard("u", "c1")
+    assert tails.get("u", "c1") is None
+    assert tails.stats() == {"conversations": 0, "hits": 1, "misses": 1}
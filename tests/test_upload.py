@@ -0,0 +1,61 @@
+import os
+import pytest
+from backend.attachments.upload import UploadRejected, UploadSpooler
+
+BOUNDARY = b"boundary"
+
+
+def multipart(filename, content_type, content):
+    return (
+        b"--boundary\r\n"
+        b'Content-Disposition: form-data; name="messages"\r\n\r\n'
+        b'[{"role": "user", "content": "hi"}]\r\n'
+        b"--boundary\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="' + filename.encode() + b'"\r\n'
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n"
+        + content + b"\r\n"
+        b"--boundary--\r\n"
+    )
+
+
+async def body(data, chunk_size=7):
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+@pytest.mark.asyncio
+async def test_upload_is_spooled_to_disk(tmp_path):
+    spooler = UploadSpooler(max_file_size=1024, allowed_types=["text/*"], spool_dir=tmp_path,
+                            chunk_size=16)
+    content = b"line of text\n" * 20
+    form, files = await spooler.parse(body(multipart("notes.txt", "text/plain", content)), BOUNDARY)
+
+    upload = files["file"]
+    assert form["messages"] == '[{"role": "user", "content": "hi"}]'
+    assert (upload.filename, upload.content_type, upload.size) == ("notes.txt", "text/plain", len(content))
+    assert await upload.read() == content
+    upload.close()
+    assert not os.listdir(tmp_path)
+
+
+@pytest.mark.asyncio
+async def test_upload_limits_are_enforced_while_streaming(tmp_path):
+    spooler = UploadSpooler(max_file_size=64, allowed_types=["application/pdf"], spool_dir=tmp_path)
+
+    with pytest.raises(UploadRejected) as rejected:
+        await spooler.parse(body(multipart("big.pdf", "application/pdf", b"x" * 100)), BOUNDARY)
+    assert rejected.value.status_code == 413
+    with pytest.raises(UploadRejected) as rejected:
+        await spooler.parse(body(multipart("run.sh", "application/octet-stream", b"x")), BOUNDARY)
+    assert rejected.value.status_code == 415
+    assert not os.listdir(tmp_path)
+
+
+@pytest.mark.asyncio
+async def test_oversized_form_field_is_rejected(tmp_path):
+    spooler = UploadSpooler(max_file_size=1024, allowed_types=["text/*"], spool_dir=tmp_path,
+                            max_form_memory_size=16)
+    with pytest.raises(UploadRejected) as error:
+        await spooler.parse(body(multipart("notes.txt", "text/plain", b"text")), BOUNDARY)
+    assert error.value.status_code == 413
+    assert not os.listdir(tmp_path)
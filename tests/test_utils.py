@@ -1,5 +1,17 @@
+import asyncio
+import json
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from quart import Quart, jsonify
+from backend.utils import (
+    ORJSONProvider,
+    StreamFrameEncoder,
+    buffer_stream_response,
+    coalesce_stream_response,
+    drop_finish_frames,
+    format_as_ndjson,
+    parse_multi_columns,
+    try_lock_file,
+)
 
 
 @pytest.mark.asyncio
@@ -27,3 +39,131 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def _delta(content):
+    return {
+        "id": "chatcmpl-1",
+        "choices": [{"messages": [{"role": "assistant", "content": content}]}],
+        "history_metadata": {},
+    }
+
+
+def _contents(events):
+    return [
+        event["choices"][0]["messages"][0]["content"] if event else None
+        for event in events
+    ]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_response():
+    async def dummy_generator():
+        yield {}
+        for content in ["a", "b", "c", "d"]:
+            yield _delta(content)
+        yield {}
+
+    events = [
+        event
+        async for event in coalesce_stream_response(
+            dummy_generator(), flush_interval=10, flush_bytes=1024
+        )
+    ]
+    assert _contents(events) == [None, "a", "bcd", None]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_response_flushes_on_size_and_time():
+    async def dummy_generator():
+        for content in ["a", "bb", "cc", "d"]:
+            yield _delta(content)
+        await asyncio.sleep(0.05)
+        yield _delta("e")
+
+    events = [
+        event
+        async for event in coalesce_stream_response(
+            dummy_generator(), flush_interval=0.01, flush_bytes=4
+        )
+    ]
+    assert _contents(events) == ["a", "bbcc", "d", "e"]
+
+
+def test_stream_frame_encoder_matches_json_dumps():
+    encoder = StreamFrameEncoder()
+    frames = [
+        _delta("こんにちは"),
+        _delta('quote " and \\ backslash\n'),
+        {},
+        dict(_delta("other"), id="chatcmpl-2"),
+    ]
+    for frame in frames:
+        assert encoder.encode(frame) == json.dumps(frame) + "\n"
+
+
+@pytest.mark.asyncio
+async def test_orjson_provider():
+    app = Quart(__name__)
+    app.json = ORJSONProvider(app)
+    async with app.app_context():
+        response = jsonify({"b": 1, "a": "日本語"})
+        assert await response.get_data(as_text=True) == '{"a":"日本語","b":1}\n'
+        assert app.json.loads('{"a": [1, 2]}') == {"a": [1, 2]}
+
+
+@pytest.mark.asyncio
+async def test_buffer_stream_response():
+    async def dummy_generator():
+        for i in range(5):
+            yield {"message": i}
+
+    events = [event async for event in buffer_stream_response(dummy_generator(), max_size=2)]
+    assert events == [{"message": i} for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_buffer_stream_response_closes_source():
+    closed = asyncio.Event()
+
+    async def dummy_generator():
+        try:
+            while True:
+                yield {"message": "test message"}
+        finally:
+            closed.set()
+
+    stream = buffer_stream_response(dummy_generator(), max_size=2)
+    assert await stream.__anext__() == {"message": "test message"}
+    await stream.aclose()
+    await asyncio.wait_for(closed.wait(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_buffer_stream_response_exception():
+    async def dummy_generator():
+        yield {"message": "test message"}
+        raise Exception("test exception")
+
+    events = [event async for event in format_as_ndjson(buffer_stream_response(dummy_generator()))]
+    assert events == ['{"message": "test message"}\n', '{"error": "test exception"}']
+
+
+def test_lock_file_is_held_by_one_owner(tmp_path):
+    path = str(tmp_path / "store" / ".gc.lock")
+    owner = try_lock_file(path)
+    assert owner is not None
+    assert try_lock_file(path) is None
+    owner.close()
+    assert try_lock_file(path) is not None
+
+
+@pytest.mark.asyncio
+async def test_finish_frames_reach_the_client_empty():
+    async def frames():
+        yield {"choices": [{"messages": [{"role": "assistant", "content": "Hi"}]}]}
+        yield {"choices": [{"messages": [], "finish_reason": "stop"}]}
+
+    events = [event async for event in drop_finish_frames(frames())]
+    assert events[0]["choices"][0]["messages"][0]["content"] == "Hi"
+    assert events[1] == {}